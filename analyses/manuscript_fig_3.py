@@ -216,7 +216,7 @@ if __name__ == '__main__':
         
         q = strength_analysis.response_query(session)
         p()
-        q = q.join(strength_analysis.PulseResponseStrength)
+        q = q.join(strength_analysis.PulseResponseStrength, strength_analysis.PulseResponseStrength.pulse_response_id==strength_analysis.PulseResponse.id)
         q = q.filter(strength_analysis.PulseResponseStrength.id.in_(amps['id']))
         q = q.join(db.MultiPatchProbe)
         q = q.filter(db.MultiPatchProbe.induction_frequency < 100)
@@ -283,7 +283,7 @@ if __name__ == '__main__':
 
         # Plot detectability analysis
         q = strength_analysis.baseline_query(session)
-        q = q.join(strength_analysis.BaselineResponseStrength)
+        q = q.join(strength_analysis.BaselineResponseStrength, strength_analysis.BaselineResponseStrength.baseline_id==strength_analysis.Baseline.id)
         q = q.filter(strength_analysis.BaselineResponseStrength.id.in_(base_amps['id']))
         # q = q.limit(100)
         bg_recs = q.all()
@@ -52,7 +52,7 @@ def measure_limit(pair, session, classifier):
     base_amps = strength_analysis.get_baseline_amps(session, pair, amps=amps, clamp_mode='ic')
     
     q = strength_analysis.response_query(session)
-    q = q.join(strength_analysis.PulseResponseStrength)
+    q = q.join(strength_analysis.PulseResponseStrength, strength_analysis.PulseResponseStrength.pulse_response_id==strength_analysis.PulseResponse.id)
     q = q.filter(strength_analysis.PulseResponseStrength.id.in_(amps['id']))
     q = q.join(db.MultiPatchProbe)
     q = q.filter(db.MultiPatchProbe.induction_frequency < 100)
@@ -91,7 +91,7 @@ def measure_limit(pair, session, classifier):
     #hist_plot.plot(hist_bins, hist_y, stepMode=True, pen='k', brush=(0, 150, 150, 100), fillLevel=0)
 
     q = strength_analysis.baseline_query(session)
-    q = q.join(strength_analysis.BaselineResponseStrength)
+    q = q.join(strength_analysis.BaselineResponseStrength, strength_analysis.BaselineResponseStrength.baseline_id==strength_analysis.Baseline.id)
     q = q.filter(strength_analysis.BaselineResponseStrength.id.in_(base_amps['id']))
     bg_recs = q.all()
 
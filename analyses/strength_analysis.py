@@ -15,6 +15,7 @@ import scipy.stats
 import pandas
 from datetime import datetime
 
+import sqlalchemy
 from sqlalchemy.orm import aliased
 import sklearn.svm, sklearn.preprocessing, sklearn.ensemble
 
@@ -344,14 +345,14 @@ class ResponseStrengthAnalyzer(object):
         ids = list(map(int, ids))
         if source == 'fg':
             q = response_query(self.session)
-            q = q.join(db.PulseResponseStrength)
+            q = q.join(db.PulseResponseStrength, db.PulseResponse.pulse_response_strength)
             q = q.filter(db.PulseResponseStrength.id.in_(ids))
             q = q.add_column(db.PulseResponse.start_time)
             traces = self.selected_fg_traces
             plot = self.fg_trace_plot
         else:
             q = baseline_query(self.session)
-            q = q.join(db.BaselineResponseStrength)
+            q = q.join(db.BaselineResponseStrength, db.Baseline.baseline_response_strength)
             q = q.filter(db.BaselineResponseStrength.id.in_(ids))
             q = q.add_column(db.Baseline.start_time)
             traces = self.selected_bg_traces
@@ -424,66 +425,12 @@ class ResponseStrengthAnalyzer(object):
             trace_list.append(spike_scatter)
 
 
-def query_all_pairs(classifier=None):
-    columns = [
-        "connection_strength.*",
-        "experiment.id as experiment_id",
-        "experiment.acq_timestamp as acq_timestamp",
-        "experiment.rig_name",
-        "experiment.acsf",
-        "slice.species as donor_species",
-        "slice.genotype as donor_genotype",
-        "slice.age as donor_age",
-        "slice.sex as donor_sex",
-        "slice.quality as slice_quality",
-        "slice.weight as donor_weight",
-        "slice.slice_time",
-        "pre_cell.ext_id as pre_cell_id",
-        "pre_cell.cre_type as pre_cre_type",
-        "pre_cell.target_layer as pre_target_layer",
-        "pre_morphology.pyramidal as pre_pyramidal",
-        "post_cell.ext_id as post_cell_id",
-        "post_cell.cre_type as post_cre_type",
-        "post_cell.target_layer as post_target_layer",
-        "post_morphology.pyramidal as post_pyramidal",
-        "pair.synapse",
-        "pair.distance",
-        "pair.crosstalk_artifact",
-        "abs(post_cell.ext_id - pre_cell.ext_id) as electrode_distance",
-    ]
-    # columns.extend([
-    #     "detection_limit.minimum_amplitude",
-    # ])
-
-    joins = [
-        "join pair on connection_strength.pair_id=pair.id",
-        "join cell pre_cell on pair.pre_cell_id=pre_cell.id",
-        "join cell post_cell on pair.post_cell_id=post_cell.id",
-        "join morphology pre_morphology on pre_morphology.cell_id=pre_cell.id",
-        "join morphology post_morphology on post_morphology.cell_id=post_cell.id",
-        "join experiment on pair.experiment_id=experiment.id",
-        "join slice on experiment.slice_id=slice.id",
-    ]
-    # joins.extend([
-    #     "left join detection_limit on detection_limit.pair_id=pair.id",
-    # ])
-
-
-    query = ("""
-    select 
-    {columns}
-    from connection_strength
-    {joins}
-    order by acq_timestamp
-    """).format(
-        columns=", ".join(columns), 
-        joins=" ".join(joins),
-    )
+def query_all_pairs(classifier=None, cache=True):
+    # Selects from the denormalized pair_summary table (see pipeline/pair_summary.py)
+    query = db.strength_summary_query()
 
     session = db.Session()
-    df = pandas.read_sql(query, session.bind)
-
-    recs = df.to_records()
+    recs = db.query_cache.read_array(query, session=session, cache=cache)
 
     if classifier is None:
         return recs
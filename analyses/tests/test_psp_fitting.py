@@ -46,6 +46,24 @@ def test_psp_fitting():
 
  
 
+def test_multistart_psp_fitting():
+    """Fitting only the best-ranked initial conditions (with early termination) 
+    should find fits as good as fitting every combination.
+    """
+    test_data_files=[os.path.join(test_data_dir,f) for f in os.listdir(test_data_dir)] #list of test files
+    for file in sorted(test_data_files):
+        test_dict=json.load(open(file)) # load test data
+        avg_trace=neuroanalysis.data.Trace(data=np.array(test_dict['input']['data']), dt=test_dict['input']['dt']) # create Trace object
+        kwds = dict(sign=test_dict['input']['amp_sign'], 
+                    stacked=test_dict['input']['stacked'],
+                    xoffset=([11e-3, 12e-3, 13e-3, 14e-3, 15e-3, 16e-3], -float('inf'), float('inf')))
+        all_fits = fit_psp(avg_trace, **kwds)
+        ranked_fits = fit_psp(avg_trace, patience=2, **kwds)
+        
+        assert np.sum(ranked_fits.residual**2) <= np.sum(all_fits.residual**2) * 1.001, \
+            "Ranked multi-start fit is worse than full search for %s" % file
+
+
 def check_psp_fitting():
     """Plots the results of the current fitting with the save fits and denotes 
     when there is a change. 
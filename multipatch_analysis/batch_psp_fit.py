@@ -0,0 +1,338 @@
+# coding: utf8
+"""
+Fit PSP models to many equal-length traces at once.
+
+Fitting a single averaged response with lmfit is a small least-squares problem, and
+most of the time is spent in Python overhead rather than in the math. Here the
+Psp / StackedPsp model functions are evaluated for a whole block of traces with numpy,
+and a Levenberg-Marquardt loop is run on stacked (n_traces, n_params) arrays, so that
+a whole experiment's worth of averages can be fit in one call.
+
+Parameters are specified as for connection_detection.fit_psp (value, (value, min, max),
+or (value, 'fixed')), except that each value / bound may also be an array giving a
+different value for every trace. Bounds are handled with the same transformation
+used by lmfit.
+"""
+from __future__ import print_function, division
+
+import numpy as np
+from scipy.special import lambertw
+
+from .connection_detection import default_psp_params, default_psp_weights
+
+
+psp_param_names = ['xoffset', 'yoffset', 'rise_time', 'decay_tau', 'amp', 'rise_power']
+
+
+def psp_batch_func(x, xoffset, yoffset, rise_time, decay_tau, amp, rise_power, amp_ratio=None, exp_tau=None):
+    """Evaluate the Psp model (or StackedPsp, if *amp_ratio* is given) for many parameter sets.
+
+    Each parameter is an array of length n_traces; *x* is the array of time values shared
+    by all traces. Returns an array of shape (n_traces, len(x)).
+
+    For the stacked model, the baseline exponential has amplitude amp * amp_ratio (as
+    set up by fit_psp) and decays with *exp_tau*, or with *decay_tau* if exp_tau is None.
+    """
+    col = lambda v: np.asarray(v, dtype=float).reshape(-1, 1)
+    xoffset, yoffset, rise_time, decay_tau, amp, rise_power = map(col, (xoffset, yoffset, rise_time, decay_tau, amp, rise_power))
+
+    # same as Psp._compute_rise_tau
+    rt_over_td = np.minimum(rise_time / (rise_power * decay_tau), 0.99999)
+    denom = np.real(lambertw(-rt_over_td * np.exp(-rt_over_td), k=-1) + rt_over_td)
+    rise_tau = -rise_time / denom
+
+    def inner(t):
+        return (1.0 - np.exp(-t / rise_tau))**rise_power * np.exp(-t / decay_tau)
+
+    xoff = np.asarray(x, dtype=float)[None, :] - xoffset
+    with np.errstate(over='ignore', invalid='ignore'):
+        psp = (amp / inner(rise_time)) * inner(np.maximum(xoff, 0))
+        output = yoffset + np.where(xoff >= 0, psp, 0)
+        if amp_ratio is not None:
+            exp_tau = decay_tau if exp_tau is None else col(exp_tau)
+            output = output + amp * col(amp_ratio) * np.exp(-xoff / exp_tau)
+    return output
+
+
+def _parse_params(params, names, n):
+    """Return arrays (n_traces,) of initial value, min, max, and a vary flag for each parameter.
+    """
+    parsed = {}
+    for name in names:
+        spec = params[name]
+        vary = True
+        lo, hi = -np.inf, np.inf
+        if isinstance(spec, tuple):
+            if len(spec) == 2:
+                if spec[1] != 'fixed':
+                    raise ValueError("Parameter %s: 2-element tuples must be (value, 'fixed')" % name)
+                value = spec[0]
+                vary = False
+            else:
+                value, lo, hi = spec
+                lo = -np.inf if lo is None else lo
+                hi = np.inf if hi is None else hi
+        else:
+            value = spec
+        value, lo, hi = [_per_trace(v, name, n) for v in (value, lo, hi)]
+        if np.any(lo > hi):
+            raise ValueError("Parameter %s: min must not be greater than max" % name)
+        # like lmfit, clip initial values into bounds
+        parsed[name] = (np.clip(value, lo, hi), lo, hi, vary)
+    return parsed
+
+
+def _per_trace(v, name, n):
+    """Return a parameter value or bound as an array with one value per trace.
+
+    Scalars are used for every trace; per-trace values must be given as arrays of
+    length *n*. Lists are rejected: fit_psp interprets them as multiple initial
+    conditions to try, which the batch fit does not support.
+    """
+    if isinstance(v, (list, tuple)):
+        raise ValueError("Parameter %s: multiple initial conditions (%r) are not supported by the batch fit; "
+                         "give per-trace values as an array of length %d" % (name, v, n))
+    v = np.asarray(v, dtype=float)
+    if v.ndim == 0:
+        return np.full(n, float(v))
+    if v.shape != (n,):
+        raise ValueError("Parameter %s: per-trace values must have shape (%d,), got %r" % (name, n, v.shape))
+    return v.copy()
+
+
+def _to_internal(value, lo, hi):
+    """Map bounded parameter values to unbounded internal values (as in lmfit / MINUIT).
+    """
+    both = np.isfinite(lo) & np.isfinite(hi)
+    low = np.isfinite(lo) & ~both
+    high = np.isfinite(hi) & ~both
+    with np.errstate(invalid='ignore', divide='ignore'):
+        out = np.where(both, np.arcsin(np.clip(2 * (value - lo) / (hi - lo) - 1, -1, 1)), value)
+        out = np.where(low, np.sqrt(np.maximum((value - lo + 1)**2 - 1, 0)), out)
+        out = np.where(high, np.sqrt(np.maximum((hi - value + 1)**2 - 1, 0)), out)
+    return np.where(both & (hi == lo), 0, out)
+
+
+def _to_external(internal, lo, hi):
+    """Inverse of _to_internal.
+    """
+    both = np.isfinite(lo) & np.isfinite(hi)
+    low = np.isfinite(lo) & ~both
+    high = np.isfinite(hi) & ~both
+    with np.errstate(invalid='ignore'):
+        out = np.where(both, lo + (np.sin(internal) + 1) * (hi - lo) / 2., internal)
+        out = np.where(low, lo - 1 + np.sqrt(internal**2 + 1), out)
+        out = np.where(high, hi + 1 - np.sqrt(internal**2 + 1), out)
+    return out
+
+
+def fit_psp_batch(data, x, params, stacked=True, weights=None, max_iter=200, ftol=1e-10, xtol=1e-10, lambda_init=1.0):
+    """Fit the Psp or StackedPsp model to every row of *data* using a vectorized
+    Levenberg-Marquardt optimization.
+
+    Parameters
+    ----------
+    data : array
+        (n_traces, n_samples) array of equal-length traces to fit.
+    x : array
+        Time values (n_samples,) shared by all traces.
+    params : dict
+        Initial value / bounds for each model parameter: xoffset, yoffset, rise_time,
+        decay_tau, amp, rise_power, and for the stacked model amp_ratio (and optionally
+        exp_tau). Each may be given as value, (value, min, max), or (value, 'fixed'),
+        where value, min and max are scalars or arrays with one value per trace.
+        Unlike fit_psp, lists of initial values to try are not supported.
+    stacked : bool
+        If True, fit the StackedPsp model with exp_amp = amp * amp_ratio (as in
+        connection_detection.fit_psp); otherwise fit the Psp model.
+    weights : array | None
+        Residual weights, either (n_samples,) or (n_traces, n_samples). Samples with
+        zero weight are masked out of the fit.
+    max_iter : int
+        Maximum number of iterations per trace.
+    ftol, xtol : float
+        A trace is considered converged when an accepted step reduces its sum of squared
+        residuals by a relative amount less than *ftol*, or changes its internal parameter
+        values by less than *xtol* (relative).
+    lambda_init : float
+        Initial damping factor. Damping is then adapted per trace from the ratio of actual
+        to predicted cost reduction (Nielsen 1999); starting with a large damping makes the
+        first steps close to gradient descent, which helps keep xoffset from jumping to a
+        distant local minimum.
+
+    Returns
+    -------
+    result : dict
+        'best_values' : dict of {name: array} with the fit parameters for each trace
+        'best_fit' : (n_traces, n_samples) array of fit model values
+        'residual' : weighted residuals (n_traces, n_samples)
+        'chisqr' : weighted sum of squared residuals per trace
+        'nrmse' : normalized RMS error per trace (as FitModel.nrmse)
+        'success' : bool array; False where the fit did not converge within max_iter,
+                    no step could reduce the error any further, or the initial parameters
+                    gave an invalid model
+        'n_iter' : number of iterations per trace
+    """
+    data = np.atleast_2d(np.asarray(data, dtype=float))
+    x = np.asarray(x, dtype=float)
+    n, m = data.shape
+    if len(x) != m:
+        raise ValueError("Length of x (%d) does not match data (%d samples)" % (len(x), m))
+    if weights is None:
+        weights = np.ones((n, m))
+    else:
+        weights = np.broadcast_to(np.asarray(weights, dtype=float), (n, m))
+
+    names = list(psp_param_names)
+    if stacked:
+        names.append('amp_ratio')
+        if 'exp_tau' in params:
+            names.append('exp_tau')
+    parsed = _parse_params(params, names, n)
+    free = [name for name in names if parsed[name][3]]
+    k = len(free)
+
+    def model_values(internal, rows):
+        values = {name: parsed[name][0][rows] for name in names}
+        for j, name in enumerate(free):
+            values[name] = _to_external(internal[:, j], parsed[name][1][rows], parsed[name][2][rows])
+        return values
+
+    def residuals(internal, rows):
+        values = model_values(internal, rows)
+        return (psp_batch_func(x, **values) - data[rows]) * weights[rows]
+
+    all_rows = np.arange(n)
+    internal = np.empty((n, k))
+    for j, name in enumerate(free):
+        value, lo, hi, _ = parsed[name]
+        internal[:, j] = _to_internal(value, lo, hi)
+
+    resid = residuals(internal, all_rows)
+    cost = (resid**2).sum(axis=1)
+    lam = np.full(n, float(lambda_init))
+    nu = np.full(n, 2.)
+    active = np.isfinite(cost)
+    success = np.zeros(n, dtype=bool)
+    n_iter = np.zeros(n, dtype=int)
+
+    # normal equations for each trace; recomputed only after a step is accepted
+    jtj = np.zeros((n, k, k))
+    jtr = np.zeros((n, k))
+    stale = np.ones(n, dtype=bool)
+    eye = np.eye(k)
+
+    for i in range(max_iter):
+        rows = np.nonzero(active)[0]
+        if len(rows) == 0 or k == 0:
+            break
+        n_iter[rows] += 1
+
+        # forward-difference jacobian for traces whose parameters changed
+        jrows = rows[stale[rows]]
+        if len(jrows) > 0:
+            p0 = internal[jrows]
+            r0 = resid[jrows]
+            step = 1.49012e-8 * np.where(p0 == 0, 1.0, np.abs(p0))
+            jac = np.empty((len(jrows), m, k))
+            for j in range(k):
+                p1 = p0.copy()
+                p1[:, j] += step[:, j]
+                jac[:, :, j] = (residuals(p1, jrows) - r0) / step[:, j:j+1]
+            jac[~np.isfinite(jac)] = 0
+            jtj[jrows] = np.einsum('nmi,nmj->nij', jac, jac)
+            jtr[jrows] = np.einsum('nmi,nm->ni', jac, r0)
+            stale[jrows] = False
+
+        # damped step (Marquardt scaling by the diagonal of J^T J)
+        jtj_rows = jtj[rows]
+        jtr_rows = jtr[rows]
+        diag = np.diagonal(jtj_rows, axis1=1, axis2=2)
+        diag = np.maximum(diag, 1e-12 * diag.max(axis=1, keepdims=True) + 1e-300)
+        a = jtj_rows + lam[rows, None, None] * diag[:, :, None] * eye[None, :, :]
+        try:
+            delta = np.linalg.solve(a, -jtr_rows[:, :, None])[:, :, 0]
+        except np.linalg.LinAlgError:
+            delta = -np.einsum('nij,nj->ni', np.linalg.pinv(a), jtr_rows)
+
+        trial = internal[rows] + delta
+        trial_resid = residuals(trial, rows)
+        trial_cost = (trial_resid**2).sum(axis=1)
+        better = np.isfinite(trial_cost) & (trial_cost < cost[rows])
+
+        # ratio of actual to predicted (linearized) reduction in cost
+        predicted = -(2 * np.einsum('ni,ni->n', delta, jtr_rows) + np.einsum('ni,nij,nj->n', delta, jtj_rows, delta))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            gain = (cost[rows] - trial_cost) / predicted
+        gain = np.where(np.isfinite(gain), gain, 1.0)
+
+        # accept improved steps
+        acc = rows[better]
+        reduction = (cost[acc] - trial_cost[better]) / np.maximum(cost[acc], 1e-300)
+        small_step = np.all(np.abs(delta[better]) <= xtol * (np.abs(internal[acc]) + xtol), axis=1)
+        internal[acc] = trial[better]
+        resid[acc] = trial_resid[better]
+        cost[acc] = trial_cost[better]
+        # damping update from Nielsen (1999): relax damping when the model predicted the reduction well
+        lam[acc] = np.maximum(lam[acc] * np.maximum(1/3., 1 - (2 * gain[better] - 1)**3), 1e-12)
+        nu[acc] = 2.
+        stale[acc] = True
+        done = acc[(reduction < ftol) | small_step]
+        success[done] = True
+        active[done] = False
+
+        # increase damping for rejected steps; give up (unsuccessfully) when no step can reduce the error
+        rej = rows[~better]
+        lam[rej] *= nu[rej]
+        nu[rej] *= 2.
+        active[rej[lam[rej] > 1e16]] = False
+
+    best_values = model_values(internal, all_rows)
+    best_fit = psp_batch_func(x, **best_values)
+    # weighted standard deviation of the data, as used by FitModel.nrmse
+    wsum = weights.sum(axis=1)
+    avg = (data * weights).sum(axis=1) / wsum
+    std = (((data - avg[:, None])**2 * weights).sum(axis=1) / wsum)**0.5
+    rmse = (cost / m)**0.5
+    if stacked:
+        best_values['exp_amp'] = best_values['amp'] * best_values['amp_ratio']
+
+    return {
+        'best_values': best_values,
+        'best_fit': best_fit,
+        'residual': resid,
+        'chisqr': cost,
+        'nrmse': rmse / std,
+        'success': success,
+        'n_iter': n_iter,
+    }
+
+
+def fit_psp_traces(traces, mode='ic', sign='any', stacked=True, weight='default', rise_time_mult_factor=10., max_iter=200, lambda_init=1.0, **params):
+    """Fit many equal-length Traces (for example, averaged responses from all pairs in an
+    experiment) using the same defaults as connection_detection.fit_psp.
+
+    Extra keyword arguments override the default parameters (see fit_psp); their values /
+    bounds may be arrays with one value per trace, but not lists of initial values to
+    try (as accepted by fit_psp). *weight* may be 'default', False,
+    or an array of weights. All traces must share the same time values.
+
+    Returns the result of fit_psp_batch.
+    """
+    if len(traces) == 0:
+        raise ValueError("No traces to fit")
+    t = traces[0].time_values
+    dt = traces[0].dt
+    data = np.vstack([tr.data for tr in traces])
+
+    base_params = default_psp_params(mode=mode, sign=sign, stacked=stacked, rise_time_mult_factor=rise_time_mult_factor)
+    # exp_amp is computed from amp_ratio by the batch model
+    base_params.pop('exp_amp', None)
+    base_params.update(params)
+
+    if weight == 'default':
+        weight = default_psp_weights(data.shape[1], dt)
+    elif weight is False:
+        weight = None
+
+    return fit_psp_batch(data, t, base_params, stacked=stacked, weights=weight, max_iter=max_iter, lambda_init=lambda_init)
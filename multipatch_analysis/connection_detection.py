@@ -1,10 +1,11 @@
+import warnings
 from copy import deepcopy
 import numpy as np
 import scipy.signal
 import pyqtgraph as pg
 
 from .data import MultiPatchProbe, Analyzer, PulseStimAnalyzer
-from . import qc
+from . import qc, fit_cache
 from neuroanalysis.stats import ragged_mean
 from neuroanalysis.data import Trace, TraceList
 from neuroanalysis.fitting import StackedPsp, Psp
@@ -566,6 +567,158 @@ def create_all_fit_param_combos(base_params):
     
     return param_dict_list
 
+def rank_fit_starts(psp, y, t, param_dict_list, weights=None):
+    """Return *param_dict_list* sorted by the (weighted) sum of squared residuals of the 
+    model evaluated at each set of initial conditions, best first.
+    
+    This costs one model evaluation per set, which is negligible compared to a fit.
+    """
+    errs = []
+    for p in param_dict_list:
+        residual = psp.eval(psp.make_params(**p), x=t) - y
+        if weights is not None:
+            residual = residual * weights
+        errs.append(np.sum(residual**2))
+    # nan errors (invalid initial conditions) sort last
+    order = np.argsort(errs, kind='mergesort')
+    return [param_dict_list[i] for i in order]
+
+
+def _fit_start_error(args):
+    """Run one fit in a worker process and return its sum of squared residuals.
+    """
+    psp_class, y, t, params, fit_kws, method = args
+    fit = psp_class().fit(y, x=t, params=params, fit_kws=fit_kws, method=method)
+    return np.sum(fit.residual**2)
+
+
+def fit_psp_starts(psp, y, t, param_dict_list, fit_kws=None, method='leastsq', max_starts=None, patience=None, rtol=1e-3, pool=None):
+    """Fit *psp* to data starting from each set of initial conditions in *param_dict_list*
+    (see create_all_fit_param_combos) and return the fit with the smallest sum of squared
+    residuals.
+    
+    By default, every set is fit in the order given. If *max_starts* or *patience* is 
+    specified, the sets are first ranked by the residual of the model evaluated at their
+    initial conditions (see rank_fit_starts) so that the most promising starts are fit first.
+    
+    Parameters
+    ----------
+    max_starts : int | None
+        Fit only the best-ranked *max_starts* sets of initial conditions.
+    patience : int | None
+        Stop after this many consecutive fits have failed to improve on the best fit by 
+        more than a fraction *rtol* of its error.
+    pool : multiprocessing.Pool | None
+        If given, starts are fit in batches (one per pool process) in the pool. Only the
+        errors are returned from the workers; the winning start is fit again locally to 
+        produce the returned fit, which is identical to fitting it directly.
+    """
+    if fit_kws is None:
+        fit_kws = {}
+    if (max_starts is not None or patience is not None) and len(param_dict_list) > 1:
+        param_dict_list = rank_fit_starts(psp, y, t, param_dict_list, weights=fit_kws.get('weights'))
+    if max_starts is not None:
+        param_dict_list = param_dict_list[:max_starts]
+    batch_size = 1 if pool is None else max(1, getattr(pool, '_processes', 1))
+
+    best_fit = None
+    best_index = None
+    best_score = None
+    n_stale = 0
+    for start in range(0, len(param_dict_list), batch_size):
+        batch = param_dict_list[start:start+batch_size]
+        if pool is None:
+            fits = [psp.fit(y, x=t, params=p, fit_kws=fit_kws, method=method) for p in batch]
+            # note: using this because normalized (nrmse) is not necessary to comparing fits within the same data set
+            errs = [np.sum(fit.residual**2) for fit in fits]
+        else:
+            fits = [None] * len(batch)
+            errs = pool.map(_fit_start_error, [(type(psp), y, t, p, fit_kws, method) for p in batch])
+        
+        for i, err in enumerate(errs):
+            if best_score is None or err < best_score:
+                if best_score is None or err < best_score * (1 - rtol):
+                    n_stale = 0
+                else:
+                    n_stale += 1
+                best_fit = fits[i]
+                best_index = start + i
+                best_score = err
+            else:
+                n_stale += 1
+        
+        if patience is not None and n_stale >= patience:
+            break
+    
+    if best_fit is None and best_index is not None:
+        best_fit = psp.fit(y, x=t, params=param_dict_list[best_index], fit_kws=fit_kws, method=method)
+    return best_fit
+
+
+def default_psp_params(mode='ic', sign='any', stacked=True, rise_time_mult_factor=10.):
+    """Return the default initial conditions and bounds used by fit_psp (see 
+    fit_psp for a description of the arguments).
+    """
+    # set initial conditions depending on whether in voltage or current clamp
+    # note that sign of these will automatically be set later on based on the 
+    # the *sign* input
+    if mode == 'ic':
+        amp_init = .2e-3
+        amp_max = 100e-3
+        rise_time_init = 5e-3
+        decay_tau_init = 50e-3
+    elif mode == 'vc':
+        amp_init = 20e-12
+        amp_max = 500e-12
+        rise_time_init = 1e-3
+        decay_tau_init = 4e-3
+    else:
+        raise ValueError('mode must be "ic" or "vc"')
+
+    # Set up amplitude initial values and boundaries depending on whether *sign* are positive or negative
+    if sign == '-':
+        amps = (-amp_init, -amp_max, 0)
+    elif sign == '+':
+        amps = (amp_init, 0, amp_max)
+    elif sign =='any':
+        warnings.warn("You are not specifying the predicted sign of your psp.  This may slow down or mess up fitting")
+        amps = (0, -amp_max, amp_max)
+    else:
+        raise ValueError('sign must be "+", "-", or "any"')
+        
+    # initial condition, lower boundry, upper boundry    
+    base_params = {
+        'xoffset': (14e-3, -float('inf'), float('inf')),
+        'yoffset': (0, -float('inf'), float('inf')),
+        'rise_time': (rise_time_init, rise_time_init/rise_time_mult_factor, rise_time_init*rise_time_mult_factor),
+        'decay_tau': (decay_tau_init, decay_tau_init/10., decay_tau_init*10.),
+        'rise_power': (2, 'fixed'),
+        'amp': amps
+    }
+    
+    if not isinstance(stacked, bool):
+        raise Exception("Stacked must be True or False")
+    if stacked:
+        base_params.update({
+            #TODO: figure out the bounds on these
+            'exp_amp': 'amp * amp_ratio',
+            'amp_ratio': (0, -100, 100),
+        })  
+    
+    return base_params
+
+
+def default_psp_weights(n_samples, dt):
+    """Return the default fit weighting used by fit_psp for traces aligned to the
+    presynaptic pulse.
+    """
+    # THIS CODE IS DEPENDENT ON THE DATA BEING INPUT IN A CERTAIN WAY THAT IS NOT TESTED
+    weight = np.ones(n_samples)*10.  #set everything to ten initially
+    weight[int(10e-3/dt):int(12e-3/dt)] = 0.   #area around stim artifact
+    weight[int(12e-3/dt):int(19e-3/dt)] = 30.  #area around steep PSP rise 
+    return weight
+
+
 def fit_psp(response, 
             mode='ic', 
             sign='any', #Note this will not be used if *amp* input is specified
@@ -583,6 +736,11 @@ def fit_psp(response,
                 exp_amp='default',
                 xoffset='default', 
                 yoffset='default',
+            # options for fitting from multiple initial conditions (see fit_psp_starts)
+            max_starts=None,
+            patience=None,
+            pool=None,
+            cache=True,
             ):
     """Fit psp. function to the equation 
     
@@ -640,6 +798,14 @@ def fit_psp(response,
         amp_ratio : scalar 
             if *stacked* this is used to set up the ratio between the 
             residual decay amplitude and the height of the PSP.
+    max_starts, patience, pool :
+        When several initial conditions are given, these limit the number of 
+        fits that are run and optionally distribute them to a process pool 
+        (see fit_psp_starts). By default, every combination is fit.
+    cache : bool
+        If True, results are stored in and read from the on-disk fit cache (see
+        fit_cache), so that repeated fits of the same data with the same settings 
+        return immediately. The cache can be disabled globally with config.fit_cache.
     
     Returns
     -------
@@ -652,53 +818,11 @@ def fit_psp(response,
     y=response.data
     dt = response.dt
     
-    # set initial conditions depending on whether in voltage or current clamp
-    # note that sign of these will automatically be set later on based on the 
-    # the *sign* input
-    if mode == 'ic':
-        amp_init = .2e-3
-        amp_max = 100e-3
-        rise_time_init = 5e-3
-        decay_tau_init = 50e-3
-    elif mode == 'vc':
-        amp_init = 20e-12
-        amp_max = 500e-12
-        rise_time_init = 1e-3
-        decay_tau_init = 4e-3
-    else:
-        raise ValueError('mode must be "ic" or "vc"')
+    base_params = default_psp_params(mode=mode, sign=sign, stacked=stacked, rise_time_mult_factor=rise_time_mult_factor)
 
-    # Set up amplitude initial values and boundaries depending on whether *sign* are positive or negative
-    if sign == '-':
-        amps = (-amp_init, -amp_max, 0)
-    elif sign == '+':
-        amps = (amp_init, 0, amp_max)
-    elif sign =='any':
-        warnings.warn("You are not specifying the predicted sign of your psp.  This may slow down or mess up fitting")
-        amps = (0, -amp_max, amp_max)
-    else:
-        raise ValueError('sign must be "+", "-", or "any"')
-        
-    # initial condition, lower boundry, upper boundry    
-    base_params = {
-        'xoffset': (14e-3, -float('inf'), float('inf')),
-        'yoffset': (0, -float('inf'), float('inf')),
-        'rise_time': (rise_time_init, rise_time_init/rise_time_mult_factor, rise_time_init*rise_time_mult_factor),
-        'decay_tau': (decay_tau_init, decay_tau_init/10., decay_tau_init*10.),
-        'rise_power': (2, 'fixed'),
-        'amp': amps
-    }
-    
-    # specify fitting function and set up conditions
-    if not isinstance(stacked, bool):
-        raise Exception("Stacked must be True or False")
+    # specify fitting function
     if stacked:
         psp = StackedPsp()
-        base_params.update({
-            #TODO: figure out the bounds on these
-            'exp_amp': 'amp * amp_ratio',
-            'amp_ratio': (0, -100, 100),
-        })  
     else:
         psp = Psp()
     
@@ -709,10 +833,7 @@ def fit_psp(response,
     
     # set weighting that 
     if weight == 'default': #use default weighting
-        # THIS CODE IS DEPENDENT ON THE DATA BEING INPUT IN A CERTAIN WAY THAT IS NOT TESTED
-        weight = np.ones(len(y))*10.  #set everything to ten initially
-        weight[int(10e-3/dt):int(12e-3/dt)] = 0.   #area around stim artifact
-        weight[int(12e-3/dt):int(19e-3/dt)] = 30.  #area around steep PSP rise 
+        weight = default_psp_weights(len(y), dt)
     elif weight is False: #do not weight any part of the stimulus
         weight = np.ones(len(y))
     elif 'weight' in vars():  #works if there is a value specified in weight
@@ -725,16 +846,21 @@ def fit_psp(response,
     # convert initial parameters into a list of dictionaries to be consumed by psp.fit()        
     param_dict_list= create_all_fit_param_combos(base_params)
 
+    # repeated fits of the same data with the same settings are read from disk
+    if cache and fit_cache.enabled():
+        cache_key = fit_cache.fit_key('connection_detection.fit_psp', y, t, base_params, weight, 
+                                      stacked, method, max_starts, patience)
+        fit = fit_cache.get(cache_key)
+    else:
+        cache_key = None
+        fit = None
+
     # cycle though different parameters sets and chose best one
-    best_fit = None
-    best_score = None
-    for p in param_dict_list:
-        fit = psp.fit(y, x=t, params=p, fit_kws=fit_kws, method=method)
-        err = np.sum(fit.residual**2)  # note: using this because normalized (nrmse) is not necessary to comparing fits within the same data set
-        if best_fit is None or err < best_score:
-            best_fit = fit
-            best_score = err
-    fit = best_fit
+    if fit is None:
+        fit = fit_psp_starts(psp, y, t, param_dict_list, fit_kws=fit_kws, method=method, 
+                             max_starts=max_starts, patience=patience, pool=pool)
+        if cache_key is not None:
+            fit_cache.store(cache_key, fit)
 
     # nrmse = fit.nrmse()
     if 'baseline_std' in response.meta:
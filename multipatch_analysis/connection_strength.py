@@ -8,18 +8,51 @@ from __future__ import print_function, division
 import sys, multiprocessing, time
 
 import numpy as np
-import pandas
 import scipy.stats
 
 from neuroanalysis.data import Trace, TraceList
 from neuroanalysis.baseline import float_mode
 
 from .connection_detection import fit_psp
+from .util import nearest_unused_match
 from . import database as db
 
 
-def get_amps(session, pair, clamp_mode='ic', get_data=False):
+def get_amps(session, pair, clamp_mode='ic', get_data=False, cache=True):
     """Select records from pulse_response_strength table
+
+    If *cache* is True, then results are read from / written to the local query cache
+    (see database.query_cache).
+    """
+    q = amps_query(session, pair, clamp_mode=clamp_mode, get_data=get_data)
+    recs = db.query_cache.read_array(q, session=session, cache=cache)
+    if get_data:
+        _fill_snippet_data(session, db.PulseResponse, recs, 'pulse_response_id')
+    return recs
+
+
+def amps_query(session, pair, clamp_mode='ic', get_data=False):
+    """Return the query used by get_amps()
+    """
+    q, pre_rec, post_rec = _amps_query(session, get_data=get_data)
+        
+    filters = [
+        (pre_rec.electrode==pair.pre_cell.electrode,),
+        (post_rec.electrode==pair.post_cell.electrode,),
+        (db.PatchClampRecording.clamp_mode==clamp_mode,),
+        (db.PatchClampRecording.qc_pass==True,),
+    ]
+    for filter_args in filters:
+        q = q.filter(*filter_args)
+    
+    # should result in chronological order
+    q = q.order_by(db.PulseResponse.id)
+    return q
+
+
+def _amps_query(session, get_data=False):
+    """Return the unfiltered pulse response strength query used by amps_query() and
+    experiment_amps_query(), along with the pre- and postsynaptic recording aliases.
     """
     cols = [
         db.PulseResponseStrength.id,
@@ -40,18 +73,86 @@ def get_amps(session, pair, clamp_mode='ic', get_data=False):
         db.PulseResponse.start_time.label('response_start_time'),
     ]
     if get_data:
+        cols.append(db.PulseResponse.id.label('pulse_response_id'))
         cols.append(db.PulseResponse.data)
 
     q = session.query(*cols)
     q = q.join(db.PulseResponse, db.PulseResponseStrength.pulse_response)
     
     q, pre_rec, post_rec = join_pulse_response_to_expt(q)
-    q = q.join(db.StimSpike)
+    q = q.join(db.StimSpike, db.StimPulse.spikes)
     q = q.add_columns(post_rec.start_time.label('rec_start_time'))
-        
+    return q, pre_rec, post_rec
+
+
+def experiment_amps_query(session, expt, get_data=False):
+    """Return a query selecting the same records as amps_query() for all pairs and
+    clamp modes in an experiment at once.
+
+    The results include pre_electrode_id and post_electrode_id columns so that
+    records can be assigned to pairs (see get_experiment_amps).
+    """
+    q, pre_rec, post_rec = _amps_query(session, get_data=get_data)
+    q = q.add_columns(pre_rec.electrode_id.label('pre_electrode_id'), post_rec.electrode_id.label('post_electrode_id'))
+    # filtering on the denormalized experiment_id allows partition pruning
+    q = q.filter(db.PulseResponse.experiment_id==expt.id)
+    q = q.filter(db.PatchClampRecording.qc_pass==True)
+    q = q.order_by(db.PulseResponse.id)
+    return q
+
+
+def _fill_snippet_data(session, table, recs, id_col):
+    """Fill in the data column for records that reference a chunk of their recording's data
+    rather than storing their own.
+    """
+    missing = [i for i in range(len(recs)) if recs['data'][i] is None]
+    if len(missing) == 0:
+        return
+    snippets = db.load_snippet_data(session, table, [int(recs[id_col][i]) for i in missing])
+    for i in missing:
+        recs['data'][i] = snippets[recs[id_col][i]]
+
+
+def get_baseline_amps(session, pair, clamp_mode='ic', amps=None, get_data=True, cache=True):
+    """Select records from baseline_response_strength table
+
+    If *amps* is given (output from get_amps), then baseline records will be selected from the same
+    sweeps as the responses.
+
+    If *cache* is True, then results are read from / written to the local query cache
+    (see database.query_cache).
+    """
+    q = baseline_amps_query(session, pair, clamp_mode=clamp_mode, get_data=get_data)
+    recs = db.query_cache.read_array(q, session=session, cache=cache)
+
+    if amps is not None:
+        recs = select_nearest_baselines(amps, recs)
+
+    if get_data:
+        _fill_snippet_data(session, db.Baseline, recs, 'baseline_id')
+
+    return recs
+
+
+def select_nearest_baselines(amps, recs):
+    """For each record returned from get_amps, select the nearest baseline record from *recs*
+    (without reusing any baseline record).
+    """
+    mask = np.zeros(len(recs), dtype=bool)
+    amp_times = amps['rec_start_time'].astype(float)*1e-9 + amps['response_start_time']
+    base_times = recs['rec_start_time'].astype(float)*1e-9 + recs['response_start_time']
+    matches = nearest_unused_match(amp_times, base_times)
+    mask[matches[matches >= 0]] = True
+    return recs[mask]
+
+
+def baseline_amps_query(session, pair, clamp_mode='ic', get_data=True):
+    """Return the query used by get_baseline_amps()
+    """
+    q = _baseline_amps_query(session, get_data=get_data)
+    
     filters = [
-        (pre_rec.electrode==pair.pre_cell.electrode,),
-        (post_rec.electrode==pair.post_cell.electrode,),
+        (db.Recording.electrode==pair.post_cell.electrode,),
         (db.PatchClampRecording.clamp_mode==clamp_mode,),
         (db.PatchClampRecording.qc_pass==True,),
     ]
@@ -59,18 +160,32 @@ def get_amps(session, pair, clamp_mode='ic', get_data=False):
         q = q.filter(*filter_args)
     
     # should result in chronological order
-    q = q.order_by(db.PulseResponse.id)
+    q = q.order_by(db.Recording.start_time)
 
-    df = pandas.read_sql_query(q.statement, q.session.bind)
-    recs = df.to_records()
-    return recs
+    # if amps is not None:
+    #     q = q.limit(len(amps))
 
+    return q
 
-def get_baseline_amps(session, pair, clamp_mode='ic', amps=None, get_data=True):
-    """Select records from baseline_response_strength table
 
-    If *amps* is given (output from get_amps), then baseline records will be selected from the same
-    sweeps as the responses.
+def experiment_baseline_amps_query(session, expt, get_data=True):
+    """Return a query selecting the same records as baseline_amps_query() for all
+    electrodes and clamp modes in an experiment at once.
+
+    The results include an electrode_id column so that records can be assigned to
+    pairs (see get_experiment_amps).
+    """
+    q = _baseline_amps_query(session, get_data=get_data)
+    q = q.add_columns(db.Recording.electrode_id)
+    q = q.filter(db.Baseline.experiment_id==expt.id)
+    q = q.filter(db.PatchClampRecording.qc_pass==True)
+    q = q.order_by(db.Recording.start_time, db.Baseline.id)
+    return q
+
+
+def _baseline_amps_query(session, get_data=True):
+    """Return the unfiltered baseline response strength query used by baseline_amps_query()
+    and experiment_baseline_amps_query().
     """
     cols = [
         db.BaselineResponseStrength.id,
@@ -90,6 +205,7 @@ def get_baseline_amps(session, pair, clamp_mode='ic', amps=None, get_data=True):
         db.Baseline.start_time.label('response_start_time'),
     ]
     if get_data:
+        cols.append(db.Baseline.id.label('baseline_id'))
         cols.append(db.Baseline.data)
         
     q = session.query(*cols)
@@ -97,40 +213,44 @@ def get_baseline_amps(session, pair, clamp_mode='ic', amps=None, get_data=True):
     q = q.join(db.Recording)
     q = q.join(db.PatchClampRecording)
     q = q.join(db.SyncRec)
-    q = q.join(db.Experiment)
-    
-    filters = [
-        (db.Recording.electrode==pair.post_cell.electrode,),
-        (db.PatchClampRecording.clamp_mode==clamp_mode,),
-        (db.PatchClampRecording.qc_pass==True,),
-    ]
-    for filter_args in filters:
-        q = q.filter(*filter_args)
-    
-    # should result in chronological order
-    q = q.order_by(db.Recording.start_time)
+    q = q.join(db.Experiment, db.SyncRec.experiment)
+    return q
 
-    # if amps is not None:
-    #     q = q.limit(len(amps))
 
-    df = pandas.read_sql_query(q.statement, q.session.bind)
-    recs = df.to_records()
+def get_experiment_amps(session, expt, get_data=False, get_baseline_data=False, cache=True):
+    """Select pulse response and baseline strength records for all pairs in an experiment.
 
-    if amps is not None:
-        # for each record returned from get_amps, return the nearest baseline record
-        mask = np.zeros(len(recs), dtype=bool)
-        amp_times = amps['rec_start_time'].astype(float)*1e-9 + amps['response_start_time']
-        base_times = recs['rec_start_time'].astype(float)*1e-9 + recs['response_start_time']
-        for i in range(len(amps)):
-            order = np.argsort(np.abs(base_times - amp_times[i]))
-            for j in order:
-                if mask[j]:
-                    continue
-                mask[j] = True
-                break
-        recs = recs[mask]
+    This is equivalent to calling get_amps() and get_baseline_amps(amps=...) for every pair
+    and clamp mode, but uses only two queries for the entire experiment.
 
-    return recs
+    Returns a dict of {pair_id: amps}, where each *amps* is structured as required by
+    analyze_pair_connectivity().
+    """
+    fg_recs = db.query_cache.read_array(experiment_amps_query(session, expt, get_data=get_data), session=session, cache=cache)
+    bg_recs = db.query_cache.read_array(experiment_baseline_amps_query(session, expt, get_data=get_baseline_data), session=session, cache=cache)
+    if get_data:
+        _fill_snippet_data(session, db.PulseResponse, fg_recs, 'pulse_response_id')
+
+    pair_amps = {}
+    for pair in expt.pair_list:
+        pre_id = pair.pre_cell.electrode_id
+        post_id = pair.post_cell.electrode_id
+        fg_pair = (fg_recs['pre_electrode_id'] == pre_id) & (fg_recs['post_electrode_id'] == post_id)
+        bg_post = bg_recs['electrode_id'] == post_id
+        amps = {}
+        for clamp_mode in ('ic', 'vc'):
+            fg = fg_recs[fg_pair & (fg_recs['clamp_mode'] == clamp_mode)]
+            bg = bg_recs[bg_post & (bg_recs['clamp_mode'] == clamp_mode)]
+            amps[clamp_mode, 'fg'] = fg
+            amps[clamp_mode, 'bg'] = select_nearest_baselines(fg, bg)
+        pair_amps[pair.id] = amps
+
+    if get_baseline_data:
+        for amps in pair_amps.values():
+            for clamp_mode in ('ic', 'vc'):
+                _fill_snippet_data(session, db.Baseline, amps[clamp_mode, 'bg'], 'baseline_id')
+
+    return pair_amps
 
 
 def join_pulse_response_to_expt(query):
@@ -140,7 +260,7 @@ def join_pulse_response_to_expt(query):
         (post_rec, db.PulseResponse.recording),
         (db.PatchClampRecording,),
         (db.SyncRec,),
-        (db.Experiment,),
+        (db.Experiment, db.SyncRec.experiment),
         (db.StimPulse, db.PulseResponse.stim_pulse),
         (pre_rec, db.StimPulse.recording),
     ]
@@ -313,7 +433,8 @@ def analyze_pair_connectivity(amps, sign=None):
         sign = {'pos':'+', 'neg':'-'}[signs[clamp_mode]]
         fg_bsub = fg_avg.copy(data=fg_avg.data - base)  # remove base to help fitting
         try:
-            fit = fit_psp(fg_bsub, mode=clamp_mode, sign=sign, xoffset=(1e-3, 0, 6e-3), yoffset=(0, None, None), rise_time_mult_factor=4)              
+            # pipeline fits are stored in the database; don't fill the fit cache with them
+            fit = fit_psp(fg_bsub, mode=clamp_mode, sign=sign, xoffset=(1e-3, 0, 6e-3), yoffset=(0, None, None), rise_time_mult_factor=4, cache=False)
             for param, val in fit.best_values.items():
                 fields['%s_fit_%s' % (clamp_mode, param)] = val
             fields[clamp_mode + '_fit_yoffset'] = fit.best_values['yoffset'] + base
@@ -713,6 +713,41 @@ def query_pairs(project_name=None, acsf=None, age=None, species=None, distance=N
     return pairs
 
 
+def query_pair_summary(project_name=None, acsf=None, age=None, species=None, distance=None, session=None, internal=None):
+    """Generate a query for selecting records from the pair_summary table.
+
+    Accepts the same filter arguments as query_pairs(), but selects from a single denormalized
+    table rather than joining pair, cell, experiment, slice, and connection_strength.
+    """
+    ps = db.PairSummary
+    q = session.query(ps).filter(ps.connection_strength_id!=None)
+
+    for column, value in [(ps.project_name, project_name), (ps.acsf, acsf), (ps.internal, internal)]:
+        if value is None:
+            continue
+        if isinstance(value, str):
+            q = q.filter(column==value)
+        else:
+            q = q.filter(column.in_(value))
+
+    if age is not None:
+        if age[0] is not None:
+            q = q.filter(ps.donor_age>=age[0])
+        if age[1] is not None:
+            q = q.filter(ps.donor_age<=age[1])
+
+    if distance is not None:
+        if distance[0] is not None:
+            q = q.filter(ps.distance>=distance[0])
+        if distance[1] is not None:
+            q = q.filter(ps.distance<=distance[1])
+
+    if species is not None:
+        q = q.filter(ps.donor_species==species)
+
+    return q
+
+
 def pair_was_probed(pair, excitatory):
     qc_field = 'n_%s_test_spikes' % ('ex' if excitatory else 'in')
 
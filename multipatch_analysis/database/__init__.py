@@ -1,4 +1,6 @@
-from .database import Session, aliased, default_session, get_default_session, reset_db, vacuum, dispose_engines, default_sample_rate, db_name, bake_sqlite
+from collections import OrderedDict
+from sqlalchemy.orm import joinedload, selectinload
+from .database import Session, aliased, default_session, get_default_session, reset_db, vacuum, dispose_engines, default_sample_rate, db_name, bake_sqlite, read_bake_info, experiment_subset, stream, fetch_array
 
 # Import table definitions from DB modules
 from .pipeline import *
@@ -10,6 +12,10 @@ from .pulse_response_strength import *
 from .dynamics import *
 from .connection_strength import *
 from .first_pulse_fit import *
+from .pair_summary import *
+
+from . import query_cache
+from . import query_monitor
 
 
 @default_session
@@ -28,9 +34,10 @@ def experiment_from_timestamp(ts, session=None):
     expts = session.query(Experiment).filter(Experiment.acq_timestamp==ts).all()
     if len(expts) == 0:
         # For backward compatibility, check for timestamp truncated to 2 decimal places
-        for expt in session.query(Experiment).all():
-            if abs((expt.acq_timestamp - ts)) < 0.01:
-                return expt
+        q = session.query(Experiment).filter(Experiment.acq_timestamp > ts-0.01).filter(Experiment.acq_timestamp < ts+0.01)
+        expts = sorted(q.all(), key=lambda e: abs(e.acq_timestamp - ts))
+        if len(expts) > 0:
+            return expts[0]
         
         raise KeyError("No experiment found for timestamp %0.3f" % ts)
     elif len(expts) > 1:
@@ -39,6 +46,102 @@ def experiment_from_timestamp(ts, session=None):
     return expts[0]
 
 
+class ExperimentSet(OrderedDict):
+    """Ordered dict of {acq_timestamp: experiment} returned by load_experiments.
+
+    Experiments may also be looked up by timestamps truncated to 2 decimal places.
+    *session* is the session that the experiments were loaded with.
+    """
+    def __init__(self, expts, session=None):
+        OrderedDict.__init__(self, [(expt.acq_timestamp, expt) for expt in expts])
+        self.session = session
+        self._rounded = {}
+        for ts, expt in self.items():
+            self._rounded.setdefault(self._round(ts), []).append(expt)
+
+    @staticmethod
+    def _round(ts):
+        return int(ts * 100)
+
+    def __getitem__(self, ts):
+        try:
+            return OrderedDict.__getitem__(self, ts)
+        except KeyError:
+            candidates = []
+            for key in (self._round(ts)-1, self._round(ts), self._round(ts)+1):
+                candidates.extend(self._rounded.get(key, []))
+            candidates = [e for e in candidates if abs(e.acq_timestamp - ts) < 0.01]
+            if len(candidates) == 0:
+                raise KeyError("No experiment found for timestamp %0.3f" % ts)
+            return min(candidates, key=lambda e: abs(e.acq_timestamp - ts))
+
+
+def load_experiments(timestamps=None, pulse_responses=False, recordings=False, session=None):
+    """Load experiments along with their slices, electrodes, cells, pairs, and (optionally) recordings
+    and pulse responses using a small, fixed number of batched queries.
+
+    Dictionary indexes of cells, pairs, and devices are built for each experiment, so that 
+    lookups like ``expt[pre_id, post_id]`` and analysis loops over the loaded objects do not
+    issue any further queries.
+
+    Parameters
+    ----------
+    timestamps : list | None
+        Experiment acq_timestamps to load (or None to load all experiments)
+    pulse_responses : bool
+        If True, also load all pulse responses for each pair, along with their stim pulses,
+        stim spikes, recordings, and patch clamp recording / multipatch probe records. 
+        Array data remains deferred.
+    recordings : bool
+        If True, also load all sync recs and recordings (with patch clamp recording and 
+        multipatch probe records) for each experiment.
+    session : Session | None
+        Session to load with. By default, a new read-only session is created and kept
+        open by the returned ExperimentSet (the default session is not used because it is
+        rolled back after each call, which would expire all loaded objects).
+
+    Returns an ExperimentSet.
+    """
+    new_session = session is None
+    if new_session:
+        session = Session()
+        # release the connection after loading without expiring the loaded objects
+        session.expire_on_commit = False
+    q = session.query(Experiment)
+    if timestamps is not None:
+        q = q.filter(Experiment.acq_timestamp.in_(list(timestamps)))
+    q = q.order_by(Experiment.acq_timestamp)
+
+    def rec_opts(load):
+        return load.selectinload(Recording.patch_clamp_recording).selectinload(PatchClampRecording.multi_patch_probe)
+
+    options = [
+        joinedload(Experiment.slice),
+        selectinload(Experiment.electrodes).joinedload(Electrode.cell),
+        selectinload(Experiment.cell_list),
+        selectinload(Experiment.pair_list),
+    ]
+    if recordings:
+        recs = selectinload(Experiment.sync_recs).selectinload(SyncRec.recordings)
+        options.extend([rec_opts(recs), recs.joinedload(Recording.electrode)])
+    if pulse_responses:
+        prs = selectinload(Experiment.pair_list).selectinload(Pair.pulse_responses)
+        options.extend([
+            prs.joinedload(PulseResponse.stim_pulse).selectinload(StimPulse.spikes),
+            rec_opts(prs.joinedload(PulseResponse.stim_pulse).joinedload(StimPulse.recording)),
+            rec_opts(prs.joinedload(PulseResponse.recording)),
+        ])
+    expts = q.options(*options).all()
+
+    # Pair.pre_cell and post_cell are simple many-to-one relationships; since all cells
+    # are already in the session's identity map, these resolve without queries.
+    for expt in expts:
+        expt.build_index()
+    if new_session:
+        session.commit()
+    return ExperimentSet(expts, session=session)
+
+
 @default_session
 def list_experiments(session=None):
     return session.query(Experiment).all()
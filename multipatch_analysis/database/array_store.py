@@ -0,0 +1,274 @@
+"""
+Optional external storage for NDArray column payloads.
+
+When config.array_store_path is set, arrays written to the tables listed in
+config.array_store_tables (on a postgres database) are appended to chunk files on
+disk rather than stored inline. The database only keeps a short reference
+string giving the chunk file, byte offset and length of each payload.
+
+Chunk files are grouped by the pipeline job that generated them::
+
+    <array_store_path>/<table>/<module>/<job_id>/<pid>_<n>.bin
+
+so that all payloads for a job can be removed at once when the job is dropped
+(see DatabasePipelineModule.drop_jobs). Chunk files are append-only; payloads
+are never modified in place.
+"""
+from __future__ import division, print_function
+
+import os, io, ast, struct, shutil, threading
+from collections import OrderedDict
+import numpy as np
+
+from .. import config
+
+
+# prefix used to distinguish references from inline arrays (which begin with b'\x93NUMPY')
+REF_MAGIC = b'\x00MPAREF\x00'
+
+
+class ArrayStore(object):
+    """Append-only storage of array payloads in chunked local files.
+    """
+    def __init__(self, path, chunk_size=256*1024**2):
+        self.path = os.path.abspath(path)
+        self.chunk_size = chunk_size
+        self.lock = threading.Lock()
+        self._writers = {}
+        self._readers = OrderedDict()
+        self.current_job = None
+
+    def set_job(self, module_name, job_id):
+        """Set the pipeline job that new payloads belong to.
+
+        Payloads written with no current job are stored under "_nojob" and are only
+        removed by drop_module.
+        """
+        self.close_writers()
+        self.current_job = None if module_name is None else (module_name, job_id)
+
+    def job_path(self, table, module_name, job_id):
+        return os.path.join(self.path, table, module_name, '%0.3f' % job_id)
+
+    def write(self, table, data):
+        """Append a payload (bytes) to the store and return a reference to it.
+        """
+        with self.lock:
+            if self.current_job is None:
+                job_dir = os.path.join(table, '_nojob', '_nojob')
+            else:
+                job_dir = os.path.relpath(self.job_path(table, *self.current_job), self.path)
+
+            fh, rel_file = self._writers.get(table, (None, None))
+            if fh is None or fh.tell() + len(data) > self.chunk_size:
+                if fh is not None:
+                    fh.close()
+                fh, rel_file = self._new_chunk(job_dir)
+                self._writers[table] = (fh, rel_file)
+
+            offset = fh.tell()
+            fh.write(data)
+            # payload must be visible to other processes by the time the db transaction commits
+            fh.flush()
+
+        ref = '%s:%d:%d' % (rel_file.replace(os.sep, '/'), offset, len(data))
+        return REF_MAGIC + ref.encode('utf8')
+
+    def _new_chunk(self, job_dir):
+        full_dir = os.path.join(self.path, job_dir)
+        if not os.path.isdir(full_dir):
+            os.makedirs(full_dir)
+        i = 0
+        while True:
+            rel_file = os.path.join(job_dir, '%d_%d.bin' % (os.getpid(), i))
+            if not os.path.exists(os.path.join(self.path, rel_file)):
+                break
+            i += 1
+        return open(os.path.join(self.path, rel_file), 'ab'), rel_file
+
+    def close_writers(self):
+        with self.lock:
+            for fh, _ in self._writers.values():
+                fh.close()
+            self._writers = {}
+
+    def _reader(self, rel_file):
+        fh = self._readers.pop(rel_file, None)
+        if fh is None:
+            fh = open(os.path.join(self.path, rel_file), 'rb')
+            if len(self._readers) > 32:
+                self._readers.popitem(last=False)[1].close()
+        self._readers[rel_file] = fh
+        return fh
+
+    def read(self, ref):
+        """Return the array for a single reference.
+        """
+        return self.read_many([ref])[0]
+
+    def read_many(self, refs, max_gap=64*1024):
+        """Return a list of arrays for a list of references.
+
+        Reads are grouped by chunk file and sorted by offset; payloads separated by
+        less than *max_gap* bytes are fetched together in a single sequential read.
+        """
+        by_file = OrderedDict()
+        for i,ref in enumerate(refs):
+            rel_file, offset, size = parse_ref(ref)
+            by_file.setdefault(rel_file, []).append((offset, size, i))
+
+        results = [None] * len(refs)
+        with self.lock:
+            for rel_file, items in by_file.items():
+                fh = self._reader(rel_file)
+                items.sort()
+                j = 0
+                while j < len(items):
+                    # extend this read over following payloads that are close by
+                    start = items[j][0]
+                    stop = items[j][0] + items[j][1]
+                    k = j + 1
+                    while k < len(items) and items[k][0] - stop < max_gap:
+                        stop = max(stop, items[k][0] + items[k][1])
+                        k += 1
+                    fh.seek(start)
+                    buf = fh.read(stop - start)
+                    for offset, size, i in items[j:k]:
+                        results[i] = load_npy(buf[offset-start:offset-start+size])
+                    j = k
+        return results
+
+    def drop_jobs(self, tables, module_name, job_ids):
+        """Remove all payloads written by *module_name* for the given jobs.
+        """
+        self.close_writers()
+        for table in tables:
+            for job_id in job_ids:
+                path = self.job_path(table, module_name, job_id)
+                if os.path.isdir(path):
+                    shutil.rmtree(path)
+
+    def drop_module(self, tables, module_name):
+        """Remove all payloads written by *module_name*, and any payloads not associated with a job.
+        """
+        self.close_writers()
+        for table in tables:
+            for name in (module_name, '_nojob'):
+                path = os.path.join(self.path, table, name)
+                if os.path.isdir(path):
+                    shutil.rmtree(path)
+
+
+NPY_MAGIC = b'\x93NUMPY'
+
+# {npy header: (dtype, shape)}; arrays written by one table/column usually share a few headers
+_npy_headers = {}
+
+def load_npy(buf):
+    """Decode an array serialized by np.save from a bytes-like object.
+
+    Equivalent to ``np.load(io.BytesIO(buf))`` but parsed headers are cached, so decoding
+    many small arrays of the same shape and dtype (pulse response snippets, averages)
+    skips the per-array header evaluation. Unusual payloads (fortran order, structured
+    or object dtypes) fall back to np.load.
+    """
+    buf = bytes(buf)
+    if buf[:6] != NPY_MAGIC:
+        return np.load(io.BytesIO(buf), allow_pickle=False)
+    if buf[6:7] == b'\x01':
+        hlen, = struct.unpack('<H', buf[8:10])
+        start = 10
+    else:
+        hlen, = struct.unpack('<I', buf[8:12])
+        start = 12
+    header = buf[start:start+hlen]
+    cached = _npy_headers.get(header)
+    if cached is None:
+        info = ast.literal_eval(header.decode('latin1'))
+        if info['fortran_order'] or not isinstance(info['descr'], str):
+            return np.load(io.BytesIO(buf), allow_pickle=False)
+        cached = (np.dtype(info['descr']), tuple(info['shape']))
+        if len(_npy_headers) > 10000:
+            _npy_headers.clear()
+        _npy_headers[header] = cached
+    dtype, shape = cached
+    count = int(np.prod(shape))
+    # copy so that the result is writable, like np.load
+    return np.frombuffer(buf, dtype=dtype, count=count, offset=start+hlen).reshape(shape).copy()
+
+
+def is_ref(value):
+    return value[:len(REF_MAGIC)] == REF_MAGIC
+
+
+def parse_ref(ref):
+    """Return (chunk file, offset, size) for an array store reference.
+    """
+    rel_file, offset, size = bytes(ref[len(REF_MAGIC):]).decode('utf8').rsplit(':', 2)
+    return rel_file.replace('/', os.sep), int(offset), int(size)
+
+
+_store = None
+def get_array_store():
+    """Return the ArrayStore configured by config.array_store_path, or None if
+    external array storage is disabled.
+    """
+    global _store
+    if config.array_store_path is None:
+        return None
+    if _store is None or _store.path != os.path.abspath(config.array_store_path):
+        _store = ArrayStore(config.array_store_path)
+    return _store
+
+
+def store_for_table(table_name, dialect):
+    """Return the ArrayStore that should be used for writing arrays into *table_name*, or None
+    if arrays should be stored inline.
+
+    External storage is only used for postgres; sqlite files (including baked copies) always
+    keep their arrays inline so they remain self-contained.
+    """
+    if table_name not in config.array_store_tables or dialect.name != 'postgresql':
+        return None
+    return get_array_store()
+
+
+def read_ref(ref):
+    store = get_array_store()
+    if store is None:
+        raise RuntimeError("Database contains external array references, but config.array_store_path is not set.")
+    return store.read(ref)
+
+
+def load_arrays(session, column, ids):
+    """Load arrays from an NDArray *column* (for example db.PulseResponse.data) for many rows at once.
+
+    Rows whose payloads live in the external array store are fetched with a few large
+    sequential reads rather than one read per row. Returns a dict {id: array}.
+    """
+    import sqlalchemy
+    table = column.class_
+    raw = sqlalchemy.type_coerce(column, sqlalchemy.LargeBinary)
+    ids = list(ids)
+    recs = []
+    for i in range(0, len(ids), 1000):
+        recs.extend(session.query(table.id, raw).filter(table.id.in_(ids[i:i+1000])).all())
+
+    result = {}
+    refs = []
+    for rec_id, value in recs:
+        if value is None or len(value) == 0:
+            result[rec_id] = None
+        elif is_ref(value):
+            refs.append((rec_id, value))
+        else:
+            result[rec_id] = load_npy(value)
+
+    if len(refs) > 0:
+        store = get_array_store()
+        if store is None:
+            raise RuntimeError("Database contains external array references, but config.array_store_path is not set.")
+        arrays = store.read_many([ref for _, ref in refs])
+        for (rec_id, _), arr in zip(refs, arrays):
+            result[rec_id] = arr
+    return result
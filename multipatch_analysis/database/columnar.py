@@ -0,0 +1,315 @@
+"""
+Export analysis tables to a columnar file layout that can be loaded without a database server.
+
+Each exported table is written to its own directory::
+
+    <path>/<table>/table.json            column names / kinds, row count, db version
+    <path>/<table>/<column>.npy          scalar columns, one numpy array per column
+    <path>/<table>/<column>.null.npy     boolean null mask (only for scalar columns containing nulls)
+    <path>/<table>/<column>.json         object (json) columns
+    <path>/<table>/<column>.bin          array columns; all arrays concatenated into one contiguous file
+    <path>/<table>/<column>.index.npy    offset / dtype / shape of each array in the .bin file
+
+Scalar columns are read with np.load, and array columns are memory-mapped so that
+individual traces are only paged in from disk when they are accessed.
+
+Example::
+
+    from multipatch_analysis.database import columnar
+    columnar.export_columnar('/path/to/synphys_columnar')
+
+    cdb = columnar.ColumnarDB('/path/to/synphys_columnar')
+    pairs = cdb.table('pair')
+    avg = cdb.arrays('avg_first_pulse_fit', 'ic_avg_psp_data')
+    trace = avg[avg.ids[0]]
+"""
+from __future__ import division, print_function
+
+import os, sys, json, shutil
+from datetime import datetime
+import numpy as np
+import sqlalchemy
+from sqlalchemy.sql.expression import func
+from sqlalchemy import Integer, Boolean, Float, Date, DateTime
+
+from .database import ORMBase, Session, NDArray, JSONObject, db_version, stream
+
+
+default_tables = ['slice', 'experiment', 'cell', 'pair', 'connection_strength', 'pulse_response_strength', 'dynamics', 'avg_first_pulse_fit', 'pair_summary']
+
+
+def export_columnar(path, tables=None, session=None, chunksize=1000):
+    """Export tables from the database to a directory of columnar files.
+
+    Parameters
+    ----------
+    path : str
+        Directory to write into. Existing table directories are replaced.
+    tables : list | None
+        Names of tables to export (default is `default_tables`).
+    session : Session | None
+        Database session to read from.
+    chunksize : int
+        Number of rows to read per query.
+    """
+    if tables is None:
+        tables = default_tables
+    if session is None:
+        session = Session()
+    if not os.path.exists(path):
+        os.makedirs(path)
+
+    for table_name in tables:
+        print("Exporting %s.." % table_name)
+        table = ORMBase.metadata.tables[table_name]
+        tmp_path = os.path.join(path, table_name + '.tmp')
+        if os.path.exists(tmp_path):
+            shutil.rmtree(tmp_path)
+        os.makedirs(tmp_path)
+
+        writers = [_column_writer(tmp_path, col) for col in table.c]
+        n_total = session.execute(sqlalchemy.select([func.count(table.c.id)])).scalar()
+        n_rows = 0
+        query = sqlalchemy.select(list(table.c)).order_by(table.c.id)
+        for batch in stream(query, batch_size=chunksize, session=session, as_array=False):
+            for rec in batch:
+                for writer, val in zip(writers, rec):
+                    writer.append(val)
+            n_rows += len(batch)
+            print("   %d/%d   %0.2f%%\r" % (n_rows, n_total, 100.0 * n_rows / max(n_total, 1)), end="")
+            sys.stdout.flush()
+        session.rollback()
+
+        meta = {
+            'table': table_name,
+            'db_version': db_version,
+            'export_time': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            'n_rows': n_rows,
+            'columns': [writer.close() for writer in writers],
+        }
+        with open(os.path.join(tmp_path, 'table.json'), 'w') as fh:
+            json.dump(meta, fh, indent=2)
+
+        # replace any previous export only after this one is complete
+        table_path = os.path.join(path, table_name)
+        if os.path.exists(table_path):
+            shutil.rmtree(table_path)
+        os.rename(tmp_path, table_path)
+        print("   wrote %d rows                      " % n_rows)
+
+
+def _column_writer(path, col):
+    if isinstance(col.type, NDArray):
+        return ArrayColumnWriter(path, col.name)
+    elif isinstance(col.type, JSONObject):
+        return ObjectColumnWriter(path, col.name)
+    else:
+        # use the underlying sql type for decorated types like FloatType
+        return ScalarColumnWriter(path, col.name, getattr(col.type, 'impl', col.type))
+
+
+class ScalarColumnWriter(object):
+    """Accumulates scalar values for one column and writes them as a single .npy file.
+    """
+    def __init__(self, path, name, sql_type):
+        self.path = path
+        self.name = name
+        self.sql_type = sql_type
+        self.values = []
+
+    def append(self, val):
+        self.values.append(val)
+
+    def close(self):
+        nulls = np.array([v is None for v in self.values], dtype=bool)
+        if isinstance(self.sql_type, Boolean):
+            dtype, fill = bool, False
+        elif isinstance(self.sql_type, Integer):
+            dtype, fill = 'int64', 0
+        elif isinstance(self.sql_type, Float):
+            dtype, fill = 'float64', np.nan
+        elif isinstance(self.sql_type, DateTime):
+            dtype, fill = 'datetime64[us]', np.datetime64('NaT')
+        elif isinstance(self.sql_type, Date):
+            dtype, fill = 'datetime64[D]', np.datetime64('NaT')
+        else:
+            dtype, fill = 'U', u''
+        values = [fill if v is None else v for v in self.values]
+        if len(values) == 0:
+            arr = np.zeros(0, dtype=dtype)
+        else:
+            arr = np.array(values, dtype=dtype)
+        np.save(os.path.join(self.path, self.name + '.npy'), arr, allow_pickle=False)
+        if nulls.any():
+            np.save(os.path.join(self.path, self.name + '.null.npy'), nulls, allow_pickle=False)
+        self.values = None
+        return {'name': self.name, 'kind': 'scalar', 'dtype': arr.dtype.str, 'nullable': bool(nulls.any())}
+
+
+class ObjectColumnWriter(object):
+    """Accumulates json-compatible values for one column and writes them to a .json file.
+    """
+    def __init__(self, path, name):
+        self.path = path
+        self.name = name
+        self.values = []
+
+    def append(self, val):
+        self.values.append(val)
+
+    def close(self):
+        with open(os.path.join(self.path, self.name + '.json'), 'w') as fh:
+            json.dump(self.values, fh)
+        self.values = None
+        return {'name': self.name, 'kind': 'object'}
+
+
+class ArrayColumnWriter(object):
+    """Streams arrays from one column into a contiguous binary file with an offset index.
+    """
+    max_ndim = 4
+
+    def __init__(self, path, name):
+        self.path = path
+        self.name = name
+        self.fh = open(os.path.join(path, name + '.bin'), 'wb')
+        self.offset = 0
+        self.index = []
+
+    def append(self, arr):
+        shape = [0] * self.max_ndim
+        if arr is None:
+            self.index.append((self.offset, -1, b'', 0, shape))
+            return
+        arr = np.ascontiguousarray(arr)
+        if arr.ndim > self.max_ndim or arr.dtype.hasobject:
+            raise TypeError("Cannot export array with shape %r and dtype %s" % (arr.shape, arr.dtype))
+        shape[:arr.ndim] = arr.shape
+        # keep each array aligned so that views can be made without copying
+        pad = (-self.offset) % 16
+        if pad > 0:
+            self.fh.write(b'\0' * pad)
+            self.offset += pad
+        self.fh.write(arr.tobytes())
+        self.index.append((self.offset, arr.nbytes, arr.dtype.str.encode('ascii'), arr.ndim, shape))
+        self.offset += arr.nbytes
+
+    def close(self):
+        self.fh.close()
+        index_dtype = [('offset', 'int64'), ('nbytes', 'int64'), ('dtype', 'S8'), ('ndim', 'int8'), ('shape', 'int64', (self.max_ndim,))]
+        index = np.array(self.index, dtype=index_dtype)
+        np.save(os.path.join(self.path, self.name + '.index.npy'), index, allow_pickle=False)
+        self.index = None
+        return {'name': self.name, 'kind': 'array'}
+
+
+class ColumnarDB(object):
+    """Read-only access to tables written by `export_columnar`.
+
+    Tables are returned as pandas DataFrames (array columns excluded), and array
+    columns are returned as `ArrayColumn` instances that give memory-mapped views of
+    each stored array.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._meta = {}
+        self._arrays = {}
+
+    def list_tables(self):
+        return sorted([d for d in os.listdir(self.path) if os.path.isfile(os.path.join(self.path, d, 'table.json'))])
+
+    def table_meta(self, table):
+        if table not in self._meta:
+            with open(os.path.join(self.path, table, 'table.json'), 'r') as fh:
+                self._meta[table] = json.load(fh)
+        return self._meta[table]
+
+    def columns(self, table, kind=None):
+        """Return the names of columns in a table, optionally only those of a particular *kind*
+        ('scalar', 'object', or 'array').
+        """
+        return [c['name'] for c in self.table_meta(table)['columns'] if kind is None or c['kind'] == kind]
+
+    def column(self, table, column):
+        """Return values from a scalar or object column as a numpy array.
+
+        Null values are returned as NaN for numerical columns, NaT for dates, and None otherwise.
+        """
+        col_meta = [c for c in self.table_meta(table)['columns'] if c['name'] == column][0]
+        base = os.path.join(self.path, table, column)
+        if col_meta['kind'] == 'object':
+            with open(base + '.json', 'r') as fh:
+                vals = json.load(fh)
+            arr = np.empty(len(vals), dtype=object)
+            arr[:] = vals
+            return arr
+        elif col_meta['kind'] == 'array':
+            raise TypeError("Column %s.%s contains arrays; use arrays() instead." % (table, column))
+
+        arr = np.load(base + '.npy', allow_pickle=False)
+        if col_meta['nullable']:
+            nulls = np.load(base + '.null.npy', allow_pickle=False)
+            if arr.dtype.kind in 'iu':
+                arr = arr.astype(float)
+                arr[nulls] = np.nan
+            elif arr.dtype.kind in 'bUS':
+                arr = arr.astype(object)
+                arr[nulls] = None
+        return arr
+
+    def table(self, table, columns=None):
+        """Return a DataFrame containing the scalar and object columns of a table, indexed by id.
+        """
+        import pandas
+        if columns is None:
+            columns = [c for c in self.columns(table) if c not in self.columns(table, kind='array')]
+        data = {'id': self.column(table, 'id')}
+        for col in columns:
+            data[col] = self.column(table, col)
+        df = pandas.DataFrame(data, columns=['id'] + [c for c in columns if c != 'id'])
+        return df.set_index('id', drop=False)
+
+    def arrays(self, table, column):
+        """Return an `ArrayColumn` giving access to the arrays stored in a column.
+        """
+        key = (table, column)
+        if key not in self._arrays:
+            if column not in self.columns(table, kind='array'):
+                raise KeyError("No array column named %s.%s" % (table, column))
+            self._arrays[key] = ArrayColumn(os.path.join(self.path, table, column), self.column(table, 'id'))
+        return self._arrays[key]
+
+
+class ArrayColumn(object):
+    """Memory-mapped access to a single exported array column.
+
+    Index by row id to get a read-only view of the stored array (or None if the
+    value was null).
+    """
+    def __init__(self, base_path, ids):
+        self.ids = ids
+        self.index = np.load(base_path + '.index.npy', allow_pickle=False)
+        self._row = {rid:i for i,rid in enumerate(ids)}
+        if os.path.getsize(base_path + '.bin') > 0:
+            self.data = np.memmap(base_path + '.bin', dtype='uint8', mode='r')
+        else:
+            self.data = np.zeros(0, dtype='uint8')
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, row_id):
+        return self.get_row(self._row[row_id])
+
+    def get_row(self, i):
+        """Return the array at row *i* (not row id).
+        """
+        offset, nbytes, dtype, ndim, shape = self.index[i]
+        if nbytes < 0:
+            return None
+        dtype = np.dtype(dtype.decode('ascii'))
+        return self.data[offset:offset+nbytes].view(dtype).reshape(tuple(shape[:ndim]))
+
+    def __iter__(self):
+        for i in range(len(self.ids)):
+            yield self.get_row(i)
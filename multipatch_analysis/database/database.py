@@ -6,8 +6,8 @@ The actual schemas for database tables are implemented in other files in this su
 from __future__ import division, print_function
 
 import os, sys, io, time, json, threading, gc
-from datetime import datetime
-from collections import OrderedDict
+from datetime import datetime, timedelta
+from collections import OrderedDict, namedtuple
 import numpy as np
 try:
     import queue
@@ -19,7 +19,7 @@ from distutils.version import LooseVersion
 if LooseVersion(sqlalchemy.__version__) < '1.2':
     raise Exception('requires at least sqlalchemy 1.2')
 
-from sqlalchemy import create_engine, Column, Integer, String, Boolean, Float, Date, DateTime, LargeBinary, ForeignKey, or_, and_
+from sqlalchemy import create_engine, Column, Integer, String, Boolean, Float, Date, DateTime, LargeBinary, ForeignKey, ForeignKeyConstraint, UniqueConstraint, DDL, event, or_, and_
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.orm import relationship, deferred, sessionmaker, aliased, reconstructor
@@ -27,9 +27,10 @@ from sqlalchemy.types import TypeDecorator
 from sqlalchemy.sql.expression import func
 
 from .. import config
+from . import array_store
 
 # database version should be incremented whenever the schema has changed
-db_version = 12
+db_version = 16
 db_name = '{database}_{version}'.format(database=config.synphys_db, version=db_version)
 app_name = ('mp_a:' + ' '.join(sys.argv))[:60]
 
@@ -60,6 +61,29 @@ class TableGroup(object):
     def __getitem__(self, item):
         return self.tables[item]
 
+    def partition_keys(self):
+        """Return {table_name: column_name} for all tables in this group that declare a partition key
+        (see make_table).
+        """
+        return OrderedDict([(k, partition_keys[k]) for k in self.tables if k in partition_keys])
+
+    def delete_partitions(self, session, values):
+        """Delete all rows whose partition key is in *values* from every table in this group that
+        declares a partition key, using one bulk delete per table.
+
+        When partitioning is enabled, each delete only touches the partitions that hold *values*.
+        Tables are processed in reverse order so that dependent rows are removed first.
+        Returns the total number of rows deleted.
+        """
+        values = list(values)
+        n = 0
+        if len(values) == 0:
+            return n
+        for name, key in reversed(list(self.partition_keys().items())):
+            table = self.tables[name].__table__
+            n += session.execute(table.delete().where(table.c[key].in_(values))).rowcount
+        return n
+
     def drop_tables(self):
         global engine_rw
         drops = []
@@ -68,7 +92,13 @@ class TableGroup(object):
                 drops.append(k)
         if len(drops) == 0:
             return
-        engine_rw.execute('drop table %s cascade' % (','.join(drops)))
+        if engine_rw.dialect.name == 'sqlite':
+            # no "drop ... cascade" in sqlite (and foreign keys are not enforced); drop dependent tables first
+            with engine_rw.begin() as conn:
+                for k in reversed(drops):
+                    conn.execute('drop table %s' % k)
+        else:
+            engine_rw.execute('drop table %s cascade' % (','.join(drops)))
 
     def create_tables(self):
         global engine_rw, engine_ro
@@ -87,21 +117,33 @@ class TableGroup(object):
 
 class NDArray(TypeDecorator):
     """For marshalling arrays in/out of binary DB fields.
+
+    If *table_name* is one of config.array_store_tables, then array payloads may be
+    kept in an external ArrayStore with only a reference stored in the database
+    (see array_store.py).
     """
     impl = LargeBinary
+
+    def __init__(self, table_name=None, *args, **kwds):
+        TypeDecorator.__init__(self, *args, **kwds)
+        self.table_name = table_name
     
     def process_bind_param(self, value, dialect):
         if value is None:
             return b'' 
         buf = io.BytesIO()
         np.save(buf, value, allow_pickle=False)
+        store = array_store.store_for_table(self.table_name, dialect)
+        if store is not None:
+            return store.write(self.table_name, buf.getvalue())
         return buf.getvalue()
         
     def process_result_value(self, value, dialect):
         if value == b'':
             return None
-        buf = io.BytesIO(value)
-        return np.load(buf, allow_pickle=False)
+        if array_store.is_ref(value):
+            return array_store.read_ref(value)
+        return array_store.load_npy(value)
 
 
 class JSONObject(TypeDecorator):
@@ -146,7 +188,20 @@ column_data_types = {
 
 ORMBase = declarative_base()
 
-def make_table(name, columns, base=None, **table_args):
+# {table_name: column_name} for all tables declared with a partition key
+partition_keys = {}
+
+def partitioning_enabled():
+    """Return True if tables declared with a partition key are hash-partitioned in the database.
+
+    Partitioning requires postgres (11 or later) and is enabled by setting config.table_partitions
+    to the number of partitions per table.
+    """
+    addr = db_address_rw or db_address_ro
+    return config.table_partitions > 0 and addr.startswith('postgres')
+
+
+def make_table(name, columns, base=None, partition_by=None, **table_args):
     """Generate an ORM mapping class from a simplified schema format.
 
     Columns named 'id' (int) and 'meta' (object) are added automatically.
@@ -157,6 +212,13 @@ def make_table(name, columns, base=None, **table_args):
         Name of the table, used to set __tablename__ in the new class
     base : class or None
         Base class on which to build the new table class
+    partition_by : str or None
+        Name of a foreign key column (usually experiment_id) that groups rows which are always
+        created and dropped together. TableGroup.delete_partitions uses this key for bulk
+        deletes, and if partitioning is enabled (see partitioning_enabled) the table is
+        hash-partitioned on this column. In that case the primary key of the table becomes
+        (id, partition_by) and foreign keys that reference another partitioned table
+        include the partition column as well (the ORM mapping still uses id alone).
     table_args : keyword arguments
         Extra keyword arguments are used to set __table_args__ in the new class
     columns : list of tuple
@@ -169,23 +231,52 @@ def make_table(name, columns, base=None, **table_args):
     """
     props = {
         '__tablename__': name,
-        '__table_args__': table_args,
         'id': Column(Integer, primary_key=True),
     }
+    constraints = []
+
+    partitioned = False
+    if partition_by is not None:
+        partition_keys[name] = partition_by
+        partitioned = partitioning_enabled()
+    if partitioned:
+        # postgres requires the partition key to be part of the primary key and all unique constraints
+        props['id'] = Column(Integer, primary_key=True, autoincrement=True)
+        props['__mapper_args__'] = {'primary_key': [props['id']]}
+        table_args['postgresql_partition_by'] = 'HASH (%s)' % partition_by
 
     for column in columns:
         colname, coltype = column[:2]
-        kwds = {} if len(column) < 4 else column[3]
+        kwds = {} if len(column) < 4 else dict(column[3])
         kwds['comment'] = None if len(column) < 3 else column[2]
         defer_col = kwds.pop('deferred', False)
         ondelete = kwds.pop('ondelete', None)
+        if partitioned:
+            if colname == partition_by:
+                kwds['primary_key'] = True
+                kwds['autoincrement'] = False
+            elif kwds.get('unique', False):
+                kwds['unique'] = False
+                constraints.append(UniqueConstraint(colname, partition_by))
 
         if coltype not in column_data_types:
             if not coltype.endswith('.id'):
                 raise ValueError("Unrecognized column type %s" % coltype)
-            props[colname] = Column(Integer, ForeignKey(coltype, ondelete=ondelete), **kwds)
+            ref_table = coltype[:-3]
+            if partitioned and ref_table != name and partition_keys.get(ref_table) == partition_by and colname != partition_by:
+                # a partitioned table can only be referenced by its full primary key
+                props[colname] = Column(Integer, **kwds)
+                constraints.append(ForeignKeyConstraint(
+                    [colname, partition_by], 
+                    [coltype, '%s.%s' % (ref_table, partition_by)],
+                    ondelete=ondelete,
+                ))
+            else:
+                props[colname] = Column(Integer, ForeignKey(coltype, ondelete=ondelete), **kwds)
         else:
             ctyp = column_data_types[coltype]
+            if ctyp is NDArray:
+                ctyp = NDArray(table_name=name)
             props[colname] = Column(ctyp, **kwds)
 
         if defer_col:
@@ -194,9 +285,10 @@ def make_table(name, columns, base=None, **table_args):
     # props['time_created'] = Column(DateTime, default=func.now())
     # props['time_modified'] = Column(DateTime, onupdate=func.current_timestamp())
     props['meta'] = Column(column_data_types['object'])
+    props['__table_args__'] = tuple(constraints) + (table_args,)
 
     if base is None:
-        return type(name, (ORMBase,), props)
+        table = type(name, (ORMBase,), props)
     else:
         # need to jump through a hoop to allow __init__ on table classes;
         # see: https://docs.sqlalchemy.org/en/latest/orm/constructors.html
@@ -205,7 +297,14 @@ def make_table(name, columns, base=None, **table_args):
             def _init_on_load(self, *args, **kwds):
                 base._init_on_load(self)
             props['_init_on_load'] = _init_on_load
-        return type(name, (base,ORMBase), props)
+        table = type(name, (base,ORMBase), props)
+
+    if partitioned:
+        for i in range(config.table_partitions):
+            ddl = DDL("CREATE TABLE %(table)s_p{i} PARTITION OF %(table)s FOR VALUES WITH (MODULUS {n}, REMAINDER {i})".format(i=i, n=config.table_partitions))
+            event.listen(table.__table__, 'after_create', ddl.execute_if(dialect='postgresql'))
+
+    return table
 
 
 
@@ -228,12 +327,104 @@ def init_engines():
         opts_ro = {}
         opts_rw = {}
     
-    engine_ro = create_engine(db_address_ro, **opts_ro)
-    if db_address_rw is not None:
+    if db_address_ro.startswith('sqlite'):
+        # a file that is also opened for writing may be in WAL mode, which read-only opens do not always support
+        engine_ro = sqlite_engine(db_address_ro, readonly=True, open_readonly=db_address_rw is None)
+    else:
+        engine_ro = create_engine(db_address_ro, **opts_ro)
+    if db_address_rw is None:
+        pass
+    elif db_address_rw.startswith('sqlite'):
+        engine_rw = sqlite_engine(db_address_rw, readonly=False)
+    else:
         engine_rw = create_engine(db_address_rw, **opts_rw)
     engine_pid = os.getpid()
 
 
+def sqlite_backend():
+    """Return True if results are written to a local sqlite file rather than a postgres server.
+
+    In this case the file is used in WAL mode (see sqlite_write_pragmas): readers never block,
+    but only one connection can write at a time, so parallel pipeline workers serialize their
+    writes (see pipeline_module.serialize_writes).
+    """
+    return db_address_rw is not None and db_address_rw.startswith('sqlite')
+
+
+# pragmas applied to every read-only sqlite connection (see sqlite_engine)
+sqlite_read_pragmas = OrderedDict([
+    ('query_only', 1),
+    ('mmap_size', 8 * 1024**3),    # map the file rather than copying pages through the sqlite page cache
+    ('cache_size', -256 * 1024),   # page cache per connection, in KiB
+    ('temp_store', 'MEMORY'),      # sorts / temporary b-trees for large reads
+])
+
+
+# pragmas applied to every writable sqlite connection
+sqlite_write_pragmas = OrderedDict([
+    ('journal_mode', 'WAL'),       # readers and the (single) writer do not block each other
+    ('synchronous', 'NORMAL'),     # sync at checkpoints rather than every commit; safe with WAL
+    ('busy_timeout', 600000),      # ms to wait for the write lock held by another process
+    ('cache_size', -64 * 1024),
+    ('temp_store', 'MEMORY'),
+])
+
+
+def sqlite_engine(address, readonly=True, pool_size=5, open_readonly=True):
+    """Return an engine for an sqlite file (for example one generated by bake_sqlite).
+
+    If *readonly* is True, connections have the pragmas in sqlite_read_pragmas applied,
+    and are kept in a pool so that their page caches survive between sessions (sqlalchemy
+    otherwise opens a new connection for every session on file databases). If
+    *open_readonly* is also True, the file itself is opened in read-only mode (and
+    connecting fails if it does not exist).
+
+    Otherwise, connections use the pragmas in sqlite_write_pragmas.
+    """
+    if not readonly:
+        engine = create_engine(address)
+        _set_pragmas(engine, sqlite_write_pragmas)
+        return engine
+
+    import sqlite3
+    path = address.partition(':///')[2]
+
+    def connect():
+        if open_readonly and path not in ('', ':memory:'):
+            # mode=ro also prevents a missing file from being silently created
+            if sys.version_info[0] >= 3:
+                uri = 'file:%s?mode=ro' % _sqlite_uri_path(path)
+                return sqlite3.connect(uri, uri=True, check_same_thread=False)
+            if not os.path.isfile(path):
+                raise sqlite3.OperationalError("unable to open database file: %s" % path)
+        return sqlite3.connect(path, check_same_thread=False)
+
+    engine = create_engine('sqlite://', creator=connect, poolclass=sqlalchemy.pool.QueuePool, pool_size=pool_size, max_overflow=10)
+    _set_pragmas(engine, sqlite_read_pragmas)
+    return engine
+
+
+def _set_pragmas(engine, pragmas):
+    @event.listens_for(engine, 'connect')
+    def set_pragmas(dbapi_conn, conn_record):
+        cur = dbapi_conn.cursor()
+        for name, value in pragmas.items():
+            cur.execute('PRAGMA %s = %s' % (name, value))
+        cur.close()
+
+
+def _sqlite_uri_path(path):
+    """Quote a filesystem path for use in an sqlite URI filename.
+    """
+    path = os.path.abspath(path).replace(os.sep, '/')
+    for ch in '%?#':
+        path = path.replace(ch, '%%%02X' % ord(ch))
+    if not path.startswith('/'):
+        # windows drive letter
+        path = '/' + path
+    return path
+
+
 def dispose_engines():
     global engine_ro, engine_rw, engine_pid, _sessionmaker_ro, _sessionmaker_rw
     if engine_ro is not None:
@@ -306,6 +497,15 @@ def reset_db():
     global engine_rw
     
     dispose_engines()
+
+    if sqlite_backend():
+        path = db_address_rw.partition(':///')[2]
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+        init_engines()
+        create_tables()
+        return
     
     pg_engine = create_engine(config.synphys_db_host_rw + '/postgres')
     with pg_engine.begin() as conn:
@@ -341,14 +541,20 @@ def create_tables(tables=None, engine=None):
     # Create all tables
     global ORMBase
     if engine is None:
-        _, engine_rw = get_engines()
-    ORMBase.metadata.create_all(bind=engine_rw, tables=tables)
+        _, engine = get_engines()
+    ORMBase.metadata.create_all(bind=engine, tables=tables)
 
 def vacuum(tables=None):
     """Cleans up database and analyzes table statistics in order to improve query planning.
     Should be run after any significant changes to the database.
     """
     engine_ro, engine_rw = get_engines()
+    if engine_rw.dialect.name == 'sqlite':
+        # sqlite's VACUUM rewrites the entire file; only statistics are needed for query planning
+        with engine_rw.begin() as conn:
+            for table in (tables or [None]):
+                conn.execute('analyze' if table is None else 'analyze %s' % table)
+        return
     with engine_rw.begin() as conn:
         conn.connection.set_isolation_level(0)
         if tables is None:
@@ -388,39 +594,411 @@ def get_default_session():
     return _default_session
 
 
-def bake_sqlite(sqlite_file):
+def stream(query, batch_size=1000, session=None, as_array=True):
+    """Iterate over the results of a query in batches, without loading the entire result into memory.
+
+    Postgres queries are run with a server-side cursor, so memory use stays flat
+    regardless of the number of rows selected (if the session is bound to an autocommit
+    engine, the query is run in a transaction on a separate connection). Array (NDArray) columns are fetched as
+    raw bytes and decoded in bulk for each batch (payloads in an external array store are
+    read with a few large sequential reads rather than one read per row).
+
+    Parameters
+    ----------
+    query : Query | Select | str
+        An ORM query, core selectable, or raw SQL string. ORM entities are returned as plain columns.
+    batch_size : int
+        Maximum number of rows per batch.
+    session : Session | None
+        Session used to execute the query (by default, the session attached to an ORM query
+        or a new read-only session).
+    as_array : bool
+        If True, each batch is a numpy structured array with one field per column (nulls
+        become NaN in float and nullable integer columns). Otherwise, each batch is a list of
+        named tuples with None for nulls.
+
+    Example::
+
+        q = session.query(db.PulseResponse.id, db.PulseResponse.data)
+        for batch in db.stream(q, batch_size=5000, as_array=False):
+            for rec in batch:
+                analyze(rec.id, rec.data)
+    """
+    if session is None:
+        session = getattr(query, 'session', None) or Session()
+    stmt, columns, array_cols = _prepare_fetch(query)
+
+    conn = _stream_connection(session)
+    try:
+        if conn is None:
+            result = session.execute(stmt.execution_options(stream_results=True))
+        else:
+            trans = conn.begin()
+            result = conn.execute(stmt.execution_options(stream_results=True))
+    except Exception:
+        if conn is not None:
+            conn.close()
+        raise
+    names = _unique_names(result.keys())
+    if columns is None:
+        columns = [None] * len(names)
+    dtype = [(name, 'O' if col is None else _stream_dtype(col)) for name, col in zip(names, columns)]
+    row_type = namedtuple('StreamRow', names, rename=True)
+    try:
+        while True:
+            rows = result.fetchmany(batch_size)
+            if len(rows) == 0:
+                break
+            rows = [list(row) for row in rows]
+            for i in array_cols:
+                arrays = _decode_arrays([row[i] for row in rows])
+                for row, arr in zip(rows, arrays):
+                    row[i] = arr
+            if not as_array:
+                yield [row_type(*row) for row in rows]
+                continue
+
+            batch = np.empty(len(rows), dtype=dtype)
+            for j,(name, typ) in enumerate(dtype):
+                batch[name] = _column_array([row[j] for row in rows], typ)
+            yield batch
+    finally:
+        result.close()
+        if conn is not None:
+            trans.rollback()
+            conn.close()
+
+
+def _stream_connection(session):
+    """Return a new connection (with a non-autocommit isolation level) for stream() to run its
+    query on if *session* is bound to an autocommit engine, or None if the query can be run
+    by the session itself.
+
+    Server-side cursors (psycopg2 named cursors) can only be used inside a transaction, so they
+    are not available on autocommit connections such as those of the read-only postgres engine.
+    """
+    bind = session.get_bind()
+    level = bind.get_execution_options().get('isolation_level', getattr(bind.dialect, 'isolation_level', None))
+    if level != 'AUTOCOMMIT':
+        return None
+    level = 'READ COMMITTED' if bind.dialect.name == 'postgresql' else 'SERIALIZABLE'
+    return bind.engine.connect().execution_options(isolation_level=level)
+
+
+def fetch_array(query, session=None, params=None):
+    """Run a query and return all results as a numpy structured array with one typed field per column.
+
+    This is much faster than building a DataFrame (or ORM objects) for queries that return
+    many rows. Field types follow pandas conventions so that the result can be used in place
+    of ``pandas.read_sql_query(...).to_records()``:
+
+    * float columns are float64, with NaN for nulls
+    * integer columns are int64, or float64 if any values are null
+    * boolean columns are bool, or object if any values are null
+    * datetime columns are datetime64[ns], with NaT for nulls
+    * array (NDArray) columns are decoded in bulk into an object field
+    * all other columns are object
+
+    Parameters
+    ----------
+    query : Query | Select | str
+        An ORM query, core selectable, or raw SQL string. For raw SQL, field types are
+        inferred from the returned values.
+    session : Session | None
+        Session used to execute the query (by default, the session attached to an ORM query
+        or a new read-only session).
+    params : dict | None
+        Parameters to bind to the query.
+    """
+    if session is None:
+        session = getattr(query, 'session', None) or Session()
+    stmt, columns, array_cols = _prepare_fetch(query)
+    result = session.execute(stmt, params or {})
+    try:
+        names = _unique_names(result.keys())
+        rows = result.fetchall()
+    finally:
+        result.close()
+
+    # transpose once, then convert each column with a single numpy call
+    values = list(zip(*rows)) if len(rows) > 0 else [()] * len(names)
+    fields = []
+    for i,name in enumerate(names):
+        vals = values[i]
+        if i in array_cols:
+            vals = _decode_arrays(vals)
+        typ = _fetch_dtype(None if columns is None else columns[i], vals)
+        fields.append((name, typ, _column_array(vals, typ)))
+
+    arr = np.empty(len(rows), dtype=[(name, typ) for name, typ, _ in fields])
+    for name, typ, col in fields:
+        arr[name] = col
+    return arr
+
+
+def _prepare_fetch(query):
+    """Return (statement, columns, array_column_indices) for a query to be run by stream() or fetch_array().
+
+    Array columns are selected as raw bytes so that they can be decoded in bulk. For raw
+    SQL strings, columns is None.
+    """
+    if isinstance(query, (str, type(u''))):
+        return sqlalchemy.text(query), None, []
+    stmt = query.statement if hasattr(query, 'statement') else query
+
+    columns = list(stmt.inner_columns)
+    array_cols = []
+    new_columns = []
+    for i,col in enumerate(columns):
+        if isinstance(col.type, NDArray):
+            array_cols.append(i)
+            col = sqlalchemy.type_coerce(col, LargeBinary).label(col.name)
+        new_columns.append(col)
+    if len(array_cols) > 0:
+        stmt = stmt.with_only_columns(new_columns)
+    return stmt, columns, array_cols
+
+
+def _unique_names(keys):
+    names = []
+    for key in keys:
+        name = str(key)
+        i = 1
+        while name in names:
+            name = '%s_%d' % (key, i)
+            i += 1
+        names.append(name)
+    return names
+
+
+def _stream_dtype(col):
+    """Return the numpy dtype used by stream() for a selected column.
+    """
+    typ = getattr(col.type, 'impl', col.type)
+    nullable = getattr(getattr(col, 'element', col), 'nullable', True)
+    if isinstance(typ, Float):
+        return 'f8'
+    elif isinstance(typ, Boolean):
+        return 'O' if nullable else '?'
+    elif isinstance(typ, Integer):
+        # nullable integers are returned as float (with NaN for null)
+        return 'f8' if nullable else 'i8'
+    else:
+        return 'O'
+
+
+def _fetch_dtype(col, values):
+    """Return the numpy dtype used by fetch_array() for a column, given all of its values.
+    """
+    has_null = any(v is None for v in values)
+    if col is None:
+        # raw SQL; infer from values
+        types = set(type(v) for v in values if v is not None)
+        if len(types) == 0:
+            return 'O'
+        elif types == set([bool]):
+            kind = 'bool'
+        elif all(issubclass(t, (int, np.integer)) and t is not bool for t in types):
+            kind = 'int'
+        elif all(issubclass(t, (int, float, np.number)) and t is not bool for t in types):
+            kind = 'float'
+        elif all(issubclass(t, datetime) for t in types):
+            kind = 'datetime'
+        else:
+            return 'O'
+    else:
+        typ = getattr(col.type, 'impl', col.type)
+        if isinstance(typ, Float):
+            kind = 'float'
+        elif isinstance(typ, Boolean):
+            kind = 'bool'
+        elif isinstance(typ, Integer):
+            kind = 'int'
+        elif isinstance(typ, DateTime):
+            kind = 'datetime'
+        else:
+            return 'O'
+
+    if kind == 'bool':
+        return 'O' if has_null else '?'
+    elif kind == 'int':
+        return 'f8' if has_null else 'i8'
+    elif kind == 'float':
+        return 'f8'
+    else:
+        return 'datetime64[ns]'
+
+
+def _column_array(values, dtype):
+    """Convert a sequence of column values to a 1D array of *dtype* (None becomes NaN / NaT).
+    """
+    if dtype == 'O':
+        # assign element-wise; numpy would otherwise try to broadcast sequences of equal-length arrays
+        arr = np.empty(len(values), dtype=object)
+        for i,v in enumerate(values):
+            arr[i] = v
+        return arr
+    elif dtype == 'f8':
+        return np.array(values, dtype=float)
+    elif dtype == 'datetime64[ns]':
+        return np.array([np.datetime64('NaT') if v is None else v for v in values], dtype=dtype)
+    else:
+        return np.array(values, dtype=dtype)
+
+
+def _decode_arrays(values):
+    """Decode a list of raw NDArray column values (inline or external references).
+    """
+    arrays = [None] * len(values)
+    refs = []
+    for i,val in enumerate(values):
+        if val is None or len(val) == 0:
+            continue
+        if array_store.is_ref(val):
+            refs.append(i)
+        else:
+            arrays[i] = array_store.load_npy(val)
+    if len(refs) > 0:
+        store = array_store.get_array_store()
+        if store is None:
+            raise RuntimeError("Database contains external array references, but config.array_store_path is not set.")
+        for i, arr in zip(refs, store.read_many([values[i] for i in refs])):
+            arrays[i] = arr
+    return arrays
+
+
+def bake_sqlite(sqlite_file, incremental=False, skip_arrays=False, **filters):
     """Dump a copy of the database to an sqlite file.
+
+    If *incremental* is True and *sqlite_file* contains a previous bake, then only
+    experiments whose pipeline jobs finished (or were dropped) since that bake are
+    updated: their rows (and all dependent rows) are deleted from the sqlite file
+    and re-inserted from the current database. The time of the most recent pipeline
+    job included in the bake is stored in the sqlite file's bake_info table.
+
+    Extra keyword arguments select a subset of experiments to bake (see `experiment_subset`
+    for the accepted filters). Records are included by following foreign keys from each 
+    selected experiment, so the resulting file is referentially complete. If *skip_arrays*
+    is True, then all array columns (raw traces, averages, etc.) are left empty.
+
+    When updating incrementally, the subset filters and *skip_arrays* stored from the
+    previous bake are used; passing different filters raises an exception (a full bake
+    is required to change the subset).
     """
     from ..pipeline import all_modules
     sqlite_addr = "sqlite:///%s" % sqlite_file
     sqlite_engine = create_engine(sqlite_addr)
+
+    last_bake = read_bake_info(sqlite_engine) if incremental else {}
+    if incremental:
+        if 'watermark' not in last_bake:
+            print("No previous bake found in %s; baking all records." % sqlite_file)
+            incremental = False
+        elif last_bake.get('db_version') != str(db_version):
+            raise Exception("Cannot update sqlite file %s (schema version %s) incrementally from database version %s; a full bake is required." % (
+                sqlite_file, last_bake.get('db_version'), db_version))
+        else:
+            last_filters = json.loads(last_bake.get('filters', '{}'))
+            if len(filters) > 0 and json.loads(json.dumps(filters)) != last_filters:
+                raise Exception("Cannot update sqlite file %s incrementally with experiment filters %r; it was baked with %r. A full bake is required to change the subset." % (
+                    sqlite_file, filters, last_filters))
+            filters = last_filters
+            skip_arrays = last_bake.get('skip_arrays') == 'True'
+
     create_tables(engine=sqlite_engine)
     
     read_session = Session()
     write_session = sessionmaker(bind=sqlite_engine)()
-    last_size = 0
+
+    # Record the completion time of the most recent pipeline job _before_ reading any data;
+    # anything that finishes after this point will be picked up by the next incremental bake.
+    # (jobs still committing now may have an earlier finish_time; see bake_watermark_overlap)
+    pipeline_table = ORMBase.metadata.tables['pipeline']
+    watermark = read_session.execute(sqlalchemy.select([func.max(pipeline_table.c.finish_time)])).scalar()
+
+    tables = []
     for mod in all_modules().values():
         table_group = mod.table_group
         for table_name in table_group.tables:
-            print("Baking %s.." % table_name)
-            table = table_group[table_name]
-            
-            # read from table in background thread, write to sqlite in main thread.
-            reader = TableReadThread(table)
-            for i,rec in enumerate(reader):
-                write_session.execute(table.__table__.insert(rec))
-                if i%200 == 0:
-                    print("%d/%d   %0.2f%%\r" % (i, reader.max_id, (100.0*(i+1.0)/reader.max_id)), end="")
-                    sys.stdout.flush()
-                
-            print("   committing %d rows..                    " % i)
-            write_session.commit()
-            read_session.rollback()
+            tables.append(table_group[table_name])
+
+    # decide which experiments to copy
+    subset_ids = None
+    if len(filters) > 0:
+        subset_ids = experiment_subset(read_session, **filters)
+        print("Selected %d experiments matching %r" % (len(subset_ids), filters))
+    expt_ids = subset_ids
+
+    if incremental:
+        last_watermark = datetime.strptime(last_bake['watermark'], '%Y-%m-%d %H:%M:%S.%f')
+        changed_ids = changed_experiments(read_session, write_session, last_watermark)
+        print("%d experiments changed since last bake (%s)" % (len(changed_ids), last_bake['watermark']))
+
+        # Collect ids to delete from all tables first; rows are located by joining up to the
+        # experiment table, so parent rows must still be present while we search.
+        drop_ids = OrderedDict()
+        for table in tables:
+            if experiment_join_path(table) is None:
+                continue
+            drop_ids[table] = experiment_row_ids(write_session, table, changed_ids)
+        for table, ids in drop_ids.items():
+            print("Removing %d stale rows from %s.." % (len(ids), table.__table__.name))
+            for i in range(0, len(ids), 1000):
+                write_session.execute(table.__table__.delete().where(table.__table__.c.id.in_(ids[i:i+1000])))
+        read_session.rollback()
+
+        if expt_ids is None:
+            expt_ids = changed_ids
+        else:
+            expt_ids = sorted(set(expt_ids) & set(changed_ids))
+
+    last_size = os.stat(sqlite_file).st_size if incremental else 0
+    for table in tables:
+        table_name = table.__table__.name
+        print("Baking %s.." % table_name)
+        
+        if experiment_join_path(table) is None:
+            # Small tables that don't belong to any single experiment are copied again in full
+            # (or just the rows referenced by the selected experiments)
+            if incremental:
+                write_session.execute(table.__table__.delete())
+            ids = None if subset_ids is None else unattributed_rows(read_session, table, subset_ids)
+        elif expt_ids is None:
+            ids = None
+        else:
+            ids = experiment_row_ids(read_session, table, expt_ids)
+
+        # read from table in background thread, write to sqlite in main thread.
+        reader = TableReadThread(table, ids=ids, skip_arrays=skip_arrays)
+
+        i = -1
+        for i,rec in enumerate(reader):
+            write_session.execute(table.__table__.insert(rec))
+            if i%200 == 0:
+                print("%d/%d   %0.2f%%\r" % (i, reader.n_records, (100.0*(i+1.0)/max(reader.n_records, 1))), end="")
+                sys.stdout.flush()
             
-            size = os.stat(sqlite_file).st_size
-            diff = size - last_size
-            last_size = size
-            print("   sqlite file size:  %0.2fGB  (+%0.2fGB for this table)" % (size*1e-9, diff*1e-9))
+        print("   committing %d rows..                    " % (i+1))
+        write_session.commit()
+        read_session.rollback()
+        
+        size = os.stat(sqlite_file).st_size
+        diff = size - last_size
+        last_size = size
+        print("   sqlite file size:  %0.2fGB  (+%0.2fGB for this table)" % (size*1e-9, diff*1e-9))
+
+    bake_info = {
+        'db_version': str(db_version),
+        'bake_time': datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f'),
+        'filters': json.dumps(filters),
+        'skip_arrays': str(bool(skip_arrays)),
+    }
+    if watermark is not None:
+        bake_info['watermark'] = watermark.strftime('%Y-%m-%d %H:%M:%S.%f')
+    write_bake_info(sqlite_engine, bake_info)
+
+    print("Creating covering indexes..")
+    create_sqlite_indexes(sqlite_engine)
 
     print("Optimizing database..")    
     write_session.execute("analyze")
@@ -428,30 +1006,283 @@ def bake_sqlite(sqlite_file):
     print("All finished!")
 
 
+# Covering indexes added to baked sqlite files for the most common pair / pulse response lookups
+# (connection_strength.get_amps, pulse_response_strength queries, connectivity.query_pair_summary).
+# Each index holds every column these queries read from its table, so sqlite never has to visit
+# the table rows--which, for the pulse-level tables, are interleaved with large data blobs.
+sqlite_covering_indexes = OrderedDict([
+    ('ix_cover_pulse_response_pair', ('pulse_response', ['pair_id', 'id', 'recording_id', 'stim_pulse_id', 'ex_qc_pass', 'in_qc_pass', 'start_time'])),
+    ('ix_cover_pulse_response_strength', ('pulse_response_strength', ['pulse_response_id', 'id', 'pos_amp', 'neg_amp', 'pos_dec_amp', 'neg_dec_amp', 'pos_dec_latency', 'neg_dec_latency', 'crosstalk'])),
+    ('ix_cover_patch_clamp_recording', ('patch_clamp_recording', ['recording_id', 'clamp_mode', 'qc_pass', 'baseline_potential', 'baseline_current'])),
+    ('ix_cover_recording_electrode', ('recording', ['electrode_id', 'id', 'sync_rec_id', 'start_time'])),
+    ('ix_cover_stim_pulse_recording', ('stim_pulse', ['recording_id', 'id', 'pulse_number', 'onset_time'])),
+    ('ix_cover_stim_spike_pulse', ('stim_spike', ['stim_pulse_id', 'max_dvdt_time'])),
+    ('ix_cover_baseline_recording', ('baseline', ['recording_id', 'id', 'ex_qc_pass', 'in_qc_pass'])),
+    ('ix_cover_pair_cells', ('pair', ['pre_cell_id', 'post_cell_id', 'id', 'experiment_id', 'synapse'])),
+    ('ix_cover_pair_summary_project', ('pair_summary', ['project_name', 'connection_strength_id', 'pair_id'])),
+])
+
+
+def create_sqlite_indexes(engine):
+    """Create the indexes in sqlite_covering_indexes in an sqlite file.
+
+    Indexes that already exist, or that refer to tables / columns not present in this schema, are skipped.
+    """
+    tables = ORMBase.metadata.tables
+    with engine.begin() as conn:
+        for name, (table_name, columns) in sqlite_covering_indexes.items():
+            table = tables.get(table_name)
+            if table is None or any(col not in table.c for col in columns):
+                continue
+            conn.execute('CREATE INDEX IF NOT EXISTS %s ON %s (%s)' % (name, table_name, ', '.join(columns)))
+
+
+def read_bake_info(engine):
+    """Return a dict of metadata stored by bake_sqlite in an sqlite file, or an empty dict
+    if the file has not been baked.
+    """
+    if 'bake_info' not in engine.table_names():
+        return {}
+    recs = engine.execute("select key, value from bake_info").fetchall()
+    return {k:v for k,v in recs}
+
+
+def write_bake_info(engine, info):
+    """Store bake metadata (a dict of string keys and values) in an sqlite file.
+    """
+    with engine.begin() as conn:
+        conn.execute("create table if not exists bake_info (key varchar primary key, value varchar)")
+        for k,v in info.items():
+            conn.execute(sqlalchemy.text("insert or replace into bake_info (key, value) values (:key, :value)"), key=k, value=v)
+
+
+# Jobs that finished up to this long before the previous bake's watermark are baked again
+# by incremental bakes (see changed_experiments)
+bake_watermark_overlap = timedelta(hours=1)
+
+
+def changed_experiments(session, sqlite_session, watermark, overlap=None):
+    """Return a list of acq_timestamps for all experiments that need to be updated in an sqlite
+    file that was last baked at *watermark*.
+
+    This includes experiments for which any pipeline job (including jobs on the experiment's slice)
+    finished after *watermark* - *overlap*, and experiments whose pipeline jobs have since been dropped.
+
+    A job's finish_time is set before its results are committed, so a job that was still committing
+    when the previous bake began may have a finish_time slightly earlier than *watermark*; the
+    *overlap* (default bake_watermark_overlap) re-checks these jobs.
+    """
+    if overlap is None:
+        overlap = bake_watermark_overlap
+    watermark = watermark - overlap
+    pipeline = ORMBase.metadata.tables['pipeline']
+    experiment = ORMBase.metadata.tables['experiment']
+    slice_ = ORMBase.metadata.tables['slice']
+
+    job_query = sqlalchemy.select([pipeline.c.module_name, pipeline.c.job_id, pipeline.c.finish_time])
+    new_jobs = session.execute(job_query).fetchall()
+    old_jobs = sqlite_session.execute(job_query).fetchall()
+
+    changed_jobs = set([rec.job_id for rec in new_jobs if rec.finish_time is not None and rec.finish_time > watermark])
+    # jobs that were present in the last bake but have been dropped from the database
+    new_keys = set([(rec.module_name, rec.job_id) for rec in new_jobs])
+    changed_jobs |= set([rec.job_id for rec in old_jobs if (rec.module_name, rec.job_id) not in new_keys])
+    changed_jobs = list(changed_jobs)
+
+    # job IDs are either experiment or slice timestamps; look up both in old and new databases
+    expt_ids = set()
+    for sess in (session, sqlite_session):
+        for i in range(0, len(changed_jobs), 1000):
+            chunk = changed_jobs[i:i+1000]
+            q = sqlalchemy.select([experiment.c.acq_timestamp]).select_from(experiment.outerjoin(slice_, experiment.c.slice_id==slice_.c.id))
+            q = q.where(or_(experiment.c.acq_timestamp.in_(chunk), slice_.c.acq_timestamp.in_(chunk)))
+            expt_ids |= set([rec[0] for rec in sess.execute(q)])
+
+    # experiments that were removed entirely
+    expt_query = sqlalchemy.select([experiment.c.acq_timestamp])
+    current_expts = set([rec[0] for rec in session.execute(expt_query)])
+    baked_expts = set([rec[0] for rec in sqlite_session.execute(expt_query)])
+    expt_ids |= baked_expts - current_expts
+    
+    return sorted(expt_ids)
+
+
+def experiment_join_path(table):
+    """Return the list of foreign keys that must be followed to get from *table* to the experiment
+    table (an empty list for the experiment table itself), or None if there is no such path.
+
+    The shortest path is chosen; this is used to find all records belonging to a particular
+    set of experiments.
+    """
+    start = table.__table__ if hasattr(table, '__table__') else table
+    paths = {start.name: []}
+    pending = [start]
+    while len(pending) > 0:
+        tab = pending.pop(0)
+        if tab.name == 'experiment':
+            return paths[tab.name]
+        for fk in sorted(tab.foreign_keys, key=lambda fk: fk.parent.name):
+            parent = fk.column.table
+            if parent.name in paths:
+                continue
+            paths[parent.name] = paths[tab.name] + [fk]
+            pending.append(parent)
+    return None
+
+
+def experiment_rows_query(table, expt_ids, columns=None):
+    """Return a select statement that finds rows in *table* belonging to a list of experiments.
+
+    Experiments are identified by acq_timestamp. By default, only row ids are selected;
+    a different list of *columns* may be given instead. The experiments are matched with a
+    single IN clause; use experiment_row_ids for long lists.
+    """
+    sa_table = table.__table__ if hasattr(table, '__table__') else table
+    path = experiment_join_path(sa_table)
+    if path is None:
+        raise ValueError("Table %s cannot be joined to the experiment table" % sa_table.name)
+    from_ = sa_table
+    for fk in path:
+        from_ = from_.join(fk.column.table, fk.parent==fk.column)
+    experiment = ORMBase.metadata.tables['experiment']
+    if columns is None:
+        columns = [sa_table.c.id]
+    return sqlalchemy.select(columns).select_from(from_).where(experiment.c.acq_timestamp.in_(list(expt_ids)))
+
+
+def experiment_row_ids(session, table, expt_ids, chunksize=1000):
+    """Return a list of ids for all rows in *table* belonging to a list of experiments.
+
+    Experiments are queried *chunksize* at a time to keep statements small.
+    """
+    expt_ids = list(expt_ids)
+    ids = []
+    for i in range(0, len(expt_ids), chunksize):
+        ids.extend([rec[0] for rec in session.execute(experiment_rows_query(table, expt_ids[i:i+chunksize]))])
+    return ids
+
+
+def experiment_subset(session, experiment_ids=None, project_name=None, species=None, acsf=None, age=None, internal=None):
+    """Return a sorted list of acq_timestamps for all experiments matching the given filters.
+
+    Filters mirror those accepted by `connectivity.query_pairs`; string filters may be 
+    given as a single value or a list of accepted values.
+
+    Parameters
+    ----------
+    experiment_ids : list | None
+        List of experiment acq_timestamps to select from
+    project_name : str | list | None
+        Value(s) to match from experiment.project_name (e.g. "mouse V1 coarse matrix" or "human coarse matrix")
+    species : str | list | None
+        Value(s) to match from slice.species
+    acsf : str | list | None
+        Value(s) to match from experiment.acsf
+    age : tuple | None
+        (min, max) age of the specimen in days; either value may be None
+    internal : str | list | None
+        Value(s) to match from experiment.internal
+    """
+    experiment = ORMBase.metadata.tables['experiment']
+    slice_ = ORMBase.metadata.tables['slice']
+    q = sqlalchemy.select([experiment.c.acq_timestamp]).select_from(experiment.join(slice_, experiment.c.slice_id==slice_.c.id))
+    
+    def match(column, value):
+        if isinstance(value, (list, tuple)):
+            return column.in_(list(value))
+        return column == value
+    
+    for column, value in [(experiment.c.project_name, project_name), (experiment.c.acsf, acsf), 
+                          (experiment.c.internal, internal), (slice_.c.species, species)]:
+        if value is not None:
+            q = q.where(match(column, value))
+
+    if age is not None:
+        if age[0] is not None:
+            q = q.where(slice_.c.age >= age[0])
+        if age[1] is not None:
+            q = q.where(slice_.c.age <= age[1])
+
+    expt_ids = set([rec[0] for rec in session.execute(q)])
+    if experiment_ids is not None:
+        expt_ids &= set(experiment_ids)
+    return sorted(expt_ids)
+
+
+def unattributed_rows(session, table, expt_ids):
+    """Return ids of rows in a table that cannot be joined to the experiment table (slice, pipeline),
+    but that are needed to describe the given list of experiments.
+    """
+    experiment = ORMBase.metadata.tables['experiment']
+    slice_ = ORMBase.metadata.tables['slice']
+    sa_table = table.__table__
+    slice_query = sqlalchemy.select([slice_.c.id, slice_.c.acq_timestamp]).select_from(experiment.join(slice_, experiment.c.slice_id==slice_.c.id))
+    slices = []
+    for i in range(0, len(expt_ids), 1000):
+        slices.extend(session.execute(slice_query.where(experiment.c.acq_timestamp.in_(expt_ids[i:i+1000]))).fetchall())
+
+    if sa_table.name == 'slice':
+        return sorted(set([rec.id for rec in slices]))
+    elif sa_table.name == 'pipeline':
+        # pipeline jobs are keyed either by experiment or slice timestamp
+        job_ids = list(expt_ids) + list(set([rec.acq_timestamp for rec in slices]))
+        ids = []
+        for i in range(0, len(job_ids), 1000):
+            q = sqlalchemy.select([sa_table.c.id]).where(sa_table.c.job_id.in_(job_ids[i:i+1000]))
+            ids.extend([rec[0] for rec in session.execute(q)])
+        return sorted(ids)
+    else:
+        raise ValueError("Don't know how to select a subset of table %s" % sa_table.name)
+
+
 class TableReadThread(threading.Thread):
     """Iterator that yields records (all columns) from a table.
     
-    Records are queried chunkwise and queued in a background thread to enable more efficient streaming.
+    Records are streamed (see `stream`) and queued in a background thread to enable more efficient streaming.
+
+    If a list of row *ids* is given, then only those records are returned. If *skip_arrays* is True,
+    then array columns are returned empty (None) without being read from the database.
     """
-    def __init__(self, table, chunksize=1000):
+    def __init__(self, table, chunksize=1000, ids=None, skip_arrays=False):
         threading.Thread.__init__(self)
         self.daemon = True
         
         self.table = table
         self.chunksize = chunksize
+        self.skip_arrays = skip_arrays
         self.queue = queue.Queue(maxsize=5)
-        self.max_id = Session().query(func.max(table.id)).all()[0][0]        
+        if ids is None:
+            self.ids = None
+            session = Session()
+            self.n_records = session.query(func.count(table.id)).scalar()
+            session.rollback()
+        else:
+            self.ids = sorted(ids)
+            self.n_records = len(self.ids)
         self.start()
         
+    @staticmethod
+    def read_queries(table, chunksize=1000, ids=None, skip_arrays=False):
+        """Return the list of queries used to read records from *table*.
+        """
+        all_columns = []
+        for col in table.__table__.c:
+            if skip_arrays and isinstance(col.type, NDArray):
+                col = sqlalchemy.null().label(col.name)
+            all_columns.append(col)
+        query = sqlalchemy.select(all_columns).order_by(table.id)
+        if ids is None:
+            return [query]
+        else:
+            return [query.where(table.id.in_(ids[i:i+chunksize])) for i in range(0, len(ids), chunksize)]
+
     def run(self):
         session = Session()
-        table = self.table
         chunksize = self.chunksize
-        all_columns = table.__table__.c
-        for i in range(0, self.max_id, chunksize):
-            query = session.query(*all_columns).filter((table.id >= i) & (table.id < i+chunksize))
-            records = query.all()
-            self.queue.put(records)
+        queries = self.read_queries(self.table, chunksize=chunksize, ids=self.ids, skip_arrays=self.skip_arrays)
+        for query in queries:
+            for records in stream(query, batch_size=chunksize, session=session, as_array=False):
+                self.queue.put(records)
         self.queue.put(None)
         session.rollback()
         session.close()
@@ -463,4 +1294,3 @@ class TableReadThread(threading.Thread):
                 break
             for rec in recs:
                 yield rec
-    
\ No newline at end of file
@@ -6,7 +6,7 @@ from sqlalchemy.orm import relationship
 from .experiment import Experiment, Electrode, Pair
 
 
-__all__ = ['dataset_tables', 'SyncRec', 'Recording', 'PatchClampRecording', 'MultiPatchProbe', 'TestPulse', 'StimPulse', 'StimSpike', 'PulseResponse', 'Baseline']
+__all__ = ['dataset_tables', 'load_snippet_data', 'pulse_waveform', 'SyncRec', 'Recording', 'PatchClampRecording', 'MultiPatchProbe', 'TestPulse', 'StimPulse', 'StimSpike', 'PulseResponse', 'Baseline']
 
 
 SyncRec = make_table(
@@ -19,14 +19,40 @@ SyncRec = make_table(
     ]
 )
 
+class RecordingBase(object):
+    def _init_on_load(self):
+        self._tseries = None
+
+    @property
+    def tseries(self):
+        """Trace containing the full primary channel data for this recording.
+
+        Only available if the recording data was stored at import time (see config.store_recording_data).
+        """
+        if self._tseries is None:
+            if self.data is None:
+                raise ValueError("No data stored for recording %d" % self.id)
+            self._tseries = Trace(self.data, sample_rate=default_sample_rate, t0=self.data_start_time)
+        return self._tseries
+
+    def data_slice(self, start, stop):
+        """Return a view of the stored recording data between two sample indices.
+        """
+        return self.tseries.data[start:stop]
+
+
 Recording = make_table(
     name='recording',
+    base=RecordingBase,
     comment= "A recording represents a single contiguous sweep recorded from a single electrode.",
     columns=[
         ('sync_rec_id', 'sync_rec.id', 'References the synchronous recording to which this recording belongs.', {'index': True}),
         ('electrode_id', 'electrode.id', 'Identifies the electrode that generated this recording', {'index': True}),
         ('start_time', 'datetime', 'The clock time at the start of this recording'),
         ('sample_rate', 'int', 'Sample rate for this recording'),
+        ('data', 'array', 'Numpy array (float32) of the full primary channel recording sampled at '+_sample_rate_str+
+            '. Only stored when config.store_recording_data is set; otherwise data is stored per-snippet.', {'deferred': True}),
+        ('data_start_time', 'float', "Starting time of the stored recording data"),
     ]
 )
 
@@ -46,8 +72,50 @@ PatchClampRecording = make_table(
     ]
 )
 
+def pulse_waveform(pulses, t0, n_samples, sample_rate=default_sample_rate):
+    """Return an array containing the rectangular stimulus waveform of one or more pulses.
+
+    Parameters
+    ----------
+    pulses : list
+        StimPulse records (or any objects with onset_time, duration and amplitude attributes).
+        Only these metadata columns are used; no recorded data is loaded.
+    t0 : float
+        Time (relative to the beginning of the recording) of the first sample.
+    n_samples : int
+        Length of the returned array.
+    """
+    data = np.zeros(n_samples)
+    # pulse edges fall on the same samples as in the recording (times are rounded to sample
+    # indices relative to the start of the recording, as with Trace.index_at), even if t0
+    # does not lie exactly on a sample
+    i0 = int(np.round(t0 * sample_rate))
+    for pulse in pulses:
+        start = int(np.round(pulse.onset_time * sample_rate)) - i0
+        stop = int(np.round((pulse.onset_time + pulse.duration) * sample_rate)) - i0
+        data[max(start, 0):max(stop, 0)] = pulse.amplitude
+    return data
+
+
+class MultiPatchProbeBase(object):
+    def stimulus_tseries(self, start=0, stop=None):
+        """Return a Trace of the presynaptic pulse train delivered during this recording.
+
+        The waveform is generated from the stim_pulse metadata; no recorded data is loaded.
+        By default the trace spans from the start of the recording until stim_pulse_window
+        after the end of the last pulse.
+        """
+        pulses = self.patch_clamp_recording.recording.stim_pulses
+        if stop is None:
+            ends = [p.onset_time + p.duration for p in pulses]
+            stop = (max(ends) if len(ends) > 0 else start) + stim_pulse_window
+        n_samples = int(np.round((stop - start) * default_sample_rate))
+        return Trace(pulse_waveform(pulses, start, n_samples), sample_rate=default_sample_rate, t0=start)
+
+
 MultiPatchProbe = make_table(
     name='multi_patch_probe',
+    base=MultiPatchProbeBase,
     comment="Extra data for multipatch recordings intended to test synaptic dynamics.",
     columns=[
         ('patch_clamp_recording_id', 'patch_clamp_recording.id', '', {'index': True, 'unique': True}),
@@ -74,6 +142,10 @@ TestPulse = make_table(
     ]
 )
 
+# Length of the recording stored before and after the onset of each stim pulse (s)
+stim_pulse_window = 10e-3
+
+
 class StimPulseBase(object):
     def _init_on_load(self):
         self._rec_tseries = None
@@ -82,19 +154,40 @@ class StimPulseBase(object):
     @property
     def recorded_tseries(self):
         if self._rec_tseries is None:
-            self._rec_tseries = Trace(self.data, sample_rate=default_sample_rate, t0=self.data_start_time)
+            if self.data_start_index is None:
+                data = self.data
+            else:
+                data = self.recording.data_slice(self.data_start_index, self.data_stop_index)
+            self._rec_tseries = Trace(data, sample_rate=default_sample_rate, t0=self.data_start_time)
         return self._rec_tseries
 
+    @property
+    def n_samples(self):
+        """Number of samples in the stored data chunk.
+
+        This is determined without loading any data if the chunk is stored as a slice of its
+        recording. Otherwise the length of the stored chunk is used (it is resampled from the
+        original recording, so its length cannot be reliably computed from the chunk times).
+        """
+        if self._rec_tseries is not None:
+            return self._rec_tseries.shape[0]
+        if self.data_start_index is not None:
+            return self.data_stop_index - self.data_start_index
+        if self.data is not None:
+            return len(self.data)
+        # no stored data; chunks span stim_pulse_window after the pulse onset (see pipeline/dataset.py)
+        return int(np.round((self.onset_time + stim_pulse_window - self.data_start_time) * default_sample_rate))
+
     @property
     def stimulus_tseries(self):
-        # can we work Stimulus objects into here, rather than generating manually??
+        """Trace of the stimulus pulse, aligned with recorded_tseries.
+
+        The waveform is generated from onset_time, duration and amplitude, so no recorded
+        data is loaded.
+        """
         if self._stim_tseries is None:
-            rec_ts = self.recorded_tseries  # todo: avoid loading full data for this step
-            data = np.zeros(shape=rec_ts.shape)
-            pstart = rec_ts.index_at(self.onset_time)
-            pstop = rec_ts.index_at(self.onset_time + self.duration)
-            data[pstart:pstop] = self.amplitude            
-            self._stim_tseries = rec_ts.copy(data=data)
+            data = pulse_waveform([self], self.data_start_time, self.n_samples)
+            self._stim_tseries = Trace(data, sample_rate=default_sample_rate, t0=self.data_start_time)
         return self._stim_tseries
 
    
@@ -102,7 +195,9 @@ StimPulse = make_table(
     name='stim_pulse',
     base=StimPulseBase,
     comment= "A pulse stimulus intended to evoke an action potential",
+    partition_by='experiment_id',
     columns=[
+        ('experiment_id', 'experiment.id', 'Copied from sync_rec.experiment_id', {'index': True}),
         ('recording_id', 'recording.id', '', {'index': True}),
         ('pulse_number', 'int', 'The ordinal position of this pulse within a train of pulses.', {'index': True}),
         ('onset_time', 'float', 'The starting time of the pulse, relative to the beginning of the recording'),
@@ -113,6 +208,8 @@ StimPulse = make_table(
         # ('first_spike', 'stim_spike.id', 'The ID of the first spike evoked by this pulse'),
         ('data', 'array', 'Numpy array of presynaptic recording sampled at '+_sample_rate_str, {'deferred': True}),
         ('data_start_time', 'float', "Starting time of the data chunk, relative to the beginning of the recording"),
+        ('data_start_index', 'int', "Start index of the data chunk in recording.data (if the full recording is stored instead of data)"),
+        ('data_stop_index', 'int', "Stop index of the data chunk in recording.data (if the full recording is stored instead of data)"),
     ]
 )
 
@@ -120,7 +217,9 @@ StimPulse = make_table(
 StimSpike = make_table(
     name='stim_spike',
     comment= "An action potential evoked by a stimulus pulse",
+    partition_by='experiment_id',
     columns=[
+        ('experiment_id', 'experiment.id', 'Copied from sync_rec.experiment_id', {'index': True}),
         ('stim_pulse_id', 'stim_pulse.id', '', {'index': True}),
         ('peak_time', 'float', "The time of the peak of the spike, relative to the beginning of the recording."),
         ('peak_diff', 'float', 'Amplitude of the spike peak, relative to baseline'),
@@ -138,7 +237,11 @@ class PulseResponseBase(object):
     @property
     def post_tseries(self):
         if self._post_tseries is None:
-            self._post_tseries = Trace(self.data, sample_rate=default_sample_rate, t0=self.start_time)
+            if self.data_start_index is None:
+                data = self.data
+            else:
+                data = self.recording.data_slice(self.data_start_index, self.data_stop_index)
+            self._post_tseries = Trace(data, sample_rate=default_sample_rate, t0=self.start_time)
         return self._post_tseries
 
     @property
@@ -149,16 +252,42 @@ class PulseResponseBase(object):
     def stim_tseries(self):
         return self.stim_pulse.stimulus_tseries
 
+    def response_stimulus_tseries(self, duration=None):
+        """Return a Trace of the presynaptic stimulus (including any other pulses in the same
+        train) over the time window of this response, generated without loading recorded data.
+
+        By default the trace has the same length as post_tseries. This is known without loading
+        data only if the response is stored as a slice of its recording; otherwise the stored
+        data is loaded, unless *duration* is given.
+        """
+        if duration is not None:
+            n_samples = int(np.round(duration * default_sample_rate))
+        elif self._post_tseries is not None:
+            n_samples = self._post_tseries.shape[0]
+        elif self.data_start_index is not None:
+            n_samples = self.data_stop_index - self.data_start_index
+        elif self.data is not None:
+            n_samples = len(self.data)
+        else:
+            raise ValueError("Pulse response %d has no stored data; duration must be specified." % self.id)
+        pulses = self.stim_pulse.recording.stim_pulses
+        return Trace(pulse_waveform(pulses, self.start_time, n_samples), sample_rate=default_sample_rate, t0=self.start_time)
+
+
 PulseResponse = make_table(
     name='pulse_response',
     base=PulseResponseBase,
     comment="A chunk of postsynaptic recording taken during a presynaptic pulse stimulus",
+    partition_by='experiment_id',
     columns=[
+        ('experiment_id', 'experiment.id', 'Copied from sync_rec.experiment_id', {'index': True}),
         ('recording_id', 'recording.id', 'The full recording from which this pulse was extracted', {'index': True}),
         ('stim_pulse_id', 'stim_pulse.id', 'The presynaptic pulse', {'index': True}),
         ('pair_id', 'pair.id', 'The pre-post cell pair involved in this pulse response', {'index': True}),
         ('start_time', 'float', 'Starting time of this chunk of the recording in seconds, relative to the beginning of the recording'),
         ('data', 'array', 'numpy array of response data sampled at '+_sample_rate_str, {'deferred': True}),
+        ('data_start_index', 'int', "Start index of the response in recording.data (if the full recording is stored instead of data)"),
+        ('data_stop_index', 'int', "Stop index of the response in recording.data (if the full recording is stored instead of data)"),
         ('ex_qc_pass', 'bool', 'Indicates whether this recording snippet passes QC for excitatory synapse probing', {'index': True}),
         ('in_qc_pass', 'bool', 'Indicates whether this recording snippet passes QC for inhibitory synapse probing', {'index': True}),
     ]
@@ -168,10 +297,14 @@ PulseResponse = make_table(
 Baseline = make_table(
     name='baseline',
     comment="A snippet of baseline data, matched to a postsynaptic recording",
+    partition_by='experiment_id',
     columns=[
+        ('experiment_id', 'experiment.id', 'Copied from sync_rec.experiment_id', {'index': True}),
         ('recording_id', 'recording.id', 'The recording from which this baseline snippet was extracted.', {'index': True}),
         ('start_time', 'float', "Starting time of this chunk of the recording in seconds, relative to the beginning of the recording"),
         ('data', 'array', 'numpy array of baseline data sampled at '+_sample_rate_str, {'deferred': True}),
+        ('data_start_index', 'int', "Start index of the baseline in recording.data (if the full recording is stored instead of data)"),
+        ('data_stop_index', 'int', "Stop index of the baseline in recording.data (if the full recording is stored instead of data)"),
         ('mode', 'float', 'most common value in the baseline snippet'),
         ('ex_qc_pass', 'bool', 'Indicates whether this recording snippet passes QC for excitatory synapse probing'),
         ('in_qc_pass', 'bool', 'Indicates whether this recording snippet passes QC for inhibitory synapse probing'),
@@ -219,4 +352,37 @@ Pair.pulse_responses = relationship(PulseResponse, back_populates='pair', single
 PulseResponse.pair = relationship(Pair, back_populates='pulse_responses')
 
 
+def load_snippet_data(session, table, ids):
+    """Return a dict {id: data} of data arrays for many StimPulse, PulseResponse, or Baseline records.
+
+    Records that reference a chunk of recording.data (see config.store_recording_data) are
+    sliced from their parent recordings, which are each loaded only once. Other records
+    return their own data array.
+    """
+    ids = list(ids)
+    recs = []
+    for i in range(0, len(ids), 1000):
+        q = session.query(table.id, table.recording_id, table.data_start_index, table.data_stop_index)
+        recs.extend(q.filter(table.id.in_(ids[i:i+1000])).all())
+
+    snippets = {}
+    rec_ids = set([rec.recording_id for rec in recs if rec.data_start_index is not None])
+    inline_ids = [rec.id for rec in recs if rec.data_start_index is None]
+
+    rec_data = {}
+    rec_ids = list(rec_ids)
+    for i in range(0, len(rec_ids), 100):
+        q = session.query(Recording.id, Recording.data).filter(Recording.id.in_(rec_ids[i:i+100]))
+        rec_data.update(dict(q.all()))
+    for rec in recs:
+        if rec.data_start_index is not None:
+            snippets[rec.id] = rec_data[rec.recording_id][rec.data_start_index:rec.data_stop_index]
+
+    for i in range(0, len(inline_ids), 1000):
+        q = session.query(table.id, table.data).filter(table.id.in_(inline_ids[i:i+1000]))
+        snippets.update(dict(q.all()))
+
+    return snippets
+
+
 dataset_tables = TableGroup([SyncRec, Recording, PatchClampRecording, MultiPatchProbe, TestPulse, StimPulse, Baseline, StimSpike, PulseResponse])
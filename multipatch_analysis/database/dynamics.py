@@ -14,6 +14,7 @@ Dynamics = make_table(
         ('pulse_ratio_8_1_50Hz', 'float', '8:1 pulse ratio for 50Hz induction', {'index': True}),
         ('pulse_ratio_2_1_50Hz', 'float', '2:1 pulse ratio for 50Hz induction', {'index': True}),
         ('pulse_ratio_5_1_50Hz', 'float', '5:1 pulse ratio for 50Hz induction', {'index': True}),
+        ('stp', 'object', 'Pulse ratios and recovery for every clamp mode, induction frequency, and recovery delay (see multipatch_analysis.dynamics.stp_table)'),
     ]
 )
 
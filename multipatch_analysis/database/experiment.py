@@ -11,25 +11,45 @@ __all__ = ['experiment_tables', 'Experiment', 'Electrode', 'Cell', 'Pair']
 
 class ExperimentBase(object):
     def __getitem__(self, item):
-        # Easy cell/pair getters.
-        # They're inefficient, but meh.
+        # Easy cell/pair getters: expt[cell_ext_id] or expt[pre_ext_id, post_ext_id]
         if isinstance(item, int):
-            for cell in self.cells:
-                if cell.ext_id == item:
-                    return cell
+            return self.cells.get(item)
         elif isinstance(item, tuple):
-            for pair in self.pair_lists:
-                if item == (pair.pre_cell.ext_id, pair.post_cell.ext_id):
-                    return pair
+            return self.pairs.get(item)
     
     @property
     def cells(self):
+        index = getattr(self, '_index', None)
+        if index is not None:
+            return index['cells']
         return {elec.cell.ext_id: elec.cell for elec in self.electrodes if elec.cell is not None}
 
     @property
     def pairs(self):
+        index = getattr(self, '_index', None)
+        if index is not None:
+            return index['pairs']
         return {(pair.pre_cell.ext_id, pair.post_cell.ext_id): pair for pair in self.pair_list}
 
+    @property
+    def devices(self):
+        """Dict of {device_id: electrode} for all electrodes in this experiment.
+        """
+        index = getattr(self, '_index', None)
+        if index is not None:
+            return index['devices']
+        return {elec.device_id: elec for elec in self.electrodes}
+
+    def build_index(self):
+        """Build and cache dictionary indexes of cells, pairs, and devices in this experiment.
+
+        After this is called, `cells`, `pairs`, `devices`, and `__getitem__` use the cached
+        indexes rather than walking the relationships. This is done automatically by
+        `load_experiments`; call it again if cells or pairs are added to the experiment.
+        """
+        self._index = None
+        self._index = {'cells': self.cells, 'pairs': self.pairs, 'devices': self.devices}
+
     @property
     def nwb_file(self):
         return os.path.join(config.synphys_data, self.storage_path, self.ephys_file)
@@ -0,0 +1,147 @@
+import sqlalchemy
+from sqlalchemy import Integer, Boolean, String
+from sqlalchemy.orm import relationship
+from .database import make_table, TableGroup, NDArray, JSONObject
+from .experiment import Pair
+from .morphology import Morphology
+from .connection_strength import ConnectionStrength
+from .first_pulse_fit import AvgFirstPulseFit
+from .dynamics import Dynamics
+
+
+__all__ = ['pair_summary_tables', 'PairSummary', 'strength_summary_query']
+
+
+def _copy_columns(table, prefix='', exclude=()):
+    """Generate column specifications for all scalar columns in *table*.
+    """
+    columns = []
+    for col in table.__table__.columns:
+        if col.name in ('id', 'meta', 'pair_id') or col.name in exclude:
+            continue
+        if isinstance(col.type, (NDArray, JSONObject)):
+            continue
+        if isinstance(col.type, Boolean):
+            typ = 'bool'
+        elif isinstance(col.type, Integer):
+            typ = 'int'
+        elif isinstance(col.type, String):
+            typ = 'str'
+        else:
+            typ = 'float'
+        columns.append((prefix + col.name, typ, 'Copied from %s.%s' % (table.__table__.name, col.name)))
+    return columns
+
+
+PairSummary = make_table(
+    name='pair_summary',
+    comment="""Denormalized per-pair summary combining the most commonly used fields from pair, cell, morphology,
+            experiment, slice, connection_strength, avg_first_pulse_fit, and dynamics tables. This table
+            is regenerated per-experiment by the pair_summary pipeline module, and allows pairs
+            to be filtered and reported without any joins.""",
+    columns=[
+        ('pair_id', 'pair.id', 'The ID of the pair summarized by this record', {'index': True, 'unique': True}),
+        ('experiment_id', 'experiment.id', '', {'index': True}),
+        ('pre_cell_id', 'cell.id', 'ID of the presynaptic cell'),
+        ('post_cell_id', 'cell.id', 'ID of the postsynaptic cell'),
+        ('connection_strength_id', 'connection_strength.id', 'ID of the connection_strength record for this pair, if any'),
+
+        # experiment
+        ('acq_timestamp', 'float', 'Experiment acq_timestamp', {'index': True}),
+        ('project_name', 'str', '', {'index': True}),
+        ('rig_name', 'str', ''),
+        ('acsf', 'str', '', {'index': True}),
+        ('internal', 'str', '', {'index': True}),
+        ('target_temperature', 'float', ''),
+
+        # slice
+        ('donor_species', 'str', 'slice.species', {'index': True}),
+        ('donor_genotype', 'str', 'slice.genotype'),
+        ('donor_age', 'int', 'slice.age', {'index': True}),
+        ('donor_sex', 'str', 'slice.sex'),
+        ('donor_weight', 'str', 'slice.weight'),
+        ('slice_quality', 'int', 'slice.quality'),
+        ('slice_time', 'datetime', 'slice.slice_time'),
+
+        # cells
+        ('pre_cell_ext_id', 'int', 'External ID of the presynaptic cell'),
+        ('pre_cre_type', 'str', '', {'index': True}),
+        ('pre_target_layer', 'str', '', {'index': True}),
+        ('pre_is_excitatory', 'bool', ''),
+        ('pre_pyramidal', 'bool', 'Copied from morphology.pyramidal'),
+        ('post_cell_ext_id', 'int', 'External ID of the postsynaptic cell'),
+        ('post_cre_type', 'str', '', {'index': True}),
+        ('post_target_layer', 'str', '', {'index': True}),
+        ('post_is_excitatory', 'bool', ''),
+        ('post_pyramidal', 'bool', 'Copied from morphology.pyramidal'),
+        ('electrode_distance', 'int', 'Absolute difference between pre- and postsynaptic cell ext_id'),
+
+        # pair
+        ('synapse', 'bool', '', {'index': True}),
+        ('electrical', 'bool', ''),
+        ('crosstalk_artifact', 'float', ''),
+        ('n_ex_test_spikes', 'int', '', {'index': True}),
+        ('n_in_test_spikes', 'int', '', {'index': True}),
+        ('synapse_sign', 'int', ''),
+        ('distance', 'float', '', {'index': True}),
+    ]
+    + _copy_columns(ConnectionStrength)
+    + _copy_columns(AvgFirstPulseFit, prefix='afpf_')
+    + _copy_columns(Dynamics)
+)
+
+Pair.summary = relationship(PairSummary, back_populates="pair", cascade="delete", single_parent=True, uselist=False)
+PairSummary.pair = relationship(Pair, back_populates="summary", single_parent=True)
+
+
+pair_summary_tables = TableGroup([PairSummary])
+
+
+def strength_summary_query(require_morphology=True):
+    """Return a select statement for connection strength results and pair metadata from the
+    pair_summary table (as used by strength_analysis.query_all_pairs).
+
+    Column names match those of the multi-table query that pair_summary replaced. pair_summary
+    has a row for every pair; if *require_morphology* is True, only pairs whose pre- and
+    postsynaptic cells both have a morphology record are selected, as in the original query.
+    """
+    ps = PairSummary.__table__
+    cs_columns = [c for c in ps.columns.keys() if c in ConnectionStrength.__table__.columns.keys() and c not in ('id', 'pair_id')]
+    columns = [
+        ps.c.connection_strength_id.label('id'),
+        ps.c.pair_id,
+    ] + [ps.c[c] for c in cs_columns] + [
+        ps.c.experiment_id,
+        ps.c.acq_timestamp,
+        ps.c.rig_name,
+        ps.c.acsf,
+        ps.c.donor_species,
+        ps.c.donor_genotype,
+        ps.c.donor_age,
+        ps.c.donor_sex,
+        ps.c.slice_quality,
+        ps.c.donor_weight,
+        ps.c.slice_time,
+        ps.c.pre_cell_ext_id.label('pre_cell_id'),
+        ps.c.pre_cre_type,
+        ps.c.pre_target_layer,
+        ps.c.pre_pyramidal,
+        ps.c.post_cell_ext_id.label('post_cell_id'),
+        ps.c.post_cre_type,
+        ps.c.post_target_layer,
+        ps.c.post_pyramidal,
+        ps.c.synapse,
+        ps.c.distance,
+        ps.c.crosstalk_artifact,
+        ps.c.electrode_distance,
+    ]
+
+    from_ = ps
+    if require_morphology:
+        pre_morph = Morphology.__table__.alias('pre_morphology')
+        post_morph = Morphology.__table__.alias('post_morphology')
+        from_ = (from_
+            .join(pre_morph, pre_morph.c.cell_id==ps.c.pre_cell_id)
+            .join(post_morph, post_morph.c.cell_id==ps.c.post_cell_id)
+        )
+    return sqlalchemy.select(columns).select_from(from_).where(ps.c.connection_strength_id != None).order_by(ps.c.acq_timestamp)
@@ -9,7 +9,9 @@ __all__ = ['pulse_response_strength_tables', 'PulseResponseStrength', 'BaselineR
 PulseResponseStrength = make_table(
     name='pulse_response_strength',
     comment="Measurements of membrane potential or current deflection following each evoked presynaptic spike.",
+    partition_by='experiment_id',
     columns=[
+        ('experiment_id', 'experiment.id', 'Copied from pulse_response.experiment_id', {'index': True}),
         ('pulse_response_id', 'pulse_response.id', '', {'index': True, 'unique': True}),
         ('pos_amp', 'float', 'max-median offset from baseline to pulse response window'),
         ('neg_amp', 'float', 'min-median offset from baseline to pulse response window'),
@@ -24,7 +26,9 @@ PulseResponseStrength = make_table(
 BaselineResponseStrength = make_table(
     name='baseline_response_strength',
     comment="Measurements of membrane potential or current deflection in the absence of presynaptic spikes (provides a measurement of background noise to compare to pulse_response_strength).",
+    partition_by='experiment_id',
     columns=[
+        ('experiment_id', 'experiment.id', 'Copied from baseline.experiment_id', {'index': True}),
         ('baseline_id', 'baseline.id', '', {'index': True, 'unique': True}),
         ('pos_amp', 'float', 'max-median offset from baseline to pulse response window'),
         ('neg_amp', 'float', 'min-median offset from baseline to pulse response window'),
@@ -0,0 +1,179 @@
+"""
+On-disk cache for results of expensive, frequently repeated queries.
+
+Query results are stored in config.cache_path/query_cache, keyed by the normalized
+SQL and its bound parameters. Each cached result records the state of the pipeline
+modules that own the tables it was selected from (latest job finish time and number
+of finished jobs); a cached result is discarded as soon as any of those modules has
+run or dropped a job.
+
+Example::
+
+    q = session.query(db.Pair.id, db.Pair.synapse).join(db.Experiment)
+    df = db.query_cache.read_sql(q)   # slow the first time; milliseconds afterward
+    recs = db.query_cache.read_array(q)   # same, as a numpy structured array
+"""
+from __future__ import division, print_function
+
+import os, re, zlib, hashlib, pickle, time
+import sqlalchemy
+from sqlalchemy.sql.expression import func
+from sqlalchemy.sql.util import find_tables
+from sqlalchemy.orm import sessionmaker
+
+from .. import config
+from ..util import replace_file
+from .database import Session, ORMBase, db_name, db_version, fetch_array
+
+
+def cache_dir():
+    return os.path.join(config.cache_path, 'query_cache')
+
+
+def read_sql(query, session=None, params=None, cache=True):
+    """Return the results of *query* as a pandas DataFrame, using a cached copy if the tables
+    involved have not been modified since the cache was written.
+
+    Parameters
+    ----------
+    query : Query | Select | str
+        An ORM query, core selectable, or raw SQL string.
+    session : Session | None
+        Session used to run the query (by default, the session attached to an ORM query
+        or a new read-only session).
+    params : dict | None
+        Parameters to bind to a raw SQL string.
+    cache : bool
+        If False, the query is run directly without reading or writing the cache.
+    """
+    import pandas
+    def fetch(query, session, params):
+        return pandas.read_sql_query(query, session.bind, params=params)
+    return _cached_fetch('dataframe', fetch, query, session, params, cache)
+
+
+def read_array(query, session=None, params=None, cache=True):
+    """Return the results of *query* as a numpy structured array (see database.fetch_array),
+    using a cached copy if the tables involved have not been modified since the cache was written.
+
+    Arguments are the same as for read_sql().
+    """
+    def fetch(query, session, params):
+        return fetch_array(query, session=session, params=params)
+    return _cached_fetch('array', fetch, query, session, params, cache)
+
+
+def _cached_fetch(kind, fetch, query, session, params, cache):
+    if session is None:
+        session = getattr(query, 'session', None) or Session()
+    if hasattr(query, 'statement'):
+        query = query.statement
+
+    if cache:
+        sql, sql_params, tables = normalize_query(query, session, params)
+        state = table_state(session, tables)
+    if not cache or state is None:
+        # no way to tell when results from these tables become invalid
+        return fetch(query, session, params)
+
+    key = hashlib.sha1(repr((db_name, db_version, kind, sql, sorted(sql_params.items()))).encode('utf8')).hexdigest()
+
+    cache_file = os.path.join(cache_dir(), key + '.pkl.z')
+    if os.path.isfile(cache_file):
+        try:
+            with open(cache_file, 'rb') as fh:
+                entry = pickle.loads(zlib.decompress(fh.read()))
+            if entry['state'] == state:
+                return entry['result']
+        except Exception:
+            # corrupt or incompatible cache file; just regenerate it
+            pass
+
+    # results are read on a separate session so that the caller's transaction (and any
+    # uncommitted changes it holds) is neither used nor ended
+    read_session = sessionmaker(bind=session.get_bind())()
+    try:
+        result = fetch(query, read_session, params)
+    finally:
+        read_session.close()
+
+    entry = {'sql': sql, 'params': sql_params, 'state': state, 'time': time.time(), 'result': result}
+    if not os.path.isdir(cache_dir()):
+        os.makedirs(cache_dir())
+    # write to a temporary file first so that concurrent readers never see a partial file
+    tmp_file = cache_file + '.%d.tmp' % os.getpid()
+    with open(tmp_file, 'wb') as fh:
+        fh.write(zlib.compress(pickle.dumps(entry, protocol=2)))
+    replace_file(tmp_file, cache_file)
+
+    return result
+
+
+def normalize_query(query, session, params=None):
+    """Return (sql, params, table_names) for a query.
+
+    SQL is compiled for the session's dialect and whitespace-normalized so that equivalent
+    queries map to the same cache entry.
+    """
+    if isinstance(query, (str, type(u''))):
+        sql = query
+        sql_params = dict(params or {})
+        tables = set()
+        known_tables = ORMBase.metadata.tables
+        for name in re.findall(r'\b(?:from|join)\s+([a-zA-Z_][a-zA-Z0-9_]*)', sql, flags=re.IGNORECASE):
+            if name in known_tables:
+                tables.add(name)
+    else:
+        compiled = query.compile(dialect=session.bind.dialect)
+        sql = str(compiled)
+        sql_params = dict(compiled.params)
+        sql_params.update(params or {})
+        tables = set()
+        for table in find_tables(query, include_joins=True, include_aliases=True):
+            table = getattr(table, 'original', table)
+            if hasattr(table, 'name') and table.name in ORMBase.metadata.tables:
+                tables.add(table.name)
+    sql = ' '.join(sql.split())
+    return sql, sql_params, sorted(tables)
+
+
+def table_owners(tables):
+    """Return the names of pipeline modules that generate records in any of *tables*.
+    """
+    from ..pipeline import all_modules
+    owners = []
+    for mod in all_modules().values():
+        if any([t in mod.table_group.tables for t in tables]):
+            owners.append(mod.name)
+    return owners
+
+
+def table_state(session, tables):
+    """Return a summary of pipeline state for the modules that own *tables*.
+
+    Any change to the returned value indicates that the contents of the tables may have changed.
+    The state is read on a separate connection so that the transaction of *session* is not affected.
+    """
+    pipeline = ORMBase.metadata.tables['pipeline']
+    modules = table_owners(tables)
+    if len(modules) == 0:
+        return None
+    q = sqlalchemy.select([pipeline.c.module_name, func.max(pipeline.c.finish_time), func.count(pipeline.c.id)])
+    q = q.where(pipeline.c.module_name.in_(modules)).group_by(pipeline.c.module_name)
+    conn = session.get_bind().connect()
+    try:
+        state = sorted([(name, str(finish_time), count) for name, finish_time, count in conn.execute(q)])
+    finally:
+        conn.close()
+    return state
+
+
+def clear():
+    """Remove all cached query results.
+    """
+    path = cache_dir()
+    if not os.path.isdir(path):
+        return
+    for fname in os.listdir(path):
+        if fname.endswith('.pkl.z') or fname.endswith('.tmp'):
+            os.remove(os.path.join(path, fname))
@@ -0,0 +1,232 @@
+"""
+Opt-in instrumentation for finding where database time is spent.
+
+A QueryMonitor hooks the sqlalchemy engine events to record the duration, row count,
+and Python call site of every statement executed while it is active. Statements are
+grouped by their normalized SQL (literals and parameter lists collapsed) and call site,
+so that a lazy-loaded relationship or a query issued inside a loop shows up as a single
+pattern with a large count (the "N+1" problem).
+
+Example::
+
+    with QueryMonitor() as mon:
+        analyze_experiment(expt)
+    print(mon.report())
+
+Set config.query_monitor = True (or use --monitor-queries with util/analysis_pipeline.py)
+to monitor every pipeline job; each job's summary is printed and stored in the
+meta['query_stats'] field of its pipeline record.
+"""
+from __future__ import division, print_function
+
+import os, re, sys, time, threading
+from collections import OrderedDict
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+_sqlalchemy_dir = os.path.dirname(os.path.abspath(event.__file__)).rpartition(os.sep)[0]
+_this_module = os.path.splitext(os.path.abspath(__file__))[0]
+
+
+def normalize_sql(sql):
+    """Return *sql* with literal values, bound parameters, and parameter lists replaced by
+    placeholders, so that statements differing only in their values compare equal.
+    """
+    sql = re.sub(r"'(?:[^']|'')*'", '?', sql)
+    sql = re.sub(r'%\(\w+\)s|:\w+|\$\d+|%s', '?', sql)
+    sql = re.sub(r'\b\d+(\.\d+)?(e[-+]?\d+)?\b', '?', sql)
+    sql = re.sub(r'\?(\s*,\s*\?)+', '?, ...', sql)
+    return ' '.join(sql.split())
+
+
+def call_site():
+    """Return "file:line (function)" for the innermost stack frame that is not part of
+    sqlalchemy or this module.
+    """
+    frame = sys._getframe(1)
+    while frame is not None:
+        filename = os.path.abspath(frame.f_code.co_filename)
+        # (sqlalchemy also generates some functions with filename "<string>")
+        if not filename.startswith(_sqlalchemy_dir) and os.path.splitext(filename)[0] != _this_module and '<string>' not in filename:
+            return '%s:%d (%s)' % (filename, frame.f_lineno, frame.f_code.co_name)
+        frame = frame.f_back
+    return '[unknown]'
+
+
+class QueryMonitor(object):
+    """Records timing, row counts, and call sites for all statements executed by any engine.
+
+    Row counts are taken from cursor.rowcount; psycopg2 reports these for all statements,
+    but sqlite only does so for inserts, updates, and deletes.
+
+    Parameters
+    ----------
+    repeat_threshold : int
+        Statement patterns executed at least this many times from the same call site are
+        reported as repeated (likely N+1 queries).
+    slow_threshold : float
+        Individual statements taking longer than this many seconds are reported as slow.
+    max_slow : int
+        Maximum number of slow statements to keep.
+    """
+    def __init__(self, repeat_threshold=10, slow_threshold=1.0, max_slow=20):
+        self.repeat_threshold = repeat_threshold
+        self.slow_threshold = slow_threshold
+        self.max_slow = max_slow
+        self.lock = threading.Lock()
+        self.active = False
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.patterns = OrderedDict()
+            self.slow = []
+            self.n_queries = 0
+            self.total_time = 0.0
+            self.start_time = time.time()
+
+    def start(self):
+        if self.active:
+            return self
+        event.listen(Engine, 'before_cursor_execute', self._before_execute)
+        event.listen(Engine, 'after_cursor_execute', self._after_execute)
+        self.active = True
+        return self
+
+    def stop(self):
+        if not self.active:
+            return
+        event.remove(Engine, 'before_cursor_execute', self._before_execute)
+        event.remove(Engine, 'after_cursor_execute', self._after_execute)
+        self.active = False
+
+    def __enter__(self):
+        self.reset()
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def _before_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_monitor_start', []).append(time.time())
+
+    def _after_execute(self, conn, cursor, statement, parameters, context, executemany):
+        starts = conn.info.get('query_monitor_start')
+        if not starts:
+            return
+        dt = time.time() - starts.pop()
+        rows = cursor.rowcount if cursor.rowcount is not None and cursor.rowcount >= 0 else 0
+        n_exec = len(parameters) if executemany else 1
+        key = (normalize_sql(statement), call_site())
+
+        with self.lock:
+            self.n_queries += n_exec
+            self.total_time += dt
+            stats = self.patterns.get(key)
+            if stats is None:
+                stats = {'sql': key[0], 'site': key[1], 'count': 0, 'total_time': 0.0, 'max_time': 0.0, 'rows': 0}
+                self.patterns[key] = stats
+            stats['count'] += n_exec
+            stats['total_time'] += dt
+            stats['max_time'] = max(stats['max_time'], dt)
+            stats['rows'] += rows
+
+            if dt > self.slow_threshold:
+                self.slow.append({'sql': ' '.join(statement.split()), 'site': key[1], 'time': dt, 'rows': rows})
+                self.slow.sort(key=lambda s: s['time'], reverse=True)
+                del self.slow[self.max_slow:]
+
+    def summary(self, n_patterns=20):
+        """Return a JSON-serializable summary of all statements recorded so far.
+
+        The summary includes the *n_patterns* statement patterns with the largest total time,
+        all patterns that were repeated at least repeat_threshold times from one call site,
+        and the slowest individual statements.
+        """
+        with self.lock:
+            patterns = sorted(self.patterns.values(), key=lambda p: p['total_time'], reverse=True)
+            repeated = [p for p in patterns if p['count'] >= self.repeat_threshold]
+            return {
+                'n_queries': self.n_queries,
+                'query_time': self.total_time,
+                'wall_time': time.time() - self.start_time,
+                'n_patterns': len(patterns),
+                'patterns': [dict(p) for p in patterns[:n_patterns]],
+                'repeated': sorted([dict(p) for p in repeated], key=lambda p: p['count'], reverse=True),
+                'slow': [dict(s) for s in self.slow],
+            }
+
+    def report(self, n_patterns=10):
+        """Return a human-readable report of the most expensive and most repeated statements.
+        """
+        return format_summary(self.summary(n_patterns=n_patterns), n_patterns=n_patterns)
+
+
+def merge_summaries(summaries):
+    """Combine summaries from many jobs (see QueryMonitor.summary) into one.
+
+    Patterns are matched by SQL and call site; the result lists all patterns, sorted by total time.
+    """
+    repeated = set()
+    total = {'n_queries': 0, 'query_time': 0.0, 'wall_time': 0.0, 'slow': []}
+    acc = OrderedDict()
+    for summ in summaries:
+        for k in ('n_queries', 'query_time', 'wall_time'):
+            total[k] += summ[k]
+        total['slow'].extend(summ['slow'])
+        for p in summ['repeated']:
+            repeated.add((p['sql'], p['site']))
+
+        # patterns may appear in both lists of the same summary
+        seen = set()
+        for p in summ['patterns'] + summ['repeated']:
+            key = (p['sql'], p['site'])
+            if key in seen:
+                continue
+            seen.add(key)
+            if key not in acc:
+                acc[key] = {'sql': p['sql'], 'site': p['site'], 'count': 0, 'total_time': 0.0, 'max_time': 0.0, 'rows': 0}
+            a = acc[key]
+            a['count'] += p['count']
+            a['total_time'] += p['total_time']
+            a['max_time'] = max(a['max_time'], p['max_time'])
+            a['rows'] += p['rows']
+
+    patterns = sorted(acc.values(), key=lambda p: p['total_time'], reverse=True)
+    total['patterns'] = patterns
+    total['n_patterns'] = len(patterns)
+    total['repeated'] = sorted([p for p in patterns if (p['sql'], p['site']) in repeated], key=lambda p: p['count'], reverse=True)
+    total['slow'].sort(key=lambda s: s['time'], reverse=True)
+    return total
+
+
+def format_summary(summary, n_patterns=10, max_sql=200):
+    """Format a summary returned by QueryMonitor.summary or merge_summaries as text.
+    """
+    def sql(s):
+        return s if len(s) <= max_sql else s[:max_sql] + '...'
+
+    lines = ["%d queries in %0.2f sec (%0.1f%% of %0.2f sec wall time), %d distinct patterns" % (
+        summary['n_queries'], summary['query_time'], 100 * summary['query_time'] / max(summary['wall_time'], 1e-9),
+        summary['wall_time'], summary['n_patterns'])]
+
+    lines.append("---- Most expensive statement patterns ----")
+    for p in summary['patterns'][:n_patterns]:
+        lines.append("  %8.3f sec  %6d calls  %8d rows  %s" % (p['total_time'], p['count'], p['rows'], p['site']))
+        lines.append("      " + sql(p['sql']))
+
+    if len(summary['repeated']) > 0:
+        lines.append("---- Repeated statements (possible N+1 queries) ----")
+        for p in summary['repeated'][:n_patterns]:
+            lines.append("  %6d calls  %8.3f sec  %s" % (p['count'], p['total_time'], p['site']))
+            lines.append("      " + sql(p['sql']))
+
+    if len(summary['slow']) > 0:
+        lines.append("---- Slowest statements ----")
+        for s in summary['slow'][:n_patterns]:
+            lines.append("  %8.3f sec  %8d rows  %s" % (s['time'], s['rows'], s['site']))
+            lines.append("      " + sql(s['sql']))
+
+    return '\n'.join(lines)
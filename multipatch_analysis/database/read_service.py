@@ -0,0 +1,490 @@
+"""
+Local service that multiplexes common read operations for many clients.
+
+Analysis scripts and GUI tools normally each open their own engine with its own
+connection pool. A ReadServer instead runs the common read operations (see `ops`)
+on behalf of all local clients through a single, bounded connection pool, and keeps
+a shared in-memory cache of encoded results. Cached results are invalidated whenever
+the pipeline modules that own the tables involved have run or dropped a job (the
+same rule used by query_cache).
+
+Results are structured numpy arrays (as returned by fetch_array), sent over TCP in a
+compact binary format: numeric fields as raw little-endian buffers, array-valued
+fields as one concatenated buffer plus lengths, and only the remaining object fields
+as JSON.
+
+Start the service with::
+
+    python util/read_service.py
+
+and set config.read_service_address (for example "127.0.0.1:25430"). Clients then
+use the functions in this module::
+
+    from multipatch_analysis.database import read_service
+    pairs = read_service.get_pairs(project_name='mouse V1 coarse matrix')
+    prs = read_service.get_pulse_responses(pairs['pair_id'][0])
+
+If the service is not configured or not reachable, these functions read directly
+from the database instead.
+"""
+from __future__ import division, print_function
+
+import json, time, socket, struct, threading, datetime
+from collections import OrderedDict
+import numpy as np
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+import sqlalchemy
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from .. import config
+from . import database
+from .database import fetch_array
+
+
+# ------------------------- operations -------------------------
+
+# {name: (function(session, **args), [names of tables read])}
+ops = OrderedDict()
+
+def read_op(name, tables):
+    """Decorator registering a read operation that may be served by a ReadServer.
+
+    The decorated function is called as ``fn(session, **args)`` and must return a
+    numpy structured array. *tables* lists the tables read by the operation (used
+    to decide when cached results become invalid).
+    """
+    def register(fn):
+        ops[name] = (fn, tables)
+        return fn
+    return register
+
+
+@read_op('pairs', tables=['pair_summary'])
+def _pairs(session, **filters):
+    from . import PairSummary
+    from ..connectivity import query_pair_summary
+    q = query_pair_summary(session=session, **filters).order_by(PairSummary.pair_id)
+    return fetch_array(q, session=session)
+
+
+@read_op('pulse_responses', tables=['pulse_response', 'pulse_response_strength', 'patch_clamp_recording'])
+def _pulse_responses(session, pair_id, clamp_mode=None, data=True):
+    from . import PulseResponse, PulseResponseStrength, PatchClampRecording, Recording, load_snippet_data
+    cols = [
+        PulseResponse.id,
+        PulseResponse.stim_pulse_id,
+        PulseResponse.start_time,
+        PulseResponse.ex_qc_pass,
+        PulseResponse.in_qc_pass,
+        PatchClampRecording.clamp_mode,
+        PulseResponseStrength.pos_amp,
+        PulseResponseStrength.neg_amp,
+        PulseResponseStrength.pos_dec_amp,
+        PulseResponseStrength.neg_dec_amp,
+        PulseResponseStrength.pos_dec_latency,
+        PulseResponseStrength.neg_dec_latency,
+        PulseResponseStrength.crosstalk,
+    ]
+    if data:
+        cols.append(PulseResponse.data)
+    q = session.query(*cols).select_from(PulseResponse)
+    q = q.join(Recording, PulseResponse.recording).join(PatchClampRecording)
+    q = q.outerjoin(PulseResponseStrength, PulseResponseStrength.pulse_response_id==PulseResponse.id)
+    q = q.filter(PulseResponse.pair_id==pair_id)
+    if clamp_mode is not None:
+        q = q.filter(PatchClampRecording.clamp_mode==clamp_mode)
+    recs = fetch_array(q.order_by(PulseResponse.id), session=session)
+    if data:
+        # fill in responses that are stored as slices of their recording
+        missing = [i for i in range(len(recs)) if recs['data'][i] is None]
+        snippets = load_snippet_data(session, PulseResponse, [int(recs['id'][i]) for i in missing])
+        for i in missing:
+            recs['data'][i] = snippets[recs['id'][i]]
+    return recs
+
+
+@read_op('connection_strength', tables=['connection_strength'])
+def _connection_strength(session, pair_ids):
+    table = database.ORMBase.metadata.tables['connection_strength']
+    pair_ids = [int(i) for i in pair_ids]
+    parts = []
+    for i in range(0, max(len(pair_ids), 1), 1000):
+        q = sqlalchemy.select([table]).where(table.c.pair_id.in_(pair_ids[i:i+1000])).order_by(table.c.pair_id)
+        parts.append(fetch_array(q, session=session))
+    return parts[0] if len(parts) == 1 else np.concatenate(parts)
+
+
+def get_pairs(**filters):
+    """Return pair_summary records for pairs with connection strength results.
+
+    Accepts the same filter arguments as connectivity.query_pair_summary().
+    """
+    return call('pairs', **filters)
+
+
+def get_pulse_responses(pair_id, clamp_mode=None, data=True):
+    """Return all pulse responses for a pair, with their strength measurements and (optionally) data arrays.
+    """
+    return call('pulse_responses', pair_id=int(pair_id), clamp_mode=clamp_mode, data=data)
+
+
+def get_connection_strength(pair_ids):
+    """Return connection_strength records for a list of pair IDs.
+    """
+    return call('connection_strength', pair_ids=[int(i) for i in pair_ids])
+
+
+# ------------------------- encoding -------------------------
+
+class ReadServiceError(Exception):
+    """Raised when the read service reports an error while processing a request.
+    """
+
+
+class ServiceUnavailable(Exception):
+    """Raised when the read service cannot be reached.
+    """
+
+
+def _json_value(v):
+    if isinstance(v, np.generic):
+        return v.item()
+    if isinstance(v, (datetime.datetime, datetime.date)):
+        return v.isoformat()
+    return v
+
+
+def encode_array(arr):
+    """Encode a structured array as (header, body) where header is JSON-serializable and body is bytes.
+    """
+    fields = []
+    chunks = []
+    for name in arr.dtype.names:
+        col = arr[name]
+        if col.dtype.kind != 'O':
+            buf = np.ascontiguousarray(col).astype(col.dtype.newbyteorder('<'), copy=False).tobytes()
+            fields.append({'name': name, 'kind': 'raw', 'dtype': col.dtype.newbyteorder('<').str, 'nbytes': len(buf)})
+            chunks.append(buf)
+            continue
+
+        values = [v for v in col if v is not None]
+        if len(values) > 0 and all(isinstance(v, np.ndarray) and v.dtype.kind in 'biuf' for v in values):
+            # arrays are concatenated into one buffer; shapes are sent in the header
+            dtype = np.result_type(*[v.dtype for v in values]).newbyteorder('<')
+            shapes = [None if v is None else list(v.shape) for v in col]
+            buf = b''.join([np.ascontiguousarray(v, dtype=dtype).tobytes() for v in values])
+            fields.append({'name': name, 'kind': 'arrays', 'dtype': dtype.str, 'shapes': shapes, 'nbytes': len(buf)})
+            chunks.append(buf)
+        else:
+            buf = json.dumps([_json_value(v) for v in col]).encode('utf8')
+            fields.append({'name': name, 'kind': 'json', 'nbytes': len(buf)})
+            chunks.append(buf)
+    return {'n': len(arr), 'fields': fields}, b''.join(chunks)
+
+
+def decode_array(header, body):
+    """Decode a structured array from (header, body) generated by encode_array.
+    """
+    n = header['n']
+    dtype = []
+    columns = []
+    offset = 0
+    for field in header['fields']:
+        buf = body[offset:offset+field['nbytes']]
+        offset += field['nbytes']
+        if field['kind'] == 'raw':
+            col = np.frombuffer(buf, dtype=field['dtype']).copy()
+            dtype.append((field['name'], col.dtype))
+        elif field['kind'] == 'arrays':
+            data = np.frombuffer(buf, dtype=field['dtype'])
+            col = np.empty(n, dtype=object)
+            i = 0
+            for j,shape in enumerate(field['shapes']):
+                if shape is None:
+                    continue
+                size = int(np.prod(shape))
+                col[j] = data[i:i+size].reshape(shape).copy()
+                i += size
+            dtype.append((field['name'], object))
+        else:
+            col = np.empty(n, dtype=object)
+            for j,v in enumerate(json.loads(buf.decode('utf8'))):
+                col[j] = v
+            dtype.append((field['name'], object))
+        columns.append(col)
+    arr = np.empty(n, dtype=dtype)
+    for (name, _), col in zip(dtype, columns):
+        arr[name] = col
+    return arr
+
+
+def send_message(sock, header, body=b''):
+    """Send one message: 8-byte total length, 4-byte header length, JSON header, binary body.
+    """
+    head = json.dumps(header).encode('utf8')
+    sock.sendall(struct.pack('<QI', 4 + len(head) + len(body), len(head)) + head + body)
+
+
+def _recv_exact(sock, n):
+    chunks = []
+    while n > 0:
+        chunk = sock.recv(min(n, 4*1024**2))
+        if len(chunk) == 0:
+            raise EOFError("Connection closed")
+        chunks.append(chunk)
+        n -= len(chunk)
+    return b''.join(chunks)
+
+
+def recv_message(sock):
+    """Receive one message sent by send_message; return (header, body).
+    """
+    total, head_len = struct.unpack('<QI', _recv_exact(sock, 12))
+    msg = _recv_exact(sock, total - 4)
+    return json.loads(msg[:head_len].decode('utf8')), msg[head_len:]
+
+
+# ------------------------- server -------------------------
+
+class ResultCache(object):
+    """Thread-safe LRU cache of encoded results, limited by total size in bytes.
+    """
+    def __init__(self, max_bytes=512*1024**2):
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.nbytes = 0
+
+    def get(self, key, state):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                return None
+            if entry[0] != state:
+                self.nbytes -= len(entry[2])
+                return None
+            self.entries[key] = entry
+            return entry[1], entry[2]
+
+    def set(self, key, state, header, body):
+        if len(body) > self.max_bytes:
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.nbytes -= len(old[2])
+            self.entries[key] = (state, header, body)
+            self.nbytes += len(body)
+            while self.nbytes > self.max_bytes:
+                _, (_, _, old_body) = self.entries.popitem(last=False)
+                self.nbytes -= len(old_body)
+
+
+class _RequestHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        # each client connection may send many requests
+        while True:
+            try:
+                request, _ = recv_message(self.request)
+            except (EOFError, socket.error):
+                return
+            try:
+                header, body = self.server.read_service.handle_request(request['op'], request.get('args', {}))
+            except Exception as exc:
+                self.server.read_service.stats['errors'] += 1
+                header, body = {'status': 'error', 'error': '%s: %s' % (type(exc).__name__, exc)}, b''
+            try:
+                send_message(self.request, header, body)
+            except socket.error:
+                return
+
+
+class _ThreadingTCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class ReadServer(object):
+    """Serves read operations (see `ops`) to local clients over TCP.
+
+    Parameters
+    ----------
+    address : (host, port)
+        Address to listen on. Use port 0 to pick any free port (see `address` attribute).
+    pool_size : int
+        Maximum number of database connections used to serve all clients.
+    cache_bytes : int
+        Maximum total size of cached results.
+    state_interval : float
+        Minimum interval (seconds) between checks of pipeline state used to invalidate
+        cached results.
+    ops : dict | None
+        Operations to serve (default is the module-level `ops` registry).
+    state_fn : callable | None
+        Function ``state_fn(session, tables)`` returning a value that changes whenever
+        *tables* change (default uses query_cache.table_state).
+    """
+    def __init__(self, address=('127.0.0.1', 25430), pool_size=5, cache_bytes=512*1024**2, state_interval=10.0, ops=None, state_fn=None):
+        self.ops = globals()['ops'] if ops is None else ops
+        if state_fn is None:
+            from .query_cache import table_state
+            state_fn = table_state
+        self.state_fn = state_fn
+        self.state_interval = state_interval
+        self._states = {}
+        self._state_lock = threading.Lock()
+        self.cache = ResultCache(cache_bytes)
+        self.stats = {'requests': 0, 'cache_hits': 0, 'errors': 0}
+
+        # one bounded pool shared by all clients
+        if database.db_address_ro.startswith('postgres'):
+            self.engine = create_engine(database.db_address_ro, pool_size=pool_size, max_overflow=0, pool_timeout=600, isolation_level='AUTOCOMMIT')
+        elif database.db_address_ro.startswith('sqlite'):
+            self.engine = database.sqlite_engine(database.db_address_ro, readonly=True, pool_size=pool_size, open_readonly=True)
+        else:
+            self.engine = create_engine(database.db_address_ro)
+        self.sessionmaker = sessionmaker(bind=self.engine)
+
+        self.server = _ThreadingTCPServer(tuple(address), _RequestHandler)
+        self.server.read_service = self
+        self.address = self.server.server_address
+        self.thread = None
+        self.serving = False
+
+    def table_state(self, tables):
+        """Return (possibly slightly stale) pipeline state for *tables*.
+        """
+        key = tuple(sorted(tables))
+        now = time.time()
+        with self._state_lock:
+            cached = self._states.get(key)
+            if cached is not None and now - cached[0] < self.state_interval:
+                return cached[1]
+        session = self.sessionmaker()
+        try:
+            state = self.state_fn(session, list(key))
+        finally:
+            session.close()
+        with self._state_lock:
+            self._states[key] = (now, state)
+        return state
+
+    def handle_request(self, op, args):
+        """Run a single operation and return (header, body) to be sent to the client.
+        """
+        self.stats['requests'] += 1
+        if op not in self.ops:
+            raise ValueError("Unknown read operation %r" % op)
+        fn, tables = self.ops[op]
+
+        key = json.dumps([op, args], sort_keys=True)
+        state = self.table_state(tables)
+        if state is not None:
+            cached = self.cache.get(key, state)
+            if cached is not None:
+                self.stats['cache_hits'] += 1
+                return cached
+
+        session = self.sessionmaker()
+        try:
+            result = fn(session, **args)
+        finally:
+            session.close()
+        table_header, body = encode_array(result)
+        header = {'status': 'ok', 'result': table_header}
+        if state is not None:
+            self.cache.set(key, state, header, body)
+        return header, body
+
+    def start(self):
+        """Start serving in a background thread.
+        """
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def serve_forever(self):
+        self.serving = True
+        try:
+            self.server.serve_forever()
+        finally:
+            self.serving = False
+
+    def stop(self):
+        if self.serving:
+            self.server.shutdown()
+        self.server.server_close()
+        self.engine.dispose()
+
+
+# ------------------------- client -------------------------
+
+def parse_address(address):
+    host, _, port = address.rpartition(':')
+    return (host or '127.0.0.1', int(port))
+
+
+class ReadClient(object):
+    """Client for a ReadServer. A single connection is kept open and reused for all requests.
+    """
+    def __init__(self, address, timeout=600):
+        if isinstance(address, (str, type(u''))):
+            address = parse_address(address)
+        self.address = tuple(address)
+        self.timeout = timeout
+        self.sock = None
+        self.lock = threading.Lock()
+
+    def call(self, op, **args):
+        with self.lock:
+            if self.sock is None:
+                try:
+                    self.sock = socket.create_connection(self.address, timeout=self.timeout)
+                except socket.error as exc:
+                    raise ServiceUnavailable("Could not connect to read service at %s:%d (%s)" % (self.address + (exc,)))
+            try:
+                send_message(self.sock, {'op': op, 'args': args})
+                header, body = recv_message(self.sock)
+            except (socket.error, EOFError) as exc:
+                self.close()
+                raise ServiceUnavailable("Lost connection to read service at %s:%d (%s)" % (self.address + (exc,)))
+
+        if header['status'] != 'ok':
+            raise ReadServiceError(header['error'])
+        return decode_array(header['result'], body)
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+
+_client = None
+_unavailable_until = 0
+def call(op, **args):
+    """Run a read operation through the read service if it is configured and reachable,
+    otherwise directly against the database.
+    """
+    global _client, _unavailable_until
+    address = config.read_service_address
+    if address is not None and time.time() > _unavailable_until:
+        if _client is None or _client.address != parse_address(address):
+            _client = ReadClient(address)
+        try:
+            return _client.call(op, **args)
+        except ServiceUnavailable:
+            # don't try the service again for a while
+            _unavailable_until = time.time() + 30
+
+    fn, tables = ops[op]
+    session = database.Session()
+    try:
+        return fn(session, **args)
+    finally:
+        session.close()
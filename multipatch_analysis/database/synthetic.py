@@ -0,0 +1,509 @@
+"""
+Generate synthetic experiments for load testing.
+
+Fills a database with realistic-looking records--slices, experiments, electrodes, cells,
+pairs, sync recordings, stimulus pulses and spikes, pulse responses and baselines with
+PSP-shaped data arrays, strength measurements, connection strength results, and the
+pipeline records for each of these stages--so that schema changes, pipeline stages,
+bake_sqlite and analysis queries can be measured at data volumes we do not have yet.
+
+Records are written with bulk inserts and explicitly allocated ids, so generation is
+limited mainly by the database write speed. Example::
+
+    from multipatch_analysis.database import synthetic
+    session = db.Session(readonly=False)
+    synthetic.SyntheticDataGenerator(session, seed=0).generate(n_experiments=500)
+
+Generated experiments all belong to the project "synthetic" (by default) and have no
+files on disk, so only purely database-driven pipeline stages (pulse_response,
+connection_strength, dynamics, pair_summary, ..) can be re-run on them.
+
+See also util/synthetic_db.py.
+"""
+from __future__ import division, print_function
+
+import sys, time
+from datetime import datetime, timedelta
+from collections import OrderedDict
+import numpy as np
+import sqlalchemy
+
+from .. import config
+from .database import ORMBase, JSONObject, default_sample_rate
+
+
+cre_types = [
+    # (cre type, layer, excitatory)
+    ('unknown', '2/3', True),
+    ('rorb', '4', True),
+    ('nr5a1', '4', True),
+    ('sim1', '5', True),
+    ('tlx3', '5', True),
+    ('ntsr1', '6', True),
+    ('pvalb', '2/3', False),
+    ('pvalb', '5', False),
+    ('sst', '2/3', False),
+    ('sst', '5', False),
+    ('vip', '2/3', False),
+]
+
+genotypes = [
+    'Pvalb-IRES-Cre/wt;Ai14(RCL-tdT)/wt',
+    'Sst-IRES-Cre/wt;Ai14(RCL-tdT)/wt',
+    'Vip-IRES-Cre/wt;Ai14(RCL-tdT)/wt',
+    'Tlx3-Cre_PL56/wt;Ai14(RCL-tdT)/wt',
+    'Ntsr1-Cre_GN220/wt;Ai14(RCL-tdT)/wt',
+]
+
+induction_frequencies = [10., 20., 50., 100., 200.]
+
+
+def psp_shape(t, rise_time, decay_tau):
+    """Return a PSP-like waveform (difference of exponentials) with unit peak, starting at t=0.
+    """
+    t = np.clip(t, 0, None)
+    rise_tau = rise_time / 2.
+    y = np.exp(-t / decay_tau) - np.exp(-t / rise_tau)
+    peak = y.max()
+    return y / peak if peak > 0 else y
+
+
+class SyntheticDataGenerator(object):
+    """Adds synthetic experiments to a database.
+
+    Parameters
+    ----------
+    session : Session
+        Read-write session used for all inserts.
+    seed : int
+        Random seed; the same seed and parameters always generate the same records
+        (apart from database ids and timestamps).
+    n_cells : int
+        Number of patched cells per experiment; every ordered pair of cells is probed.
+    n_sweeps : int
+        Number of sync recordings per experiment. Each sweep stimulates one cell (in turn)
+        and records from all others; the first half of sweeps is recorded in current clamp
+        and the second half in voltage clamp.
+    n_pulses : int
+        Number of presynaptic pulses per sweep (8-pulse induction train followed by a
+        recovery train).
+    connection_probability : float
+        Probability that any pair has a chemical synapse.
+    response_duration : float
+        Duration (s) of each pulse response snippet.
+    n_baselines : int
+        Number of baseline snippets per recording.
+    store_recording_data : bool | None
+        If True, full recordings are stored and snippets only reference them by index
+        (see config.store_recording_data, which is the default).
+    project_name : str
+        Project name assigned to all generated experiments.
+    """
+    def __init__(self, session, seed=0, n_cells=8, n_sweeps=24, n_pulses=12, connection_probability=0.15,
+                 response_duration=50e-3, n_baselines=4, store_recording_data=None, project_name='synthetic'):
+        self.session = session
+        self.rng = np.random.RandomState(seed)
+        self.n_cells = n_cells
+        self.n_sweeps = n_sweeps
+        self.n_pulses = n_pulses
+        self.connection_probability = connection_probability
+        self.response_duration = response_duration
+        self.n_baselines = n_baselines
+        self.store_recording_data = config.store_recording_data if store_recording_data is None else store_recording_data
+        self.project_name = project_name
+        self.sample_rate = default_sample_rate
+        self.tables = ORMBase.metadata.tables
+
+        # allocate ids ourselves so that rows can be inserted in bulk
+        self._next_id = {}
+        self._rows = OrderedDict()
+
+    def generate(self, n_experiments, commit_every=10):
+        """Add *n_experiments* new experiments and return their acq_timestamps.
+        """
+        first_ms = int(round(self._first_timestamp() * 1000))
+        timestamps = []
+        start = time.time()
+        for i in range(n_experiments):
+            # experiments are spaced by ~1 hour, with millisecond-resolution fractional parts like real data.
+            # Each timestamp is computed from an integer number of milliseconds so that rounding
+            # errors do not accumulate.
+            ts = (first_ms + (i + 1) * 3600000 + self.rng.randint(0, 100000)) / 1000.
+            self.add_experiment(ts)
+            timestamps.append(ts)
+            if (i + 1) % commit_every == 0 or i == n_experiments - 1:
+                self.flush()
+                self.session.commit()
+            print("Generated %d/%d experiments  (%0.1f sec)\r" % (i + 1, n_experiments, time.time() - start), end='')
+            sys.stdout.flush()
+        print("")
+        return timestamps
+
+    def _first_timestamp(self):
+        expt = self.tables['experiment']
+        last = self.session.execute(sqlalchemy.select([sqlalchemy.func.max(expt.c.acq_timestamp)])).scalar()
+        return 1.5e9 if last is None else np.ceil(last)
+
+    def new_id(self, table):
+        if table not in self._next_id:
+            col = self.tables[table].c.id
+            last = self.session.execute(sqlalchemy.select([sqlalchemy.func.max(col)])).scalar()
+            self._next_id[table] = (last or 0) + 1
+        i = self._next_id[table]
+        self._next_id[table] += 1
+        return i
+
+    def add_row(self, table, **values):
+        """Queue a row for insertion and return its id.
+        """
+        values['id'] = self.new_id(table)
+        self._rows.setdefault(table, []).append(values)
+        return values['id']
+
+    def flush(self):
+        """Insert all queued rows, one bulk insert per table (in dependency order).
+        """
+        for table in ORMBase.metadata.sorted_tables:
+            rows = self._rows.pop(table.name, None)
+            if not rows:
+                continue
+            # executemany requires the same keys in every row. JSON columns are always included
+            # so they are stored as 'null' like ORM inserts (a SQL NULL cannot be decoded).
+            keys = set([col.name for col in table.columns if isinstance(col.type, JSONObject)])
+            for row in rows:
+                keys.update(row.keys())
+            rows = [dict([(k, row.get(k)) for k in keys]) for row in rows]
+            for i in range(0, len(rows), 1000):
+                self.session.execute(table.insert(), rows[i:i+1000])
+
+    def add_pipeline_job(self, module_name, job_id):
+        self.add_row('pipeline', module_name=module_name, job_id=job_id, success=True, finish_time=datetime.now())
+
+    def add_experiment(self, ts):
+        rng = self.rng
+        date = datetime.fromtimestamp(ts)
+
+        slice_ts = ts - 1800
+        slice_id = self.add_row('slice',
+            acq_timestamp=slice_ts,
+            species='mouse',
+            age=int(rng.randint(40, 80)),
+            sex=['M', 'F'][rng.randint(2)],
+            weight='%d g' % rng.randint(15, 30),
+            genotype=genotypes[rng.randint(len(genotypes))],
+            orientation='coronal',
+            surface='medial',
+            hemisphere=['left', 'right'][rng.randint(2)],
+            quality=int(rng.randint(1, 6)),
+            slice_time=date - timedelta(hours=2),
+            storage_path='synthetic/%0.3f' % slice_ts,
+        )
+        expt_id = self.add_row('experiment',
+            storage_path='synthetic/%0.3f/site_000' % slice_ts,
+            rig_name='MP%d' % rng.randint(1, 4),
+            project_name=self.project_name,
+            acq_timestamp=ts,
+            slice_id=slice_id,
+            target_region='VisP',
+            internal='Standard K-Gluc',
+            acsf='1.3mM Ca & 1mM Mg',
+            target_temperature=float(rng.choice([25., 34.])),
+            date=date,
+        )
+
+        cells = []
+        for i in range(self.n_cells):
+            elec_id = self.add_row('electrode',
+                experiment_id=expt_id,
+                ext_id=i + 1,
+                device_id=i,
+                patch_status='cell attached',
+                start_time=date,
+                initial_resistance=rng.uniform(3e6, 8e6),
+            )
+            cre_type, layer, excitatory = cre_types[rng.randint(len(cre_types))]
+            cell_id = self.add_row('cell',
+                experiment_id=expt_id,
+                electrode_id=elec_id,
+                ext_id=i + 1,
+                cre_type=cre_type,
+                target_layer=layer,
+                is_excitatory=excitatory,
+                synapse_sign=1 if excitatory else -1,
+                depth=rng.uniform(20e-6, 80e-6),
+            )
+            cells.append({'id': cell_id, 'electrode_id': elec_id, 'excitatory': excitatory})
+
+        # all ordered pairs are probed; synapse parameters are chosen per pair
+        pairs = {}
+        for i, pre in enumerate(cells):
+            for j, post in enumerate(cells):
+                if i == j:
+                    continue
+                synapse = bool(rng.uniform() < self.connection_probability)
+                sign = 1 if pre['excitatory'] else -1
+                pair = {
+                    'synapse': synapse,
+                    'sign': sign,
+                    'amp': sign * rng.lognormal(np.log(0.5e-3), 0.6) if synapse else 0.,
+                    'latency': rng.uniform(1e-3, 2e-3),
+                    'rise_time': rng.uniform(1e-3, 3e-3),
+                    'decay_tau': rng.uniform(10e-3, 40e-3),
+                    'stp': rng.uniform(-0.3, 0.2),   # per-pulse facilitation (>0) / depression (<0)
+                    'n_ex': 0,
+                    'n_in': 0,
+                    'ic': [], 'vc': [],      # (pos_amp, neg_amp, latency, data) for connection strength
+                }
+                pair['id'] = self.add_row('pair',
+                    experiment_id=expt_id,
+                    pre_cell_id=pre['id'],
+                    post_cell_id=post['id'],
+                    synapse=synapse,
+                    electrical=bool(rng.uniform() < 0.02),
+                    crosstalk_artifact=None,
+                    synapse_sign=sign if synapse else None,
+                    distance=rng.uniform(20e-6, 200e-6),
+                )
+                pair['row'] = self._rows['pair'][-1]
+                pairs[(i, j)] = pair
+
+        base_stats = {'ic': [], 'vc': []}
+        for sweep in range(self.n_sweeps):
+            self.add_sweep(expt_id, date, sweep, cells, pairs, base_stats)
+
+        for pair in pairs.values():
+            self.add_connection_strength(pair, base_stats)
+
+        # (these are counted by the dataset stage)
+        for pair in pairs.values():
+            pair['row']['n_ex_test_spikes'] = pair['n_ex']
+            pair['row']['n_in_test_spikes'] = pair['n_in']
+
+        self.add_pipeline_job('slice', slice_ts)
+        for module in ('experiment', 'dataset', 'pulse_response', 'connection_strength'):
+            self.add_pipeline_job(module, ts)
+
+    def add_sweep(self, expt_id, date, sweep, cells, pairs, base_stats):
+        rng = self.rng
+        dt = 1. / self.sample_rate
+        pre_index = sweep % len(cells)
+        clamp_mode = 'ic' if sweep < self.n_sweeps // 2 else 'vc'
+        freq = induction_frequencies[(sweep // len(cells)) % len(induction_frequencies)]
+        rec_delay = 250e-3
+
+        # pulse times: 8-pulse induction train, then a recovery train. Onsets are whole sample
+        # indices, and all times are computed as index * dt rather than by adding offsets.
+        n_ind = min(8, self.n_pulses)
+        onset_index = [self._samples(0.1 + k / freq) for k in range(n_ind)]
+        rec_start = onset_index[-1] + self._samples(rec_delay)
+        onset_index += [rec_start + self._samples(k / freq) for k in range(self.n_pulses - n_ind)]
+        onsets = [i * dt for i in onset_index]
+        duration = onsets[-1] + self.response_duration + 0.1
+        n_samples = int(duration * self.sample_rate)
+        t = np.arange(n_samples) * dt
+        spike_times = [onset + rng.uniform(0.8e-3, 1.5e-3) for onset in onsets]
+
+        srec_id = self.add_row('sync_rec', experiment_id=expt_id, ext_id=str(sweep), temperature=rng.uniform(32, 35))
+        start_time = date + timedelta(seconds=sweep * 20)
+
+        for i, cell in enumerate(cells):
+            mode = 'ic' if i == pre_index else clamp_mode
+            # baseline potential (V) in current clamp, holding current (A) in voltage clamp
+            if mode == 'ic':
+                offset, noise = rng.normal(-70e-3, 3e-3), 0.1e-3
+            else:
+                offset, noise = rng.normal(-50e-12, 20e-12), 5e-12
+            trace = offset + rng.normal(scale=noise, size=n_samples)
+
+            if i == pre_index:
+                for onset, spike in zip(onsets, spike_times):
+                    trace += 100e-3 * np.exp(-((t - spike) / 0.5e-3)**2)
+            else:
+                pair = pairs[(pre_index, i)]
+                if pair['synapse']:
+                    for k, spike in enumerate(spike_times):
+                        scale = max(0.05, 1 + pair['stp'] * min(k, n_ind - 1))
+                        amp = pair['amp'] * scale * (1 if mode == 'ic' else -40e-9)
+                        trace += amp * psp_shape(t - spike - pair['latency'], pair['rise_time'], pair['decay_tau'])
+
+            rec_id = self.add_row('recording',
+                sync_rec_id=srec_id,
+                electrode_id=cell['electrode_id'],
+                start_time=start_time,
+                sample_rate=self.sample_rate,
+                data=trace.astype('float32') if self.store_recording_data else None,
+                data_start_time=0.,
+            )
+            pcr_id = self.add_row('patch_clamp_recording',
+                recording_id=rec_id,
+                clamp_mode=mode,
+                patch_mode='whole cell',
+                stim_name='PulseTrain_%dHz_DA_0' % freq,
+                baseline_potential=offset if mode == 'ic' else -70e-3,
+                baseline_current=offset if mode == 'vc' else 0.,
+                baseline_rms_noise=noise,
+                qc_pass=bool(rng.uniform() < 0.95),
+            )
+            self.add_row('multi_patch_probe',
+                patch_clamp_recording_id=pcr_id,
+                induction_frequency=freq,
+                recovery_delay=rec_delay,
+                n_spikes_evoked=len(onsets) if i == pre_index else 0,
+            )
+            cell['rec'] = (rec_id, trace, mode)
+
+            if i == pre_index:
+                continue
+            # baseline snippets from the quiet period before the first pulse
+            for k in range(self.n_baselines):
+                start = int(rng.uniform(0, 0.1 - 20e-3) * self.sample_rate)
+                stop = start + self._samples(20e-3)
+                data = trace[start:stop]
+                base_id = self.add_row('baseline',
+                    experiment_id=expt_id,
+                    recording_id=rec_id,
+                    start_time=start * dt,
+                    mode=float(np.median(data)),
+                    ex_qc_pass=True,
+                    in_qc_pass=True,
+                    **self._snippet(trace, start, stop)
+                )
+                strength = self._strength(data, self._samples(10e-3), mode)
+                self.add_row('baseline_response_strength', experiment_id=expt_id, baseline_id=base_id, **strength)
+                base_stats[mode].append(strength)
+
+        pre_rec_id, pre_trace, _ = cells[pre_index]['rec']
+        pre_window = self._samples(10e-3)
+        for k, (onset, spike) in enumerate(zip(onsets, spike_times)):
+            start = onset_index[k] - pre_window
+            stop = onset_index[k] + pre_window
+            pulse_id = self.add_row('stim_pulse',
+                experiment_id=expt_id,
+                recording_id=pre_rec_id,
+                pulse_number=k + 1,
+                onset_time=onset,
+                next_pulse_time=onsets[k+1] if k + 1 < len(onsets) else None,
+                amplitude=1.5e-9,
+                duration=2e-3,
+                n_spikes=1,
+                data_start_time=start * dt,
+                **self._snippet(pre_trace, start, stop)
+            )
+            self.add_row('stim_spike',
+                experiment_id=expt_id,
+                stim_pulse_id=pulse_id,
+                max_dvdt_time=spike,
+                max_dvdt=rng.uniform(100, 300),
+                peak_time=spike + 0.5e-3,
+                peak_diff=rng.uniform(80e-3, 110e-3),
+                peak_val=rng.uniform(10e-3, 30e-3),
+            )
+
+            for i, cell in enumerate(cells):
+                if i == pre_index:
+                    continue
+                rec_id, trace, mode = cell['rec']
+                pair = pairs[(pre_index, i)]
+                start = onset_index[k] - pre_window
+                stop = start + self._samples(self.response_duration)
+                ex_qc = bool(rng.uniform() < 0.9)
+                in_qc = bool(rng.uniform() < 0.9)
+                pair['n_ex'] += ex_qc
+                pair['n_in'] += in_qc
+                pr_id = self.add_row('pulse_response',
+                    experiment_id=expt_id,
+                    recording_id=rec_id,
+                    stim_pulse_id=pulse_id,
+                    pair_id=pair['id'],
+                    start_time=start * dt,
+                    ex_qc_pass=ex_qc,
+                    in_qc_pass=in_qc,
+                    **self._snippet(trace, start, stop)
+                )
+                data = trace[start:stop]
+                strength = self._strength(data, pre_window, mode)
+                self.add_row('pulse_response_strength', experiment_id=expt_id, pulse_response_id=pr_id, **strength)
+                if k == 0:
+                    pair[mode].append((strength, data))
+
+    def _samples(self, duration):
+        """Return the number of samples closest to *duration* seconds.
+        """
+        return int(round(duration * self.sample_rate))
+
+    def _snippet(self, trace, start, stop):
+        """Return column values for a data snippet, either inline or referencing the recording data.
+        """
+        if self.store_recording_data:
+            return {'data': None, 'data_start_index': start, 'data_stop_index': stop}
+        return {'data': trace[start:stop].copy(), 'data_start_index': None, 'data_stop_index': None}
+
+    def _strength(self, data, onset_index, mode):
+        """Approximate the measurements made by the pulse_response stage for one snippet.
+        """
+        base = data[:onset_index].mean()
+        post = data[onset_index:] - base
+        pos_i = np.argmax(post)
+        neg_i = np.argmin(post)
+        dt = 1. / self.sample_rate
+        # deconvolved amplitudes scale with the raw ones; crosstalk is the step at stimulus onset
+        return {
+            'pos_amp': float(post[pos_i]),
+            'neg_amp': float(post[neg_i]),
+            'pos_dec_amp': float(post[pos_i] * 0.2 * self.rng.uniform(0.9, 1.1)),
+            'neg_dec_amp': float(post[neg_i] * 0.2 * self.rng.uniform(0.9, 1.1)),
+            'pos_dec_latency': pos_i * dt * 0.5,
+            'neg_dec_latency': neg_i * dt * 0.5,
+            'crosstalk': float(post[:5].mean()),
+        }
+
+    def add_connection_strength(self, pair, base_stats):
+        rng = self.rng
+        values = {'pair_id': pair['id']}
+        if pair['synapse']:
+            values['synapse_type'] = 'ex' if pair['sign'] > 0 else 'in'
+        for mode in ('ic', 'vc'):
+            samples = pair[mode]
+            base = base_stats[mode]
+            if len(samples) == 0:
+                continue
+            key = 'pos_amp' if (pair['sign'] > 0) == (mode == 'ic') else 'neg_amp'
+            amps = np.array([s[key] for s, d in samples])
+            base_amps = np.array([b[key] for b in base[:len(samples)]])
+            latencies = np.array([s[key.replace('amp', 'dec_latency')] for s, d in samples])
+            avg = np.mean([d for s, d in samples], axis=0)
+            p_val = rng.uniform(1e-8, 1e-3) if pair['synapse'] else rng.uniform(0, 1)
+            values.update({
+                mode + '_n_samples': len(samples),
+                mode + '_crosstalk_mean': float(np.mean([s['crosstalk'] for s, d in samples])),
+                mode + '_amp_mean': float(amps.mean()),
+                mode + '_amp_stdev': float(amps.std()),
+                mode + '_base_amp_mean': float(base_amps.mean()) if len(base_amps) else None,
+                mode + '_base_amp_stdev': float(base_amps.std()) if len(base_amps) else None,
+                mode + '_amp_ttest': p_val,
+                mode + '_amp_ks2samp': p_val,
+                mode + '_deconv_amp_mean': float(amps.mean() * 0.2),
+                mode + '_deconv_amp_stdev': float(amps.std() * 0.2),
+                mode + '_deconv_amp_ttest': p_val,
+                mode + '_deconv_amp_ks2samp': p_val,
+                mode + '_latency_mean': float(latencies.mean()),
+                mode + '_latency_stdev': float(latencies.std()),
+                mode + '_latency_ttest': p_val,
+                mode + '_latency_ks2samp': p_val,
+                mode + '_average_response': avg,
+                mode + '_average_response_t0': -10e-3,
+                mode + '_average_base_stdev': float(avg[:self._samples(10e-3)].std()),
+            })
+            if pair['synapse']:
+                amp = pair['amp'] * (1 if mode == 'ic' else -40e-9)
+                values.update({
+                    mode + '_fit_amp': amp,
+                    mode + '_fit_xoffset': 10e-3 + pair['latency'],
+                    mode + '_fit_yoffset': float(avg[:100].mean()),
+                    mode + '_fit_rise_time': pair['rise_time'],
+                    mode + '_fit_rise_power': 2.,
+                    mode + '_fit_decay_tau': pair['decay_tau'],
+                    mode + '_fit_exp_amp': 0.,
+                    mode + '_fit_nrmse': rng.uniform(0.1, 0.5),
+                })
+        self.add_row('connection_strength', **values)
@@ -0,0 +1,209 @@
+# coding: utf8
+"""
+Short-term plasticity (STP) measurements computed from pulse response strengths.
+
+Pulse response strengths for every pair in an experiment are fetched with a single query
+(dynamics_query), then grouped with numpy by pair, clamp mode, induction frequency and
+recovery delay to compute the full STP table for every pair at once (stp_table).
+
+Only sweeps in which every pulse response passes QC for the pair's synapse type are used,
+and response amplitudes are taken from the deconvolved amplitude with the sign of the
+synapse (pos_dec_amp for excitatory, neg_dec_amp for inhibitory synapses). Each pulse
+train consists of an induction train (pulses 1-8) followed, after the recovery delay,
+by a recovery train (pulses 9-12).
+"""
+from __future__ import print_function, division
+
+import numpy as np
+from . import database as db
+
+
+# number of pulses in the induction train; all later pulses belong to the recovery train
+n_induction_pulses = 8
+
+
+def dynamics_query(session, expt_id):
+    """Return a query selecting the pulse response strengths and stimulus parameters of
+    all pulse responses in an experiment, as used by stp_table.
+    """
+    q = session.query(
+        db.PulseResponse.pair_id,
+        db.PulseResponse.recording_id,
+        db.PatchClampRecording.clamp_mode,
+        db.MultiPatchProbe.induction_frequency,
+        db.MultiPatchProbe.recovery_delay,
+        db.StimPulse.pulse_number,
+        db.PulseResponse.ex_qc_pass,
+        db.PulseResponse.in_qc_pass,
+        db.PulseResponseStrength.pos_dec_amp,
+        db.PulseResponseStrength.neg_dec_amp,
+    )
+    q = q.join(db.PulseResponseStrength, db.PulseResponseStrength.pulse_response_id==db.PulseResponse.id)
+    q = q.join(db.StimPulse, db.PulseResponse.stim_pulse_id==db.StimPulse.id)
+    q = q.join(db.PatchClampRecording, db.PatchClampRecording.recording_id==db.PulseResponse.recording_id)
+    q = q.join(db.MultiPatchProbe, db.MultiPatchProbe.patch_clamp_recording_id==db.PatchClampRecording.id)
+    q = q.filter(db.PulseResponse.experiment_id==expt_id)
+    return q
+
+
+def stp_table(recs, synapse_types):
+    """Compute short-term plasticity measurements for many pairs at once.
+
+    Parameters
+    ----------
+    recs : structured array
+        Records with the fields returned by dynamics_query (see db.fetch_array).
+    synapse_types : dict
+        {pair_id: 'ex' or 'in'}. Pairs that are not listed are ignored.
+
+    Returns
+    -------
+    stp : dict
+        ``{pair_id: {clamp_mode: {frequency: entry}}}``, where frequency is the induction
+        frequency formatted as a string (for example '50'), and each entry is a dict with keys:
+
+        * n_sweeps: number of sweeps included
+        * pulse_amps: mean amplitude of each induction pulse (averaged over all recovery delays)
+        * pulse_ratios: mean amplitude of each induction pulse divided by that of the first pulse
+        * recovery: ``{recovery_delay: recovery_entry}`` with the delay in seconds formatted as
+          a string (for example '0.25'), and each recovery_entry a dict with keys:
+
+          * n_sweeps: number of sweeps with this recovery delay
+          * pulse_amps: mean amplitude of each recovery pulse
+          * pulse_ratios: mean amplitude of each recovery pulse divided by that of the first
+            pulse in the same sweeps
+          * recovery_index: mean amplitude of the recovery pulses divided by the mean
+            amplitude of the same number of pulses at the start of the induction train
+
+        Amplitudes and ratios that cannot be measured are None. The result is JSON-serializable.
+    """
+    if len(recs) == 0 or len(synapse_types) == 0:
+        return {}
+
+    # synapse type of each row
+    pair_ids = np.array(sorted(synapse_types.keys()))
+    ex_pairs = np.array([synapse_types[p] == 'ex' for p in pair_ids])
+    pair_index = np.clip(np.searchsorted(pair_ids, recs['pair_id']), 0, len(pair_ids) - 1)
+    known = pair_ids[pair_index] == recs['pair_id']
+    ex = ex_pairs[pair_index]
+
+    amp = np.where(ex, recs['pos_dec_amp'], recs['neg_dec_amp']).astype(float)
+    qc = np.where(ex, np.array(recs['ex_qc_pass'], dtype=bool), np.array(recs['in_qc_pass'], dtype=bool))
+    freq = np.asarray(recs['induction_frequency'], dtype=float)
+    delay = np.asarray(recs['recovery_delay'], dtype=float)
+    pulse = np.asarray(recs['pulse_number'], dtype=float)
+    modes, mode_index = np.unique(np.array(recs['clamp_mode']).astype(str), return_inverse=True)
+    usable = known & qc & np.isfinite(amp) & np.isfinite(freq) & np.isfinite(pulse) & (pulse >= 1)
+
+    # discard whole sweeps unless every pulse response in the sweep is usable
+    pair_id = np.asarray(recs['pair_id'])
+    sweep_first, sweep = _group_index(pair_id, np.asarray(recs['recording_id']))
+    sweep_ok = np.bincount(sweep, weights=~usable) == 0
+    mask = sweep_ok[sweep]
+    if not mask.any():
+        return {}
+    pair_id, mode_index, freq, delay, amp, sweep = pair_id[mask], mode_index[mask], freq[mask], delay[mask], amp[mask], sweep[mask]
+    pulse = pulse[mask].astype(int)
+    # NaN does not compare equal to itself, so use a placeholder for grouping
+    delay_key = np.where(np.isfinite(delay), delay, -1)
+    n_pulses = pulse.max()
+    first_row_of_sweep = np.unique(sweep, return_index=True)[1]
+
+    # mean amplitude of each pulse for each (pair, clamp mode, frequency)
+    freq_first, freq_group = _group_index(pair_id, mode_index, freq)
+    freq_amps = _mean_amps(freq_group, pulse, amp, len(freq_first), n_pulses)
+    freq_sweeps = np.bincount(freq_group[first_row_of_sweep], minlength=len(freq_first))
+    ind_amps = freq_amps[:, :n_induction_pulses]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        ind_ratios = ind_amps / ind_amps[:, :1]
+
+    # ..and for each (pair, clamp mode, frequency, recovery delay)
+    delay_first, delay_group = _group_index(pair_id, mode_index, freq, delay_key)
+    delay_amps = _mean_amps(delay_group, pulse, amp, len(delay_first), n_pulses)
+    delay_sweeps = np.bincount(delay_group[first_row_of_sweep], minlength=len(delay_first))
+    rec_amps = delay_amps[:, n_induction_pulses:]
+    n_rec = rec_amps.shape[1]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        rec_ratios = rec_amps / delay_amps[:, :1]
+        recovery_index = _row_mean(rec_amps) / _row_mean(delay_amps[:, :n_rec])
+
+    stp = {}
+    for i, row in enumerate(freq_first):
+        entry = {
+            'n_sweeps': int(freq_sweeps[i]),
+            'pulse_amps': _json_list(ind_amps[i]),
+            'pulse_ratios': _json_list(ind_ratios[i]),
+            'recovery': {},
+        }
+        stp.setdefault(int(pair_id[row]), {}).setdefault(modes[mode_index[row]], {})[_freq_key(freq[row])] = entry
+
+    if n_rec > 0:
+        for i, row in enumerate(delay_first):
+            if not np.isfinite(delay[row]) or not np.isfinite(rec_amps[i]).any():
+                continue
+            entry = stp[int(pair_id[row])][modes[mode_index[row]]][_freq_key(freq[row])]
+            entry['recovery']['%g' % delay[row]] = {
+                'n_sweeps': int(delay_sweeps[i]),
+                'pulse_amps': _json_list(rec_amps[i]),
+                'pulse_ratios': _json_list(rec_ratios[i]),
+                'recovery_index': _json_value(recovery_index[i]),
+            }
+
+    return stp
+
+
+def pulse_ratio(stp, clamp_mode, frequency, pulse_number):
+    """Return the ratio of the mean amplitude of *pulse_number* to that of the first pulse from
+    an STP table generated by stp_table (for example, the 8:1 ratio at 50 Hz), or None if it
+    was not measured.
+    """
+    entry = stp.get(clamp_mode, {}).get(_freq_key(frequency))
+    if entry is None or pulse_number > len(entry['pulse_ratios']):
+        return None
+    return entry['pulse_ratios'][pulse_number - 1]
+
+
+def _group_index(*keys):
+    """Group rows having equal values in all *keys* (1D arrays of equal length).
+
+    Returns the index of the first row of each group (in sorted key order), and the group index of each row.
+    """
+    order = np.lexsort(keys[::-1])
+    change = np.zeros(len(order), dtype=bool)
+    change[:1] = True
+    for key in keys:
+        key = key[order]
+        change[1:] |= key[1:] != key[:-1]
+    group = np.empty(len(order), dtype=int)
+    group[order] = np.cumsum(change) - 1
+    return order[change], group
+
+
+def _mean_amps(group, pulse, amp, n_groups, n_pulses):
+    """Return an (n_groups, n_pulses) array of mean amplitudes, with NaN where there are no values.
+    """
+    flat = group * n_pulses + (pulse - 1)
+    sums = np.bincount(flat, weights=amp, minlength=n_groups * n_pulses)
+    counts = np.bincount(flat, minlength=n_groups * n_pulses)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return (sums / counts).reshape(n_groups, n_pulses)
+
+
+def _row_mean(a):
+    """Mean of the finite values in each row of *a*.
+    """
+    finite = np.isfinite(a)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(finite, a, 0).sum(axis=1) / finite.sum(axis=1)
+
+
+def _freq_key(freq):
+    return '%g' % freq
+
+
+def _json_value(x):
+    return float(x) if np.isfinite(x) else None
+
+
+def _json_list(a):
+    return [_json_value(x) for x in a]
@@ -6,6 +6,7 @@ import numpy as np
 from neuroanalysis.data import Trace, TraceList
 from neuroanalysis.fitting import fit_psp
 from . import database as db
+from . import fit_cache
 
 
 time_before_spike = 10.e-3 #time in seconds before spike to start trace waveforms
@@ -242,7 +243,7 @@ def fit_trace(waveform, excitation, clamp_mode='ic', weight=None, latency=None,
         #since these are spike aligned the psp should not happen before the spike that happens at pre_pad by definition
         xoffset=([time_before_spike+1e-3, time_before_spike+4e-3], time_before_spike, time_before_spike+5e-3)
 
-    fit = fit_psp(waveform, 
+    fit = fit_cache.cached_fit(fit_psp, waveform, 
                     clamp_mode=clamp_mode,
                     xoffset=xoffset,
                     sign=sign, 
@@ -0,0 +1,288 @@
+"""
+On-disk cache for curve fit results.
+
+The same averaged response is often fit many times with identical settings (for example,
+when re-running analyze_pair_connectivity in an interactive session or regenerating
+figures). Fit results are stored in config.cache_path/fit_cache, keyed by a hash of
+everything that determines the outcome of the fit: the input data and time values,
+initial parameters, bounds, weights, fitting options, and the versions of the fitting code.
+
+The total size of the cache is limited to config.fit_cache_size MB; when the cache has
+grown beyond the limit, the least recently used results are removed. To avoid scanning
+the cache directory on every store, each process keeps a running estimate of the cache
+size and only checks the directory when the estimate passes the limit (or every
+size_check_interval stores).
+Set config.fit_cache = False to disable caching.
+
+Example::
+
+    fit = fit_cache.cached_fit(fit_psp, trace, clamp_mode='ic', sign=1)   # slow the first time
+    fit = fit_cache.cached_fit(fit_psp, trace, clamp_mode='ic', sign=1)   # loaded from disk
+
+connection_detection.fit_psp consults the cache automatically.
+
+lmfit ModelResults (as returned by neuroanalysis fitting functions) cannot be pickled
+directly, so they are stored as FitRecords and rebuilt when loaded.
+"""
+from __future__ import division, print_function
+
+import os, zlib, hashlib, pickle, logging
+import numpy as np
+
+from . import config
+from .util import replace_file
+
+
+logger = logging.getLogger(__name__)
+
+
+# Increment this when changes to the fitting code in this package would change fit results
+version = 2
+
+
+def cache_dir():
+    return os.path.join(config.cache_path, 'fit_cache')
+
+
+def enabled():
+    return getattr(config, 'fit_cache', True) and config.cache_path is not None
+
+
+def code_version():
+    """Return a string identifying the versions of the code that fits are computed with.
+    """
+    versions = ['multipatch_analysis:%d' % version]
+    for mod_name in ('neuroanalysis', 'lmfit', 'scipy'):
+        try:
+            mod = __import__(mod_name)
+            versions.append('%s:%s' % (mod_name, getattr(mod, '__version__', '?')))
+        except ImportError:
+            pass
+    return ' '.join(versions)
+
+
+def fit_key(*args, **kwds):
+    """Return a hex digest identifying the values of all arguments.
+
+    Arrays are hashed by dtype, shape and contents; Traces by their data and time values;
+    dicts, lists and tuples recursively; all other objects by repr().
+    """
+    h = hashlib.sha1()
+    _hash_value(h, code_version())
+    _hash_value(h, args)
+    _hash_value(h, kwds)
+    return h.hexdigest()
+
+
+def _hash_value(h, value):
+    if isinstance(value, np.ndarray):
+        value = np.ascontiguousarray(value)
+        h.update(('array %s %r:' % (value.dtype.str, value.shape)).encode('utf8'))
+        h.update(value.tobytes())
+    elif hasattr(value, 'data') and hasattr(value, 'time_values'):
+        # Trace
+        h.update(b'trace:')
+        _hash_value(h, np.asarray(value.data))
+        _hash_value(h, np.asarray(value.time_values))
+    elif isinstance(value, dict):
+        h.update(b'dict:')
+        for k in sorted(value.keys(), key=repr):
+            _hash_value(h, k)
+            _hash_value(h, value[k])
+    elif isinstance(value, (list, tuple)):
+        h.update(('%s %d:' % (type(value).__name__, len(value))).encode('utf8'))
+        for v in value:
+            _hash_value(h, v)
+    elif callable(value) and hasattr(value, '__name__'):
+        h.update(('function %s.%s;' % (getattr(value, '__module__', ''), value.__name__)).encode('utf8'))
+    else:
+        h.update(('%s %r;' % (type(value).__name__, value)).encode('utf8'))
+
+
+def get(key):
+    """Return the cached result for *key*, or None if there is no cached result.
+    """
+    cache_file = os.path.join(cache_dir(), key + '.pkl.z')
+    if not os.path.isfile(cache_file):
+        return None
+    try:
+        with open(cache_file, 'rb') as fh:
+            result = pickle.loads(zlib.decompress(fh.read()))
+        if isinstance(result, FitRecord):
+            result = result.restore()
+        # mark as recently used
+        os.utime(cache_file, None)
+        return result
+    except Exception:
+        # corrupt or incompatible cache file; the fit will be rerun and the file replaced
+        return None
+
+
+def store(key, result):
+    """Store *result* under *key*, then remove least recently used results if the cache
+    has grown beyond config.fit_cache_size MB.
+
+    Failing to store a result never raises (the cache is only an optimization); results
+    that cannot be pickled or written are not cached, and a warning is logged.
+    """
+    try:
+        data = zlib.compress(pickle.dumps(_picklable(result), protocol=2))
+    except Exception:
+        logger.warning("Could not store fit result (%s) in cache:", type(result).__name__, exc_info=True)
+        return
+
+    tmp_file = None
+    try:
+        if not os.path.isdir(cache_dir()):
+            try:
+                os.makedirs(cache_dir())
+            except OSError:
+                # another process may have created it in the meantime
+                if not os.path.isdir(cache_dir()):
+                    raise
+        cache_file = os.path.join(cache_dir(), key + '.pkl.z')
+        # write to a temporary file first so that concurrent readers never see a partial file
+        tmp_file = cache_file + '.%d.tmp' % os.getpid()
+        with open(tmp_file, 'wb') as fh:
+            fh.write(data)
+        replace_file(tmp_file, cache_file)
+        tmp_file = None
+
+        _check_size(len(data))
+    except Exception:
+        logger.warning("Could not write fit result to cache directory %s:", cache_dir(), exc_info=True)
+        if tmp_file is not None and os.path.exists(tmp_file):
+            try:
+                os.remove(tmp_file)
+            except OSError:
+                pass
+
+
+# Number of stores after which the cache directory is scanned again even if the estimated
+# size is below the limit (other processes may be writing to the same cache)
+size_check_interval = 1000
+
+# {cache_dir: [estimated size in bytes, stores since the last scan]} for this process
+_size_estimates = {}
+
+
+def _check_size(n_bytes):
+    """Update the estimated cache size after storing *n_bytes*, and call limit_size() if
+    the estimate exceeds config.fit_cache_size MB (or every size_check_interval stores).
+
+    Scanning the cache directory is expensive, so this is done only occasionally rather
+    than after every store.
+    """
+    max_bytes = getattr(config, 'fit_cache_size', 1000) * 1e6
+    est = _size_estimates.get(cache_dir())
+    if est is not None:
+        est[0] += n_bytes
+        est[1] += 1
+        if est[0] <= max_bytes and est[1] < size_check_interval:
+            return
+    _size_estimates[cache_dir()] = [limit_size(max_bytes), 0]
+
+
+def _picklable(result):
+    """Return *result*, or a FitRecord if it is an lmfit ModelResult.
+    """
+    try:
+        from lmfit.model import ModelResult
+    except ImportError:
+        return result
+    if isinstance(result, ModelResult):
+        return FitRecord(result)
+    return result
+
+
+class FitRecord(object):
+    """Picklable copy of an lmfit ModelResult.
+
+    ModelResults can not be pickled directly: neuroanalysis FitModel.fit attaches rmse()
+    and nrmse() lambdas to them, and they reference the model's residual function. Instead,
+    the model class, the parameters and all other picklable attributes (best_values,
+    best_fit, residual, chisqr, data, weights, etc.) are stored, and restore() builds an
+    equivalent ModelResult.
+    """
+    def __init__(self, fit):
+        self.model_class = type(fit.model)
+        self.params = fit.params.dumps()
+        self.init_params = None if fit.init_params is None else fit.init_params.dumps()
+        self.attrs = {}
+        for name, value in fit.__dict__.items():
+            if name in ('model', 'params', 'init_params') or callable(value):
+                continue
+            try:
+                pickle.dumps(value, protocol=2)
+            except Exception:
+                continue
+            self.attrs[name] = value
+
+    def restore(self):
+        from lmfit import Parameters
+        from lmfit.model import ModelResult
+        model = self.model_class()
+        fit = ModelResult(model, Parameters().loads(self.params))
+        fit.__dict__.update(self.attrs)
+        if self.init_params is not None:
+            fit.init_params = Parameters().loads(self.init_params)
+        if hasattr(model, 'nrmse'):
+            # as attached by FitModel.fit
+            fit.rmse = lambda: model.rmse(fit)
+            fit.nrmse = lambda: model.nrmse(fit)
+        return fit
+
+
+def limit_size(max_bytes):
+    """Remove least recently used results until the cache is no larger than *max_bytes*.
+
+    Returns the remaining size of the cache in bytes.
+    """
+    path = cache_dir()
+    if not os.path.isdir(path):
+        return 0
+    files = []
+    for fname in os.listdir(path):
+        if not fname.endswith('.pkl.z'):
+            continue
+        try:
+            st = os.stat(os.path.join(path, fname))
+        except OSError:
+            continue
+        files.append((st.st_mtime, st.st_size, fname))
+    total = sum([f[1] for f in files])
+    for mtime, size, fname in sorted(files):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(os.path.join(path, fname))
+        except OSError:
+            pass
+        total -= size
+    return total
+
+
+def cached_fit(fit_func, *args, **kwds):
+    """Return ``fit_func(*args, **kwds)``, using a cached result if the same function has
+    already been called with identical arguments.
+    """
+    if not enabled():
+        return fit_func(*args, **kwds)
+    key = fit_key(fit_func, args, kwds)
+    result = get(key)
+    if result is None:
+        result = fit_func(*args, **kwds)
+        store(key, result)
+    return result
+
+
+def clear():
+    """Remove all cached fit results.
+    """
+    path = cache_dir()
+    _size_estimates.pop(path, None)
+    if not os.path.isdir(path):
+        return
+    for fname in os.listdir(path):
+        if fname.endswith('.pkl.z') or fname.endswith('.tmp'):
+            os.remove(os.path.join(path, fname))
@@ -7,6 +7,7 @@ from .pulse_response import PulseResponsePipelineModule
 from .dynamics import DynamicsPipelineModule
 from .connection_strength import ConnectionStrengthPipelineModule
 from .first_pulse_fit import FirstPulseFitPipelineModule
+from .pair_summary import PairSummaryPipelineModule
 
 
 def all_modules():
@@ -9,7 +9,7 @@ from .pipeline_module import DatabasePipelineModule
 from .experiment import ExperimentPipelineModule
 from .dataset import DatasetPipelineModule
 from .pulse_response import PulseResponsePipelineModule
-from ..connection_strength import get_amps, get_baseline_amps, analyze_pair_connectivity
+from ..connection_strength import get_experiment_amps, analyze_pair_connectivity
 
 
 class ConnectionStrengthPipelineModule(DatabasePipelineModule):
@@ -23,14 +23,11 @@ class ConnectionStrengthPipelineModule(DatabasePipelineModule):
     def create_db_entries(cls, expt_id, session):
         expt = db.experiment_from_timestamp(expt_id, session=session)
 
+        # Query all pulse amplitude records for all pairs / clamp modes at once
+        pair_amps = get_experiment_amps(session, expt, get_data=True, cache=False)
+
         for pair in expt.pair_list:
-            # Query all pulse amplitude records for each clamp mode
-            amps = {}
-            for clamp_mode in ('ic', 'vc'):
-                clamp_mode_fg = get_amps(session, pair, clamp_mode=clamp_mode, get_data=True)
-                clamp_mode_bg = get_baseline_amps(session, pair, amps=clamp_mode_fg, clamp_mode=clamp_mode, get_data=False)
-                amps[clamp_mode, 'fg'] = clamp_mode_fg
-                amps[clamp_mode, 'bg'] = clamp_mode_bg
+            amps = pair_amps[pair.id]
             
             if all([len(a) == 0 for a in amps]):
                 # nothing to analyze here.
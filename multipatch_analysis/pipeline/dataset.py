@@ -46,6 +46,10 @@ class DatasetPipelineModule(DatabasePipelineModule):
         expt = Experiment(path)
         nwb = expt.data
         
+        # If requested, each recording is stored once (downsampled) and snippets 
+        # only record their start/stop indices into the recording data
+        store_rec_data = config.store_recording_data
+
         # Load all data from NWB into DB
         for srec in nwb.contents:
             temp = srec.meta.get('temperature', None)
@@ -55,6 +59,7 @@ class DatasetPipelineModule(DatabasePipelineModule):
             srec_has_mp_probes = False
             
             rec_entries = {}
+            rec_ds_traces = {}
             all_pulse_entries = {}
             for rec in srec.recordings:
                 
@@ -67,6 +72,12 @@ class DatasetPipelineModule(DatabasePipelineModule):
                 )
                 session.add(rec_entry)
                 rec_entries[rec.device_id] = rec_entry
+
+                if store_rec_data:
+                    ds_trace = rec['primary'].resample(sample_rate=db.default_sample_rate)
+                    rec_ds_traces[rec.device_id] = ds_trace
+                    rec_entry.data = ds_trace.data.astype('float32')
+                    rec_entry.data_start_time = ds_trace.t0
                 
                 # import patch clamp recording information
                 if not isinstance(rec, PatchClampRecording):
@@ -128,16 +139,26 @@ class DatasetPipelineModule(DatabasePipelineModule):
                     # Record information about all pulses, including test pulse.
                     t0 = rec_tvals[pulse[0]]
                     t1 = rec_tvals[pulse[1]]
-                    data_start = max(0, t0 - 10e-3)
-                    data_stop = t0 + 10e-3
+                    data_start = max(0, t0 - db.stim_pulse_window)
+                    data_stop = t0 + db.stim_pulse_window
+                    if store_rec_data:
+                        ds_trace = rec_ds_traces[rec.device_id]
+                        data = None
+                        data_inds = [ds_trace.index_at(data_start), ds_trace.index_at(data_stop)]
+                    else:
+                        data = rec['primary'].time_slice(data_start, data_stop).resample(sample_rate=20000).data
+                        data_inds = [None, None]
                     pulse_entry = db.StimPulse(
+                        experiment_id=expt_entry.id,
                         recording=rec_entry,
                         pulse_number=i,
                         onset_time=t0,
                         amplitude=pulse[2],
                         duration=t1-t0,
-                        data=rec['primary'].time_slice(data_start, data_stop).resample(sample_rate=20000).data,
+                        data=data,
                         data_start_time=data_start,
+                        data_start_index=data_inds[0],
+                        data_stop_index=data_inds[1],
                     )
                     session.add(pulse_entry)
                     pulse_entries[i] = pulse_entry
@@ -167,6 +188,7 @@ class DatasetPipelineModule(DatabasePipelineModule):
                         pulse.n_spikes = 0
                     
                     spike_entry = db.StimSpike(
+                        experiment_id=expt_entry.id,
                         pulse=pulse,
                         **extra
                     )
@@ -202,12 +224,21 @@ class DatasetPipelineModule(DatabasePipelineModule):
                             pair_entry.n_ex_test_spikes += 1
                         if resp['in_qc_pass']:
                             pair_entry.n_in_test_spikes += 1
+                        if store_rec_data:
+                            data = None
+                            data_inds = _resampled_indices(srec[post_dev]['primary'], resp['rec_start'], resp['rec_stop'])
+                        else:
+                            data = resp['response'].resample(sample_rate=20000).data
+                            data_inds = [None, None]
                         resp_entry = db.PulseResponse(
+                            experiment_id=expt_entry.id,
                             recording=rec_entries[post_dev],
                             stim_pulse=all_pulse_entries[pre_dev][resp['pulse_n']],
                             pair=pair_entry,
                             start_time=post_tvals[resp['rec_start']],
-                            data=resp['response'].resample(sample_rate=20000).data,
+                            data=data,
+                            data_start_index=data_inds[0],
+                            data_stop_index=data_inds[1],
                             ex_qc_pass=resp['ex_qc_pass'],
                             in_qc_pass=resp['in_qc_pass'],
                         )
@@ -224,14 +255,22 @@ class DatasetPipelineModule(DatabasePipelineModule):
                         # all out!
                         break
                     start, stop = base
-                    data = rec['primary'][start:stop].resample(sample_rate=20000).data
+                    if store_rec_data:
+                        data_inds = _resampled_indices(rec['primary'], start, stop)
+                        data = rec_ds_traces[dev].data[data_inds[0]:data_inds[1]]
+                    else:
+                        data = rec['primary'][start:stop].resample(sample_rate=20000).data
+                        data_inds = [None, None]
 
                     ex_qc_pass, in_qc_pass = qc.pulse_response_qc_pass(rec, [start, stop], None, [])
 
                     base_entry = db.Baseline(
+                        experiment_id=expt_entry.id,
                         recording=rec_entries[dev],
                         start_time=rec_tvals[start],
-                        data=data,
+                        data=None if store_rec_data else data,
+                        data_start_index=data_inds[0],
+                        data_stop_index=data_inds[1],
                         mode=float_mode(data),
                         ex_qc_pass=ex_qc_pass,
                         in_qc_pass=in_qc_pass,
@@ -272,3 +311,11 @@ class DatasetPipelineModule(DatabasePipelineModule):
             nwb_mtime = timestamp_to_datetime(os.stat(ephys_file).st_mtime)
             ready[rec.acq_timestamp] = max(expt_mtime, nwb_mtime)
         return ready
+
+
+def _resampled_indices(trace, start, stop):
+    """Convert start/stop indices in *trace* to indices into the same trace resampled to the
+    default database sample rate.
+    """
+    scale = float(db.default_sample_rate) / trace.sample_rate
+    return [int(round(start * scale)), int(round(stop * scale))]
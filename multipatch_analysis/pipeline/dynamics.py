@@ -5,11 +5,9 @@ For generating a DB table describing short term dynamics.
 """
 from __future__ import print_function, division
 
-import os
-import numpy as np
-from collections import OrderedDict
-from ..util import timestamp_to_datetime
+from sqlalchemy import or_
 from .. import database as db
+from ..dynamics import dynamics_query, stp_table, pulse_ratio
 from .pipeline_module import DatabasePipelineModule
 from .pulse_response import PulseResponsePipelineModule
 from .connection_strength import ConnectionStrengthPipelineModule
@@ -24,41 +22,26 @@ class DynamicsPipelineModule(DatabasePipelineModule):
     
     @classmethod
     def create_db_entries(cls, job_id, session):
-        
-        # Load experiment from DB
         expt = db.experiment_from_timestamp(job_id, session=session)
-        for pair in expt.pairs.values():
-            if pair.synapse is False:
-                continue
-            recs = session.query(db.Recording).join(db.PulseResponse).join(db.Pair).filter(db.Pair.id==pair.id).all()
-            pulse_amps = {}
-            for rec in recs:
-                q = session.query(db.PulseResponseStrength, db.PulseResponse, db.StimPulse.pulse_number, db.MultiPatchProbe.induction_frequency)
-                q = q.join(db.PulseResponse).join(db.StimPulse).join(db.PatchClampRecording, db.PatchClampRecording.recording_id==db.PulseResponse.recording_id).join(db.MultiPatchProbe)
-                q = q.filter(db.PulseResponse.pair_id==pair.id).filter(db.PatchClampRecording.clamp_mode=='ic').filter(db.PulseResponse.recording_id==rec.id)
-                results = q.all()
-                if len(results) == 0:
-                    continue
-                if results[0].induction_frequency != 50:
-                    continue
-                sign = pair.connection_strength.synapse_type
-                qc = sign+'_qc_pass'
-                # make sure all 12 pulses pass qc before moving on
-                qc_check = [getattr(r.pulse_response, qc) for r in results]
-                if all(qc_check) is False:
-                    continue
-                amp_field = 'pos_dec_amp' if sign == 'ex' else 'neg_dec_amp'
-                for result in results:
-                    pulse_number = result.pulse_number
-                    pulse_amps.setdefault(pulse_number, [])
-                    pulse_amps[pulse_number].append(getattr(result.pulse_response_strength, amp_field))
-            if any(pulse_amps):
-                pulse_ratio_8_1_50Hz = np.mean(pulse_amps[8]) / np.mean(pulse_amps[1])
-                pulse_ratio_2_1_50Hz = np.mean(pulse_amps[2]) / np.mean(pulse_amps[1])
-                pulse_ratio_5_1_50Hz = np.mean(pulse_amps[5]) / np.mean(pulse_amps[1])    
-                # Write new record to DB
-                dynamics = db.Dynamics(pair_id=pair.id, pulse_ratio_2_1_50Hz=pulse_ratio_2_1_50Hz, pulse_ratio_8_1_50Hz=pulse_ratio_8_1_50Hz, pulse_ratio_5_1_50Hz=pulse_ratio_5_1_50Hz)
-                session.add(dynamics)
+
+        # synapse type for every pair that may be connected
+        q = session.query(db.Pair.id, db.ConnectionStrength.synapse_type).join(db.ConnectionStrength, db.ConnectionStrength.pair_id==db.Pair.id)
+        q = q.filter(db.Pair.experiment_id==expt.id).filter(or_(db.Pair.synapse==None, db.Pair.synapse==True))
+        synapse_types = {pair_id: syn_type for pair_id, syn_type in q if syn_type in ('ex', 'in')}
+
+        # all pulse response strengths in the experiment, fetched at once
+        recs = db.fetch_array(dynamics_query(session, expt.id))
+        stp = stp_table(recs, synapse_types)
+
+        for pair_id, pair_stp in stp.items():
+            dynamics = db.Dynamics(
+                pair_id=pair_id, 
+                pulse_ratio_2_1_50Hz=pulse_ratio(pair_stp, 'ic', 50, 2),
+                pulse_ratio_8_1_50Hz=pulse_ratio(pair_stp, 'ic', 50, 8),
+                pulse_ratio_5_1_50Hz=pulse_ratio(pair_stp, 'ic', 50, 5),
+                stp=pair_stp,
+            )
+            session.add(dynamics)
         
     @classmethod
     def job_records(cls, job_ids, session):
@@ -0,0 +1,133 @@
+# coding: utf8
+"""
+For generating a denormalized per-pair summary table.
+
+"""
+from __future__ import print_function, division
+
+from collections import OrderedDict
+import sqlalchemy
+from .. import database as db
+from .pipeline_module import DatabasePipelineModule
+from .experiment import ExperimentPipelineModule
+from .morphology import MorphologyPipelineModule
+from .connection_strength import ConnectionStrengthPipelineModule
+from .first_pulse_fit import FirstPulseFitPipelineModule
+from .dynamics import DynamicsPipelineModule
+
+
+class PairSummaryPipelineModule(DatabasePipelineModule):
+    """Collects per-pair results from many tables into the pair_summary table
+    """
+    name = 'pair_summary'
+    dependencies = [ExperimentPipelineModule, MorphologyPipelineModule, ConnectionStrengthPipelineModule, FirstPulseFitPipelineModule, DynamicsPipelineModule]
+    table_group = db.pair_summary_tables
+
+    @classmethod
+    def create_db_entries(cls, job_id, session):
+        for rec in pair_summary_query(session, job_id):
+            session.add(db.PairSummary(**dict(rec)))
+
+    @classmethod
+    def job_records(cls, job_ids, session):
+        """Return a list of records associated with a list of job IDs.
+
+        This method is used by drop_jobs to delete records for specific job IDs.
+        """
+        return session.query(db.PairSummary).filter(db.PairSummary.acq_timestamp.in_(job_ids)).all()
+
+    @classmethod
+    def ready_jobs(cls):
+        """Return an ordered dict of all jobs that are ready to be processed and the dates that dependencies were created.
+
+        Only the experiment module is required; results from other modules are included if they are available,
+        and summaries are regenerated whenever any of them is updated.
+        """
+        expt_jobs = ExperimentPipelineModule.finished_jobs()
+        other_jobs = [mod.finished_jobs() for mod in cls.dependencies if mod is not ExperimentPipelineModule]
+
+        ready = OrderedDict()
+        for job_id, (date, success) in expt_jobs.items():
+            if success is False:
+                continue
+            for jobs in other_jobs:
+                if job_id in jobs:
+                    date = max(date, jobs[job_id][0])
+            ready[job_id] = date
+        return ready
+
+
+def pair_summary_query(session, expt_id):
+    """Return records for all pairs in an experiment, with keys matching columns in the pair_summary table.
+    """
+    pair = db.Pair.__table__
+    expt = db.Experiment.__table__
+    slice_ = db.Slice.__table__
+    pre_cell = db.Cell.__table__.alias('pre_cell')
+    post_cell = db.Cell.__table__.alias('post_cell')
+    pre_morph = db.Morphology.__table__.alias('pre_morphology')
+    post_morph = db.Morphology.__table__.alias('post_morphology')
+    cs = db.ConnectionStrength.__table__
+    afpf = db.AvgFirstPulseFit.__table__
+    dyn = db.Dynamics.__table__
+
+    columns = [
+        pair.c.id.label('pair_id'),
+        pair.c.experiment_id,
+        pair.c.pre_cell_id,
+        pair.c.post_cell_id,
+        cs.c.id.label('connection_strength_id'),
+        expt.c.acq_timestamp,
+        expt.c.project_name,
+        expt.c.rig_name,
+        expt.c.acsf,
+        expt.c.internal,
+        expt.c.target_temperature,
+        slice_.c.species.label('donor_species'),
+        slice_.c.genotype.label('donor_genotype'),
+        slice_.c.age.label('donor_age'),
+        slice_.c.sex.label('donor_sex'),
+        slice_.c.weight.label('donor_weight'),
+        slice_.c.quality.label('slice_quality'),
+        slice_.c.slice_time,
+        pre_cell.c.ext_id.label('pre_cell_ext_id'),
+        pre_cell.c.cre_type.label('pre_cre_type'),
+        pre_cell.c.target_layer.label('pre_target_layer'),
+        pre_cell.c.is_excitatory.label('pre_is_excitatory'),
+        pre_morph.c.pyramidal.label('pre_pyramidal'),
+        post_cell.c.ext_id.label('post_cell_ext_id'),
+        post_cell.c.cre_type.label('post_cre_type'),
+        post_cell.c.target_layer.label('post_target_layer'),
+        post_cell.c.is_excitatory.label('post_is_excitatory'),
+        post_morph.c.pyramidal.label('post_pyramidal'),
+        sqlalchemy.func.abs(post_cell.c.ext_id - pre_cell.c.ext_id).label('electrode_distance'),
+        pair.c.synapse,
+        pair.c.electrical,
+        pair.c.crosstalk_artifact,
+        pair.c.n_ex_test_spikes,
+        pair.c.n_in_test_spikes,
+        pair.c.synapse_sign,
+        pair.c.distance,
+    ]
+
+    # all remaining columns are copied directly from the results tables
+    summary_cols = set(db.PairSummary.__table__.columns.keys())
+    for table, prefix in [(cs, ''), (afpf, 'afpf_'), (dyn, '')]:
+        for col in table.columns:
+            name = prefix + col.name
+            if col.name not in ('id', 'pair_id', 'meta') and name in summary_cols:
+                columns.append(col.label(name))
+
+    joins = (pair
+        .join(expt, pair.c.experiment_id==expt.c.id)
+        .join(slice_, expt.c.slice_id==slice_.c.id)
+        .join(pre_cell, pair.c.pre_cell_id==pre_cell.c.id)
+        .join(post_cell, pair.c.post_cell_id==post_cell.c.id)
+        .outerjoin(pre_morph, pre_morph.c.cell_id==pre_cell.c.id)
+        .outerjoin(post_morph, post_morph.c.cell_id==post_cell.c.id)
+        .outerjoin(cs, cs.c.pair_id==pair.c.id)
+        .outerjoin(afpf, afpf.c.pair_id==pair.c.id)
+        .outerjoin(dyn, dyn.c.pair_id==pair.c.id)
+    )
+    q = sqlalchemy.select(columns).select_from(joins).where(expt.c.acq_timestamp==expt_id).order_by(pair.c.id)
+    return session.execute(q).fetchall()
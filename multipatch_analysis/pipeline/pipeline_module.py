@@ -1,10 +1,12 @@
 from __future__ import division, print_function
 import sys, time, multiprocessing, traceback
+from sqlalchemy import event
 from datetime import datetime
 import numpy as np
 from collections import OrderedDict
 from pyqtgraph import toposort
 from .. import database as db
+from .. import config
 
 
 class PipelineModule(object):
@@ -128,9 +130,12 @@ class PipelineModule(object):
         if parallel:
             # kill DB connections before forking multiple processes
             db.dispose_engines()
+
+            # with an sqlite backend, workers compute in parallel but take turns writing
+            write_lock = multiprocessing.Lock() if db.database.sqlite_backend() else None
             
             print("Processing all jobs (parallel)..")
-            pool = multiprocessing.Pool(processes=workers, maxtasksperchild=cls.maxtasksperchild)
+            pool = multiprocessing.Pool(processes=workers, maxtasksperchild=cls.maxtasksperchild, initializer=init_worker, initargs=(write_lock,))
             # would like to just call cls._run_job, but we can't pass a method to Pool.map()
             # instead we wrap this with the run_job_parallel function defined below.
             parallel_jobs = [(cls, job) for job in run_jobs]
@@ -148,7 +153,7 @@ class PipelineModule(object):
                 job_results[result['job_id']] = result['error']
                 
         errors = {job:result for job,result in job_results.items() if result is not None}
-        return {'n_dropped': len(drop_job_ids), 'n_updated': len(run_job_ids), 'n_errors': len(errors), 'errors': errors, 'n_retry': n_retry}
+        return {'n_dropped': len(drop_job_ids), 'n_updated': len(run_job_ids), 'n_errors': len(errors), 'errors': errors, 'n_retry': n_retry, 'job_ids': run_job_ids}
 
     @classmethod
     def _run_job(cls, job, raise_exceptions=False):
@@ -282,6 +287,40 @@ def run_job_parallel(job):
     return cls._run_job(job)
 
 
+# lock shared by all worker processes of a parallel update (see init_worker)
+_write_lock = None
+
+def init_worker(write_lock):
+    """Initializer for worker processes started by PipelineModule.update.
+    """
+    global _write_lock
+    _write_lock = write_lock
+
+
+def serialize_writes(session, lock):
+    """Hold *lock* from the first flush of each transaction in *session* until the transaction ends.
+
+    sqlite allows only one writing connection at a time, and a connection that begins
+    writing keeps the file locked until it commits. Acquiring a lock shared by all worker
+    processes before writing lets workers wait their turn in order rather than repeatedly
+    retrying on a busy database.
+    """
+    held = [False]
+
+    def acquire(session, flush_context, instances):
+        if not held[0]:
+            lock.acquire()
+            held[0] = True
+
+    def release(session, transaction):
+        if held[0] and transaction.parent is None:
+            held[0] = False
+            lock.release()
+
+    event.listen(session, 'before_flush', acquire)
+    event.listen(session, 'after_transaction_end', release)
+
+
 class DatabasePipelineModule(PipelineModule):
     """PipelineModule that implements default behaviors for interacting with database.
     
@@ -322,15 +361,40 @@ class DatabasePipelineModule(PipelineModule):
         # drop old pipeline job record
         session.query(db.Pipeline).filter(db.Pipeline.job_id==job_id).filter(db.Pipeline.module_name==cls.name).delete()
         session.commit()
+
+        # arrays written during this job are grouped in the external array store (if any)
+        # so they can be removed when the job is dropped
+        store = db.array_store.get_array_store()
+        if store is not None:
+            store.set_job(cls.name, job_id)
+
+        # optionally record all queries issued by this job
+        monitor = None
+        if config.query_monitor:
+            monitor = db.query_monitor.QueryMonitor().start()
         
+        if _write_lock is not None:
+            serialize_writes(session, _write_lock)
+
         try:
-            errors = cls.create_db_entries(job_id, session)
+            if db.database.sqlite_backend():
+                # keep all inserts for the commit so that the write lock is held only briefly
+                with session.no_autoflush:
+                    errors = cls.create_db_entries(job_id, session)
+            else:
+                errors = cls.create_db_entries(job_id, session)
             job_result = db.Pipeline(module_name=cls.name, job_id=job_id, success=True, error=errors, finish_time=datetime.now())
+            if monitor is not None:
+                monitor.stop()
+                job_result.meta = {'query_stats': monitor.summary()}
+                print("Query report for %s %0.3f:\n%s" % (cls.name, job_id, monitor.report()))
             session.add(job_result)
 
             session.commit()
         except Exception:
             session.rollback()
+            if store is not None:
+                store.drop_jobs(cls.table_group.tables.keys(), cls.name, [job_id])
             
             err = ''.join(traceback.format_exception(*sys.exc_info()))
             job_result = db.Pipeline(module_name=cls.name, job_id=job_id, success=False, error=err, finish_time=datetime.now())
@@ -339,6 +403,10 @@ class DatabasePipelineModule(PipelineModule):
             raise
         finally:
             session.close()
+            if store is not None:
+                store.set_job(None, None)
+            if monitor is not None:
+                monitor.stop()
 
     @classmethod
     def initialize(cls):
@@ -359,6 +427,10 @@ class DatabasePipelineModule(PipelineModule):
         session.query(db.Pipeline).filter(db.Pipeline.module_name==cls.name).delete()
         session.commit()
 
+        store = db.array_store.get_array_store()
+        if store is not None:
+            store.drop_module(cls.table_group.tables.keys(), cls.name)
+
         if reinitialize:
             cls.initialize()        
             for dep in cls.dependent_modules():
@@ -383,8 +455,18 @@ class DatabasePipelineModule(PipelineModule):
             dep.drop_jobs(dep_jobs, session=session, skip=skip)
         
         print("Dropping %d jobs from %s module.." % (len(job_ids), cls.name))
+
+        # Tables keyed by experiment (see make_table partition_by) are cleared with one bulk delete
+        # per table before loading the remaining records; when partitioning is enabled, this only
+        # touches the partitions holding these experiments.
+        n_bulk = 0
+        if len(cls.table_group.partition_keys()) > 0:
+            expt_ids = [expt_id for expt_id, in session.query(db.Experiment.id).filter(db.Experiment.acq_timestamp.in_(job_ids))]
+            n_bulk = cls.table_group.delete_partitions(session, expt_ids)
+            print("   bulk deleted %d records" % n_bulk)
+
         records = cls.job_records(job_ids, session)
-        if len(records) == 0:
+        if len(records) == 0 and n_bulk == 0:
             print("   (no records to remove for these job IDs)")
         else:
             for i,rec in enumerate(records):
@@ -392,10 +474,31 @@ class DatabasePipelineModule(PipelineModule):
                 print("   record %d/%d\r" % (i, len(records)), end='')
                 sys.stdout.flush()
             session.query(db.Pipeline).filter(db.Pipeline.module_name==cls.name).filter(db.Pipeline.job_id.in_(job_ids)).delete(synchronize_session=False)
-            print("   dropped %d records; committing.." % len(records))
+            print("   dropped %d records; committing.." % (len(records) + n_bulk))
             session.commit()
+
+        # remove array payloads only after the records referencing them are gone
+        store = db.array_store.get_array_store()
+        if store is not None:
+            store.drop_jobs(cls.table_group.tables.keys(), cls.name, job_ids)
         
         skip.append(cls)  # only process each module once
+
+    @classmethod
+    def query_stats(cls, job_ids=None):
+        """Return a combined summary of database queries recorded for this module's jobs
+        (see config.query_monitor and database.query_monitor.merge_summaries), or None if no jobs
+        were monitored.
+        """
+        session = db.Session()
+        q = session.query(db.Pipeline.meta).filter(db.Pipeline.module_name==cls.name)
+        if job_ids is not None:
+            q = q.filter(db.Pipeline.job_id.in_(job_ids))
+        summaries = [meta['query_stats'] for meta, in q.all() if meta is not None and 'query_stats' in meta]
+        session.rollback()
+        if len(summaries) == 0:
+            return None
+        return db.query_monitor.merge_summaries(summaries)
     
     @classmethod
     def finished_jobs(cls):
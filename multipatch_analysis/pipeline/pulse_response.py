@@ -7,7 +7,7 @@ from .. import database as db
 from .. import config
 from .pipeline_module import DatabasePipelineModule
 from .dataset import DatasetPipelineModule
-from ..pulse_response_strength import baseline_query, response_query, analyze_response_strength
+from ..pulse_response_strength import baseline_query, response_query, analyze_response_strengths
 
 
 class PulseResponsePipelineModule(DatabasePipelineModule):
@@ -29,17 +29,12 @@ class PulseResponsePipelineModule(DatabasePipelineModule):
         This method is used by drop_jobs to delete records for specific job IDs.
         """
         q = session.query(db.PulseResponseStrength)
-        q = q.filter(db.PulseResponseStrength.pulse_response_id==db.PulseResponse.id)
-        q = q.filter(db.PulseResponse.pair_id==db.Pair.id)
-        q = q.filter(db.Pair.experiment_id==db.Experiment.id)
+        q = q.filter(db.PulseResponseStrength.experiment_id==db.Experiment.id)
         q = q.filter(db.Experiment.acq_timestamp.in_(job_ids))
         prs = q.all()
         
         q = session.query(db.BaselineResponseStrength)
-        q = q.filter(db.BaselineResponseStrength.baseline_id==db.Baseline.id)
-        q = q.filter(db.Baseline.recording_id==db.Recording.id)
-        q = q.filter(db.Recording.sync_rec_id==db.SyncRec.id)
-        q = q.filter(db.SyncRec.experiment_id==db.Experiment.id)
+        q = q.filter(db.BaselineResponseStrength.experiment_id==db.Experiment.id)
         q = q.filter(db.Experiment.acq_timestamp.in_(job_ids))
         brs = q.all()
         
@@ -56,25 +51,28 @@ def _compute_strength(source, expt_id, session):
     else:
         raise ValueError("Invalid source %s" % source)
 
-    # select just data for the selected experiment
-    q = q.join(db.SyncRec).join(db.Experiment).filter(db.Experiment.acq_timestamp==expt_id)
+    # select just data for the selected experiment; filtering on the denormalized
+    # experiment_id allows partition pruning when tables are partitioned
+    table = db.Baseline if source == 'baseline' else db.PulseResponse
+    expt = db.experiment_from_timestamp(expt_id, session=session)
+    q = q.filter(table.experiment_id==expt.id)
 
     prof = pg.debug.Profiler(delayed=False)
     
-    recs = q.all()
-    prof('fetch')
-        
+
     new_recs = []
+    for recs in db.stream(q, batch_size=500, session=session, as_array=False):
+        snippets = db.load_snippet_data(session, table, [rec.response_id for rec in recs if rec.data is None])
+        results = analyze_response_strengths(recs, source, data=[snippets.get(rec.response_id) for rec in recs])
 
-    for rec in recs:
-        result = analyze_response_strength(rec, source)
-        new_rec = {'%s_id'%source: rec.response_id}
-        # copy a subset of results over to new record
-        for k in ['pos_amp', 'neg_amp', 'pos_dec_amp', 'neg_dec_amp', 'pos_dec_latency', 'neg_dec_latency', 'crosstalk']:
-            new_rec[k] = result[k]
-        new_recs.append(new_rec)
+        for rec, result in zip(recs, results):
+            new_rec = {'%s_id'%source: rec.response_id, 'experiment_id': expt.id}
+            # copy a subset of results over to new record
+            for k in ['pos_amp', 'neg_amp', 'pos_dec_amp', 'neg_dec_amp', 'pos_dec_latency', 'neg_dec_latency', 'crosstalk']:
+                new_rec[k] = result[k]
+            new_recs.append(new_rec)
     
-    prof('process')
+    prof('fetch / process')
 
     # Bulk insert is not safe with parallel processes
     # if source == 'pulse_response':
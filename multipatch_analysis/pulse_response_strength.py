@@ -8,6 +8,7 @@ from __future__ import print_function, division
 import sys, multiprocessing, time
 
 import numpy as np
+import scipy.signal
 import pyqtgraph as pg
 
 from neuroanalysis.data import Trace
@@ -98,8 +99,8 @@ def response_query(session):
         db.PulseResponse.ex_qc_pass,
         db.PulseResponse.in_qc_pass,
     )
-    q = q.join(db.StimPulse)
-    q = q.join(db.StimSpike)
+    q = q.join(db.StimPulse, db.PulseResponse.stim_pulse)
+    q = q.join(db.StimSpike, db.StimPulse.spikes)
     q = q.join(db.PulseResponse.recording).join(db.PatchClampRecording) 
 
     # return qc-failed records as well so we can verify qc is working
@@ -127,15 +128,10 @@ def baseline_query(session):
     return q
 
 
-def analyze_response_strength(rec, source, remove_artifacts=False, deconvolve=True, lpf=True, bsub=True, lowpass=1000):
-    """Perform a standardized strength analysis on a record selected by response_query or baseline_query.
-
-    1. Determine timing of presynaptic stimulus pulse edges and spike
-    2. Measure peak deflection on raw trace
-    3. Apply deconvolution / artifact removal / lpf
-    4. Measure peak deflection on deconvolved trace
+def stimulus_timing(rec, source):
+    """Return the stimulus pulse edges and presynaptic spike time for a record selected by
+    response_query or baseline_query, relative to the start of the record data.
     """
-    data = Trace(rec.data, sample_rate=db.default_sample_rate)
     if source == 'pulse_response':
         # Find stimulus pulse edges for artifact removal
         start = rec.pulse_start - rec.rec_start
@@ -152,6 +148,24 @@ def analyze_response_strength(rec, source, remove_artifacts=False, deconvolve=Tr
         spike_time = 11e-3
     else:
         raise ValueError("Invalid source %s" % source)
+    return pulse_times, spike_time
+
+
+def analyze_response_strength(rec, source, remove_artifacts=False, deconvolve=True, lpf=True, bsub=True, lowpass=1000, data=None):
+    """Perform a standardized strength analysis on a record selected by response_query or baseline_query.
+
+    1. Determine timing of presynaptic stimulus pulse edges and spike
+    2. Measure peak deflection on raw trace
+    3. Apply deconvolution / artifact removal / lpf
+    4. Measure peak deflection on deconvolved trace
+
+    If *data* is given, it is used in place of rec.data (for example, when the
+    record data was loaded separately with db.load_snippet_data).
+    """
+    if data is None:
+        data = rec.data
+    data = Trace(data, sample_rate=db.default_sample_rate)
+    pulse_times, spike_time = stimulus_timing(rec, source)
 
     results = {}
 
@@ -186,3 +200,192 @@ def analyze_response_strength(rec, source, remove_artifacts=False, deconvolve=Tr
     results['neg_dec_amp'], results['neg_dec_latency'] = measure_peak(dec_data, '-', spike_time, pulse_times)
     
     return results
+
+
+def analyze_response_strengths(recs, source, data=None, remove_artifacts=False, deconvolve=True, lpf=True, bsub=True, lowpass=1000):
+    """Vectorized version of analyze_response_strength for many records at once.
+
+    Records are grouped by data length, clamp mode, and the sample indices of the
+    pulse onset windows; each group is then analyzed as a single 2D block with
+    analyze_response_block. The measurements returned are identical to those of
+    analyze_response_strength, but the raw / deconvolved traces are not included.
+
+    Parameters
+    ----------
+    recs : list
+        Records selected by response_query or baseline_query.
+    source : str
+        'pulse_response' or 'baseline'
+    data : list | None
+        Optional list of data arrays to use in place of rec.data for each record
+        (None entries fall back to rec.data).
+
+    Returns a list of result dicts in the same order as *recs*.
+    """
+    n_recs = len(recs)
+    if data is None:
+        data = [None] * n_recs
+    groups = {}
+    timing = []
+    for i, rec in enumerate(recs):
+        d = rec.data if data[i] is None else data[i]
+        pulse_times, spike_time = stimulus_timing(rec, source)
+        timing.append((pulse_times, spike_time))
+        # rows in a block must share the indices of all windows that are measured relative to pulse onset
+        n = len(d)
+        t0 = pulse_times[0]
+        onset_inds = _index_at(np.array([t0-200e-6, t0, t0+200e-6, t0-50e-6]), n)
+        key = (n, rec.clamp_mode, tuple(onset_inds), int(_index_at(t0-50e-6, n-1)))
+        groups.setdefault(key, []).append(i)
+
+    results = [None] * n_recs
+    for key, inds in groups.items():
+        block = np.vstack([recs[i].data if data[i] is None else data[i] for i in inds])
+        pulse_times = np.array([timing[i][0] for i in inds])
+        spike_times = np.array([timing[i][1] for i in inds])
+        block_results = analyze_response_block(block, key[1], pulse_times, spike_times, remove_artifacts=remove_artifacts,
+                                               deconvolve=deconvolve, lpf=lpf, bsub=bsub, lowpass=lowpass)
+        for j, i in enumerate(inds):
+            result = {k: v[j] for k, v in block_results.items()}
+            result['pulse_times'], result['spike_time'] = timing[i]
+            results[i] = result
+    return results
+
+
+def analyze_response_block(data, clamp_mode, pulse_times, spike_times, remove_artifacts=False, deconvolve=True, lpf=True, bsub=True, lowpass=1000):
+    """Perform the analysis of analyze_response_strength on a 2D (n_responses, n_samples) block of data.
+
+    All rows must be recorded in the same clamp mode and share the same sample indices for
+    the pulse onset windows (see analyze_response_strengths); spike times may differ per row.
+
+    Parameters
+    ----------
+    data : array
+        2D array of response data sampled at db.default_sample_rate.
+    clamp_mode : str
+        'ic' or 'vc'
+    pulse_times : array
+        (n_responses, 2) array of stimulus pulse edge times, relative to the start of each row.
+    spike_times : array
+        Array of presynaptic spike times, relative to the start of each row.
+
+    Returns a dict of arrays with one value per row for each of the measurements made by
+    analyze_response_strength, plus 'dec_data', the 2D block of deconvolved / filtered data.
+    """
+    data = np.asarray(data, dtype=float)
+    pulse_times = np.asarray(pulse_times, dtype=float)
+    spike_times = np.asarray(spike_times, dtype=float)
+    n_samples = data.shape[1]
+    t0 = pulse_times[0, 0]
+    results = {}
+
+    # Measure crosstalk from pulse onset
+    i0, i1, i2 = _index_at(np.array([t0-200e-6, t0, t0+200e-6]), n_samples)
+    results['crosstalk'] = np.median(data[:, i1:i2], axis=1) - np.median(data[:, i0:i1], axis=1)
+
+    # crosstalk artifacts in VC are removed before deconvolution
+    if clamp_mode == 'vc' and remove_artifacts is True:
+        data = np.vstack([remove_crosstalk_artifacts(Trace(row, sample_rate=db.default_sample_rate), list(pt)).data for row, pt in zip(data, pulse_times)])
+        remove_artifacts = False
+
+    # Measure deflection on raw data
+    (results['pos_amp'], _), (results['neg_amp'], _) = _measure_peaks(data, spike_times, t0)
+
+    # Deconvolution / artifact removal / filtering
+    dt = 1.0 / db.default_sample_rate
+    if deconvolve:
+        tau = 15e-3 if clamp_mode == 'ic' else 5e-3
+        # same as neuroanalysis.event_detection.exp_deconvolve, applied to all rows
+        dec = data[:, :-1] + (tau / dt) * np.diff(data, axis=1)
+    else:
+        dec = data
+
+    if remove_artifacts:
+        dec = np.vstack([remove_crosstalk_artifacts(Trace(row, sample_rate=db.default_sample_rate), list(pt)).data for row, pt in zip(dec, pulse_times)])
+
+    if bsub:
+        b0, b1 = _index_at(np.array([5e-3, 10e-3]), dec.shape[1])
+        dec = dec - np.median(dec[:, b0:b1], axis=1)[:, None]
+
+    if lpf:
+        # same as neuroanalysis.filter.bessel_filter, applied along the sample axis
+        b, a = scipy.signal.bessel(1, lowpass * dt, btype='low')
+        padding = 100
+        padded = np.hstack([dec[:, :padding][:, ::-1], dec, dec[:, -padding:][:, ::-1]])
+        filtered = scipy.signal.lfilter(b, a, scipy.signal.lfilter(b, a, padded, axis=1)[:, ::-1], axis=1)[:, ::-1]
+        dec = filtered[:, padding:padded.shape[1]-padding]
+    results['dec_data'] = dec
+
+    # Measure deflection on deconvolved data
+    (pos_amp, pos_lat), (neg_amp, neg_lat) = _measure_peaks(dec, spike_times, t0)
+    results['pos_dec_amp'], results['pos_dec_latency'] = pos_amp, pos_lat
+    results['neg_dec_amp'], results['neg_dec_latency'] = neg_amp, neg_lat
+
+    return results
+
+
+def _index_at(t, n_samples):
+    """Return the index of the sample nearest time *t* in data of length *n_samples*,
+    following the rounding / clipping of Trace.index_at.
+    """
+    inds = np.round(np.asarray(t) * db.default_sample_rate).astype(int)
+    return np.clip(inds, 0, n_samples - 1)
+
+
+def _measure_peaks(data, spike_times, pulse_start, spike_delay=1e-3, response_window=4e-3):
+    """Vectorized measure_peak for both signs on a 2D block of data.
+
+    Returns ((pos_amp, pos_latency), (neg_amp, neg_latency)).
+    """
+    n_rows, n_samples = data.shape
+    dt = 1.0 / db.default_sample_rate
+
+    baseline = float_mode_rows(data[:, :_index_at(pulse_start - 50e-6, n_samples)])
+
+    response_start = spike_times + spike_delay
+    r0 = _index_at(response_start, n_samples)
+    r1 = _index_at(response_start + response_window, n_samples)
+    if np.any(r1 <= r0):
+        raise ValueError("Response window is empty for some rows (spike time too close to the end of the data)")
+    width = (r1 - r0).max()
+    cols = r0[:, None] + np.arange(width)[None, :]
+    valid = cols < r1[:, None]
+    rows = np.arange(n_rows)[:, None]
+    response = data[rows, np.minimum(cols, n_samples-1)]
+
+    results = []
+    for fill, argfn in ((-np.inf, np.argmax), (np.inf, np.argmin)):
+        i = argfn(np.where(valid, response, fill), axis=1)
+        peak = response[np.arange(n_rows), i]
+        latency = (i * dt + r0 * dt) - spike_times
+        results.append((peak - baseline, latency))
+    return results
+
+
+def float_mode_rows(data, bins=None):
+    """Return neuroanalysis.baseline.float_mode computed independently for each row of a 2D array.
+    """
+    data = np.asarray(data, dtype=float)
+    n_rows, n = data.shape
+    if bins is None:
+        bins = np.clip(int(n**0.5), 3, 500)
+
+    # same bin edges as np.histogram
+    lo = data.min(axis=1)
+    hi = data.max(axis=1)
+    flat = lo == hi
+    lo = np.where(flat, lo - 0.5, lo)
+    hi = np.where(flat, hi + 0.5, hi)
+    edges = np.linspace(lo, hi, bins + 1, axis=1)
+
+    rows = np.arange(n_rows)[:, None]
+    inds = ((data - lo[:, None]) * (bins / (hi - lo))[:, None]).astype(int)
+    inds = np.clip(inds, 0, bins - 1)
+    # correct for rounding errors at the bin edges, as np.histogram does
+    inds -= data < edges[rows, inds]
+    inds += (data >= edges[rows, inds + 1]) & (inds != bins - 1)
+
+    counts = np.bincount((rows * bins + inds).ravel(), minlength=n_rows * bins).reshape(n_rows, bins)
+    ind = np.argmax(counts, axis=1)
+    r = np.arange(n_rows)
+    return 0.5 * (edges[r, ind] + edges[r, ind + 1])
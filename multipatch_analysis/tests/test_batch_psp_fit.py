@@ -0,0 +1,104 @@
+import numpy as np
+import pytest
+from neuroanalysis.data import Trace
+from neuroanalysis.fitting import StackedPsp
+from multipatch_analysis.batch_psp_fit import psp_batch_func, fit_psp_batch, fit_psp_traces
+from multipatch_analysis.connection_detection import fit_psp
+
+
+def make_psps(n=40, seed=0):
+    rng = np.random.RandomState(seed)
+    t = np.arange(0, 20e-3, 1e-4)
+    true = {
+        'xoffset': rng.uniform(9e-3, 11e-3, n),
+        'yoffset': rng.normal(size=n) * 1e-4,
+        'rise_time': rng.uniform(1.5e-3, 3e-3, n),
+        'decay_tau': rng.uniform(8e-3, 15e-3, n),
+        'amp': rng.uniform(0.5e-3, 2e-3, n) * np.sign(rng.normal(size=n)),
+        'rise_power': np.full(n, 2.0),
+        'amp_ratio': np.zeros(n),
+    }
+    data = psp_batch_func(t, **true) + rng.normal(size=(n, len(t))) * 2e-5
+    return t, data, true
+
+
+def test_psp_batch_func():
+    t, data, true = make_psps(n=5)
+    true['amp_ratio'] = np.linspace(-1, 1, 5)
+    y = psp_batch_func(t, **true)
+    for i in range(5):
+        args = dict([(k, v[i]) for k, v in true.items() if k != 'amp_ratio'])
+        args['exp_amp'] = args['amp'] * true['amp_ratio'][i]
+        args['exp_tau'] = args['decay_tau']
+        assert np.allclose(y[i], StackedPsp.stacked_psp_func(t, **args), rtol=0, atol=1e-15)
+
+
+def test_fit_psp_batch():
+    t, data, true = make_psps()
+    n = len(data)
+    params = {
+        'xoffset': (10e-3, 8e-3, 12e-3),
+        'yoffset': (0, 'fixed'),
+        'rise_time': (2e-3, 0.5e-3, 5e-3),
+        'decay_tau': (10e-3, 1e-3, 50e-3),
+        # per-trace bounds on amplitude sign
+        'amp': (np.sign(true['amp']) * 1e-3, np.where(true['amp'] > 0, 0, -5e-3), np.where(true['amp'] > 0, 5e-3, 0)),
+        'rise_power': (2, 'fixed'),
+        'amp_ratio': (0, -100, 100),
+    }
+    # mask out the first 2 ms of each trace
+    weights = np.ones(len(t))
+    weights[:20] = 0
+    fit = fit_psp_batch(data - true['yoffset'][:, None], t, params, weights=weights)
+
+    assert fit['success'].sum() >= n - 2
+    assert np.all(fit['best_values']['yoffset'] == 0)
+    assert np.all(np.sign(fit['best_values']['amp']) == np.sign(true['amp']))
+    amp_err = np.abs(fit['best_values']['amp'] - true['amp']) / np.abs(true['amp'])
+    assert np.median(amp_err) < 0.05
+    assert np.median(np.abs(fit['best_values']['xoffset'] - true['xoffset'])) < 2e-4
+    assert np.all(fit['residual'][:, :20] == 0)
+    assert np.allclose(fit['chisqr'], (fit['residual']**2).sum(axis=1))
+
+
+def test_fit_psp_traces():
+    # compare against per-trace fits of the same traces with fit_psp
+    rng = np.random.RandomState(1)
+    n = 8
+    dt = 1 / 20000.
+    t = np.arange(0, 60e-3, dt)
+    true = {
+        'xoffset': rng.uniform(12e-3, 16e-3, n),
+        'yoffset': rng.normal(size=n) * 1e-4,
+        'rise_time': rng.uniform(2e-3, 6e-3, n),
+        'decay_tau': rng.uniform(20e-3, 80e-3, n),
+        'amp': rng.uniform(0.5e-3, 3e-3, n),
+        'rise_power': np.full(n, 2.0),
+        'amp_ratio': rng.uniform(-0.5, 0.5, n),
+    }
+    data = psp_batch_func(t, **true) + rng.normal(size=(n, len(t))) * 5e-5
+    traces = [Trace(row, dt=dt) for row in data]
+
+    fit = fit_psp_traces(traces, mode='ic', sign='+')
+    assert fit['success'].sum() >= n - 1
+    for i, trace in enumerate(traces):
+        if not fit['success'][i]:
+            continue
+        ref = fit_psp(trace, mode='ic', sign='+', cache=False)
+        # same (or better) fit quality, and the same parameters within a small tolerance
+        assert fit['chisqr'][i] <= ref.chisqr * 1.001
+        assert abs(fit['best_values']['amp'][i] - ref.best_values['amp']) < 0.01 * ref.best_values['amp']
+        for name, tol in [('xoffset', 50e-6), ('rise_time', 0.05), ('decay_tau', 0.05)]:
+            err = abs(fit['best_values'][name][i] - ref.best_values[name])
+            if name != 'xoffset':
+                err /= ref.best_values[name]
+            assert err < tol, (i, name, fit['best_values'][name][i], ref.best_values[name])
+        assert abs(fit['nrmse'][i] - ref.nrmse()) < 1e-3 * ref.nrmse()
+
+    # fit_psp-style multiple initial conditions are rejected, even if there is one per trace
+    for xoffset in [([12e-3, 14e-3], 10e-3, 18e-3), (list(true['xoffset']), 10e-3, 18e-3), list(true['xoffset'])]:
+        with pytest.raises(ValueError):
+            fit_psp_traces(traces, mode='ic', sign='+', xoffset=xoffset)
+    # per-trace arrays must have one value per trace
+    with pytest.raises(ValueError):
+        fit_psp_traces(traces, mode='ic', sign='+', xoffset=(true['xoffset'][:2], 10e-3, 18e-3))
@@ -0,0 +1,72 @@
+import pytest
+import sqlalchemy
+from sqlalchemy.orm import sessionmaker
+import multipatch_analysis.database as db
+from multipatch_analysis.database.synthetic import SyntheticDataGenerator
+
+
+def test_stream_autocommit(tmpdir):
+    # server-side cursors need a transaction, so autocommit sessions stream on a separate connection
+    db_file = str(tmpdir.join('test.sqlite'))
+    engine = sqlalchemy.create_engine('sqlite:///%s' % db_file)
+    db.database.create_tables(engine=engine)
+    session = sessionmaker(bind=engine)()
+    for i in range(10):
+        session.add(db.Slice(acq_timestamp=float(i)))
+    session.commit()
+    assert db.database._stream_connection(session) is None
+
+    ac_engine = sqlalchemy.create_engine('sqlite:///%s' % db_file, isolation_level='AUTOCOMMIT')
+    ac_session = sessionmaker(bind=ac_engine)()
+    conn = db.database._stream_connection(ac_session)
+    assert conn.get_execution_options()['isolation_level'] == 'SERIALIZABLE'
+    conn.close()
+
+    for sess in (session, ac_session):
+        q = sess.query(db.Slice.acq_timestamp).order_by(db.Slice.acq_timestamp)
+        batches = list(db.stream(q, batch_size=4))
+        assert [len(b) for b in batches] == [4, 4, 2]
+        assert [rec.acq_timestamp for b in db.stream(q, batch_size=4, as_array=False) for rec in b] == list(range(10))
+
+
+def test_sqlite_engine_readonly(tmpdir):
+    # a wrong path must fail rather than create a new, empty database
+    missing = tmpdir.join('missing.sqlite')
+    engine = db.database.sqlite_engine('sqlite:///%s' % missing)
+    with pytest.raises(sqlalchemy.exc.OperationalError):
+        engine.connect()
+    assert not missing.exists()
+
+    db_file = tmpdir.join('test.sqlite')
+    db.database.create_tables(engine=sqlalchemy.create_engine('sqlite:///%s' % db_file))
+    engine = db.database.sqlite_engine('sqlite:///%s' % db_file)
+    session = sessionmaker(bind=engine)()
+    assert session.query(db.Slice).count() == 0
+    session.add(db.Slice(acq_timestamp=1.0))
+    with pytest.raises(sqlalchemy.exc.OperationalError):
+        session.commit()
+
+
+def test_load_experiments_session(tmpdir, monkeypatch):
+    # objects loaded without an explicit session must stay loaded (no lazy loads when walked)
+    engine = sqlalchemy.create_engine('sqlite:///%s' % tmpdir.join('test.sqlite'))
+    db.database.create_tables(engine=engine)
+    SyntheticDataGenerator(sessionmaker(bind=engine)(), n_cells=3, n_sweeps=3).generate(2)
+    monkeypatch.setattr(db, 'Session', sessionmaker(bind=engine))
+
+    queries = []
+    sqlalchemy.event.listen(engine, 'before_cursor_execute', lambda *args: queries.append(args[2]))
+    expts = db.load_experiments(pulse_responses=True)
+    assert len(queries) > 0
+    del queries[:]
+
+    n_responses = 0
+    for expt in expts.values():
+        for pair in expt.pair_list:
+            assert pair.pre_cell.experiment is expt
+            for pr in pair.pulse_responses:
+                n_responses += 1
+                assert pr.stim_pulse.recording.patch_clamp_recording.clamp_mode in ('ic', 'vc')
+                assert pr.recording.electrode is not None
+    assert n_responses > 0
+    assert queries == []
@@ -0,0 +1,64 @@
+import numpy as np
+import pytest
+import sqlalchemy
+from sqlalchemy.orm import sessionmaker
+import multipatch_analysis.database as db
+from multipatch_analysis.database.dataset import pulse_waveform
+from multipatch_analysis.database.synthetic import SyntheticDataGenerator
+
+
+class Pulse(object):
+    def __init__(self, onset_time, duration, amplitude):
+        self.onset_time = onset_time
+        self.duration = duration
+        self.amplitude = amplitude
+
+
+def test_pulse_waveform():
+    pulses = [Pulse(1e-3, 0.5e-3, 2.), Pulse(3e-3, 1e-3, -1.)]
+    data = pulse_waveform(pulses, 0.5e-3, 100, sample_rate=20000)
+    expected = np.zeros(100)
+    expected[10:20] = 2.
+    expected[50:70] = -1.
+    assert np.all(data == expected)
+
+    # t0 between samples; pulses stay on the same samples as in the recording
+    assert np.all(pulse_waveform(pulses, 0.51e-3, 100, sample_rate=20000) == expected)
+
+    # pulses are clipped to the window
+    data = pulse_waveform(pulses, 1.25e-3, 40, sample_rate=20000)
+    assert np.all(data[:5] == 2.) and np.all(data[5:35] == 0) and np.all(data[35:] == -1.)
+
+
+@pytest.mark.parametrize('store_recording_data', [False, True])
+def test_stimulus_tseries(tmpdir, store_recording_data):
+    engine = sqlalchemy.create_engine('sqlite:///%s' % tmpdir.join('test.sqlite'))
+    db.database.create_tables(engine=engine)
+    gen = SyntheticDataGenerator(sessionmaker(bind=engine)(), n_cells=2, n_sweeps=2, store_recording_data=store_recording_data)
+    gen.generate(1)
+
+    session = sessionmaker(bind=engine)()
+    pulses = session.query(db.StimPulse).order_by(db.StimPulse.id).all()
+    assert len(pulses) > 0
+    for pulse in pulses:
+        # generated stimulus is aligned with the stored chunk
+        n_samples = pulse.n_samples
+        stim = pulse.stimulus_tseries
+        rec = pulse.recorded_tseries
+        assert n_samples == len(stim.data) == len(rec.data)
+        assert stim.t0 == rec.t0 == pulse.data_start_time
+        on = np.argwhere(stim.data != 0)[:, 0]
+        assert on[0] == 200 and len(on) == 40
+        assert np.all(stim.data[on] == pulse.amplitude)
+
+    responses = session.query(db.PulseResponse).order_by(db.PulseResponse.id).all()
+    assert len(responses) > 0
+    for resp in responses:
+        stim = resp.response_stimulus_tseries()
+        assert len(stim.data) == len(resp.post_tseries.data)
+        assert stim.t0 == resp.start_time
+        # waveform includes the evoking pulse and any later pulses in the train
+        expected = pulse_waveform(resp.stim_pulse.recording.stim_pulses, resp.start_time, len(stim.data))
+        assert np.all(stim.data == expected)
+        assert np.argmax(stim.data != 0) == 200
+        assert len(resp.response_stimulus_tseries(duration=10e-3).data) == 200
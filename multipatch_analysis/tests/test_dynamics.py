@@ -0,0 +1,58 @@
+import numpy as np
+from multipatch_analysis.dynamics import stp_table, pulse_ratio
+
+
+dtype = [('pair_id', int), ('recording_id', int), ('clamp_mode', object), ('induction_frequency', float),
+         ('recovery_delay', float), ('pulse_number', int), ('ex_qc_pass', bool), ('in_qc_pass', bool),
+         ('pos_dec_amp', float), ('neg_dec_amp', float)]
+
+
+def make_records():
+    """Two pairs (one excitatory, one inhibitory) with 12-pulse trains at two frequencies and recovery delays.
+    """
+    rows = []
+    rec_id = 0
+    for pair_id, sign in [(1, 1), (2, -1)]:
+        for freq in (20., 50.):
+            for delay in (0.25, 0.5):
+                for sweep in range(3):
+                    rec_id += 1
+                    for pulse in range(1, 13):
+                        # depressing during induction, recovering with longer delays
+                        if pulse <= 8:
+                            amp = 1.0 * (0.9 if freq == 50 else 0.95) ** (pulse - 1)
+                        else:
+                            amp = 0.8 if delay == 0.5 else 0.6
+                        amp = amp * (1 + 0.1 * sweep) * 1e-3
+                        # one failed QC pulse excludes the entire sweep
+                        qc = not (pair_id == 1 and freq == 50 and delay == 0.5 and sweep == 2 and pulse == 5)
+                        rows.append((pair_id, rec_id, 'ic', freq, delay, pulse, qc, qc, amp * sign if sign > 0 else 0.,
+                                     amp * sign if sign < 0 else 0.))
+    return np.array(rows, dtype=dtype)
+
+
+def test_stp_table():
+    recs = make_records()
+    stp = stp_table(recs, {1: 'ex', 2: 'in', 3: 'ex'})
+    assert sorted(stp.keys()) == [1, 2]
+    assert sorted(stp[1]['ic'].keys()) == ['20', '50']
+
+    entry = stp[1]['ic']['50']
+    assert entry['n_sweeps'] == 5
+    assert len(entry['pulse_ratios']) == 8
+    assert np.allclose(entry['pulse_ratios'], 0.9 ** np.arange(8))
+    assert pulse_ratio(stp[1], 'ic', 50, 8) == entry['pulse_ratios'][7]
+    assert pulse_ratio(stp[1], 'vc', 50, 8) is None
+
+    rec = entry['recovery']['0.5']
+    assert rec['n_sweeps'] == 2
+    assert np.allclose(rec['pulse_ratios'], [0.8] * 4)
+    assert np.isclose(rec['recovery_index'], 0.8 / np.mean(0.9 ** np.arange(4)))
+    assert entry['recovery']['0.25']['n_sweeps'] == 3
+
+    # inhibitory pair uses negative amplitudes; ratios are sign-independent
+    assert np.allclose(stp[2]['ic']['20']['pulse_ratios'], 0.95 ** np.arange(8))
+    assert stp[2]['ic']['20']['pulse_amps'][0] < 0
+
+    # pairs with no usable sweeps are absent
+    assert stp_table(recs, {3: 'ex'}) == {}
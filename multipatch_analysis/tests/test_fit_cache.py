@@ -0,0 +1,147 @@
+import os, time
+import numpy as np
+from neuroanalysis.data import Trace
+from neuroanalysis.fitting import Psp
+from multipatch_analysis import config, fit_cache, connection_detection
+
+
+def test_fit_key():
+    y = np.linspace(0, 1, 100)
+    params = {'amp': (0.2e-3, 0, 100e-3), 'rise_power': (2, 'fixed')}
+    key = fit_cache.fit_key(y, params, method='leastsq')
+    assert key == fit_cache.fit_key(y.copy(), dict(params), method='leastsq')
+
+    y2 = y.copy()
+    y2[50] += 1e-12
+    assert key != fit_cache.fit_key(y2, params, method='leastsq')
+    assert key != fit_cache.fit_key(y.astype('float32'), params, method='leastsq')
+    assert key != fit_cache.fit_key(y, {'amp': (0.2e-3, 0, 50e-3), 'rise_power': (2, 'fixed')}, method='leastsq')
+    assert key != fit_cache.fit_key(y, params, method='nelder')
+
+
+def make_trace():
+    dt = 1 / 20000.
+    t = np.arange(0, 60e-3, dt)
+    rng = np.random.RandomState(0)
+    data = Psp.psp_func(t, 13e-3, 0, 3e-3, 40e-3, 1e-3, 2) + rng.normal(size=len(t)) * 5e-5
+    return Trace(data, dt=dt)
+
+
+def test_cached_fit(tmpdir, monkeypatch):
+    monkeypatch.setattr(config, 'cache_path', str(tmpdir))
+    monkeypatch.setattr(config, 'fit_cache', True, raising=False)
+    calls = []
+    fit_psp_starts = connection_detection.fit_psp_starts
+    def count_fits(*args, **kwds):
+        calls.append(1)
+        return fit_psp_starts(*args, **kwds)
+    monkeypatch.setattr(connection_detection, 'fit_psp_starts', count_fits)
+
+    trace = make_trace()
+    fit = connection_detection.fit_psp(trace, mode='ic', sign='+')
+    assert len(calls) == 1
+    assert len(os.listdir(fit_cache.cache_dir())) == 1
+
+    # cached result is an equivalent ModelResult
+    fit2 = connection_detection.fit_psp(trace, mode='ic', sign='+')
+    assert len(calls) == 1
+    assert fit2 is not fit
+    assert fit2.best_values == fit.best_values
+    for attr in ('best_fit', 'residual', 'data', 'weights'):
+        assert np.all(getattr(fit2, attr) == getattr(fit, attr))
+    assert fit2.chisqr == fit.chisqr
+    assert fit2.nrmse() == fit.nrmse()
+    assert fit2.params['amp'].value == fit.params['amp'].value
+    assert np.allclose(fit2.eval(x=trace.time_values), fit.best_fit)
+
+    # different settings are fit again
+    connection_detection.fit_psp(trace, mode='ic', sign='+', rise_time_mult_factor=5.)
+    assert len(calls) == 2
+
+    # fit_cache.cached_fit works the same way for any fitting function
+    fit3 = fit_cache.cached_fit(connection_detection.fit_psp, trace, mode='ic', sign='+', cache=False)
+    fit4 = fit_cache.cached_fit(connection_detection.fit_psp, trace, mode='ic', sign='+', cache=False)
+    assert len(calls) == 3
+    assert fit4.best_values == fit3.best_values == fit.best_values
+
+    # corrupt cache files are ignored and replaced
+    for fname in os.listdir(fit_cache.cache_dir()):
+        open(os.path.join(fit_cache.cache_dir(), fname), 'wb').write(b'xxx')
+    connection_detection.fit_psp(trace, mode='ic', sign='+')
+    assert len(calls) == 4
+    connection_detection.fit_psp(trace, mode='ic', sign='+')
+    assert len(calls) == 4
+
+    monkeypatch.setattr(config, 'fit_cache', False)
+    connection_detection.fit_psp(trace, mode='ic', sign='+')
+    assert len(calls) == 5
+
+
+def test_limit_size(tmpdir, monkeypatch):
+    monkeypatch.setattr(config, 'cache_path', str(tmpdir))
+    rng = np.random.RandomState(0)
+    keys = []
+    for i in range(5):
+        key = fit_cache.fit_key(i)
+        fit_cache.store(key, rng.normal(size=10000))
+        # make access order unambiguous
+        t = time.time() - 100 + i
+        os.utime(os.path.join(fit_cache.cache_dir(), key + '.pkl.z'), (t, t))
+        keys.append(key)
+
+    # reading an entry marks it as recently used
+    assert fit_cache.get(keys[0]) is not None
+    size = os.path.getsize(os.path.join(fit_cache.cache_dir(), keys[0] + '.pkl.z'))
+    fit_cache.limit_size(size * 2.5)
+    remaining = [k for k in keys if fit_cache.get(k) is not None]
+    assert remaining == [keys[0], keys[4]]
+
+
+def test_store_size_check(tmpdir, monkeypatch):
+    # the cache directory is scanned only when the estimated size passes the limit
+    monkeypatch.setattr(config, 'cache_path', str(tmpdir))
+    monkeypatch.setattr(fit_cache, 'size_check_interval', 20)
+    calls = []
+    limit_size = fit_cache.limit_size
+    def count_checks(max_bytes):
+        calls.append(max_bytes)
+        return limit_size(max_bytes)
+    monkeypatch.setattr(fit_cache, 'limit_size', count_checks)
+
+    data = np.random.RandomState(0).normal(size=1000)
+    fit_cache.store(fit_cache.fit_key(0), data)
+    size = os.path.getsize(os.path.join(fit_cache.cache_dir(), fit_cache.fit_key(0) + '.pkl.z'))
+    monkeypatch.setattr(config, 'fit_cache_size', size * 6.5 / 1e6, raising=False)
+    for i in range(1, 5):
+        fit_cache.store(fit_cache.fit_key(i), data)
+    assert len(calls) == 1
+    fit_cache.store(fit_cache.fit_key(5), data)
+    assert len(calls) == 1
+    # estimate passes the limit
+    fit_cache.store(fit_cache.fit_key(6), data)
+    assert len(calls) == 2
+    assert len(os.listdir(fit_cache.cache_dir())) == 6
+
+    # periodic check even if the estimate stays below the limit
+    monkeypatch.setattr(config, 'fit_cache_size', 1000, raising=False)
+    for i in range(19):
+        fit_cache.store(fit_cache.fit_key(i + 10), data)
+    assert len(calls) == 2
+    fit_cache.store(fit_cache.fit_key(100), data)
+    assert len(calls) == 3
+
+
+def test_store_errors(tmpdir, monkeypatch):
+    # cache write failures are logged, not raised
+    blocker = tmpdir.join('not_a_dir')
+    blocker.write('')
+    monkeypatch.setattr(config, 'cache_path', str(blocker))
+    fit_cache.store(fit_cache.fit_key(1), np.arange(10))
+    assert fit_cache.get(fit_cache.fit_key(1)) is None
+
+    monkeypatch.setattr(config, 'cache_path', str(tmpdir))
+    def fail(src, dst):
+        raise OSError("replace failed")
+    monkeypatch.setattr(fit_cache, 'replace_file', fail)
+    fit_cache.store(fit_cache.fit_key(2), np.arange(10))
+    assert os.listdir(fit_cache.cache_dir()) == []
@@ -0,0 +1,57 @@
+import sqlalchemy
+from sqlalchemy.orm import sessionmaker
+import multipatch_analysis.database as db
+
+
+# connection strength query that pair_summary replaced in strength_analysis.query_all_pairs
+old_query = """
+    select connection_strength.id from connection_strength
+    join pair on connection_strength.pair_id=pair.id
+    join cell pre_cell on pair.pre_cell_id=pre_cell.id
+    join cell post_cell on pair.post_cell_id=post_cell.id
+    join morphology pre_morphology on pre_morphology.cell_id=pre_cell.id
+    join morphology post_morphology on post_morphology.cell_id=post_cell.id
+    join experiment on pair.experiment_id=experiment.id
+    join slice on experiment.slice_id=slice.id
+    order by experiment.acq_timestamp
+"""
+
+
+def test_strength_summary_query(tmpdir):
+    engine = sqlalchemy.create_engine('sqlite:///%s' % tmpdir.join('test.sqlite'))
+    db.database.create_tables(engine=engine)
+    session = sessionmaker(bind=engine)()
+
+    for i in range(2):
+        expt = db.Experiment(acq_timestamp=float(i), slice=db.Slice(acq_timestamp=float(i)))
+        cells = [db.Cell(experiment=expt, ext_id=j+1) for j in range(3)]
+        # third cell has no morphology record
+        for cell in cells[:2]:
+            session.add(db.Morphology(cell=cell, pyramidal=True))
+        for pre in cells:
+            for post in cells:
+                if pre is post:
+                    continue
+                pair = db.Pair(experiment=expt, pre_cell=pre, post_cell=post)
+                cs = db.ConnectionStrength(pair=pair)
+                session.add(cs)
+                session.flush()
+                session.add(db.PairSummary(
+                    pair=pair, experiment_id=expt.id, acq_timestamp=expt.acq_timestamp,
+                    pre_cell_id=pre.id, post_cell_id=post.id, pre_cell_ext_id=pre.ext_id, post_cell_ext_id=post.ext_id,
+                    connection_strength_id=cs.id,
+                ))
+    # pair summary without connection strength results
+    pair = db.Pair(experiment=expt, pre_cell=cells[0], post_cell=cells[1])
+    session.add(db.PairSummary(pair=pair, pre_cell_id=cells[0].id, post_cell_id=cells[1].id))
+    session.commit()
+
+    old_ids = [r[0] for r in session.execute(old_query)]
+    assert len(old_ids) == 4
+
+    recs = session.execute(db.strength_summary_query()).fetchall()
+    assert sorted(old_ids) == sorted([r.id for r in recs])
+    assert sorted(set(r.pre_cell_id for r in recs)) == [1, 2]
+
+    all_recs = session.execute(db.strength_summary_query(require_morphology=False)).fetchall()
+    assert len(all_recs) == 12
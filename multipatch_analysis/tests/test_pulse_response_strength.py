@@ -0,0 +1,44 @@
+from collections import namedtuple
+import numpy as np
+from neuroanalysis.baseline import float_mode
+from multipatch_analysis.pulse_response_strength import analyze_response_strength, analyze_response_strengths, float_mode_rows
+
+
+Record = namedtuple('Record', 'response_id data rec_start pulse_start pulse_dur spike_time clamp_mode')
+
+measurements = ['pos_amp', 'neg_amp', 'pos_dec_amp', 'neg_dec_amp', 'pos_dec_latency', 'neg_dec_latency', 'crosstalk']
+
+
+def make_records(n_recs=200, seed=0):
+    rng = np.random.RandomState(seed)
+    recs = []
+    for i in range(n_recs):
+        # mix of data lengths, clamp modes, pulse onsets and missing spikes
+        n_samples = 1000 if i % 7 else 900
+        rec_start = rng.uniform(0, 10)
+        data = rng.normal(size=n_samples) * 1e-4 + np.sin(np.arange(n_samples) / 30.) * 1e-3
+        spike_time = None if i % 13 == 0 else rec_start + 10e-3 + rng.uniform(0.5e-3, 2e-3)
+        recs.append(Record(i, data, rec_start, rec_start + 10e-3 + (i % 3) * 1e-5, 2e-3, spike_time, 'ic' if i % 2 else 'vc'))
+    return recs
+
+
+def test_float_mode_rows():
+    rng = np.random.RandomState(0)
+    data = rng.normal(size=(50, 190))
+    data[3] = 1.0
+    data[4, :50] = 2.0
+    modes = float_mode_rows(data)
+    for i in range(len(data)):
+        assert modes[i] == float_mode(data[i])
+
+
+def test_batch_response_strength():
+    recs = make_records()
+    for source in ('pulse_response', 'baseline'):
+        for opts in ({}, {'remove_artifacts': True}, {'deconvolve': False, 'lpf': False, 'bsub': False}):
+            batch = analyze_response_strengths(recs, source, **opts)
+            for rec, result in zip(recs, batch):
+                expected = analyze_response_strength(rec, source, **opts)
+                for k in measurements:
+                    assert result[k] == expected[k]
+                assert np.array_equal(result['dec_data'], expected['dec_trace'].data)
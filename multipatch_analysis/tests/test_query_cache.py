@@ -0,0 +1,30 @@
+import datetime
+import sqlalchemy
+from sqlalchemy.orm import sessionmaker
+from multipatch_analysis import config
+import multipatch_analysis.database as db
+
+
+def test_cache_keeps_caller_transaction(tmpdir, monkeypatch):
+    monkeypatch.setattr(config, 'cache_path', str(tmpdir))
+    engine = sqlalchemy.create_engine('sqlite:///%s' % tmpdir.join('test.sqlite'))
+    db.database.create_tables(engine=engine)
+    session = sessionmaker(bind=engine)()
+    session.add(db.Experiment(acq_timestamp=1.0, slice=db.Slice(acq_timestamp=1.0)))
+    session.add(db.Pipeline(module_name='experiment', job_id=1.0, finish_time=datetime.datetime.now(), success=True))
+    session.commit()
+
+    # uncommitted changes in the caller's session
+    expt = session.query(db.Experiment).one()
+    expt.project_name = 'pending'
+    session.add(db.Experiment(acq_timestamp=2.0, slice=expt.slice))
+    session.flush()
+
+    q = session.query(db.Experiment.acq_timestamp).order_by(db.Experiment.acq_timestamp)
+    recs = db.query_cache.read_array(q, session=session)
+    # results are read outside of the caller's transaction..
+    assert list(recs['acq_timestamp']) == [1.0]
+    # ..and the caller's transaction is left intact
+    assert expt.project_name == 'pending'
+    session.commit()
+    assert session.query(db.Experiment).count() == 2
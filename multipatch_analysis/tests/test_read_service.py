@@ -0,0 +1,93 @@
+from collections import OrderedDict
+import numpy as np
+from multipatch_analysis import config
+from multipatch_analysis.database import read_service
+
+
+def make_records(session, n=5):
+    arr = np.empty(n, dtype=[('id', 'i8'), ('amp', 'f8'), ('ok', '?'), ('name', object), ('data', object)])
+    arr['id'] = np.arange(n)
+    arr['amp'] = np.linspace(-1e-3, 1e-3, n)
+    arr['ok'] = arr['id'] % 2 == 0
+    for i in range(n):
+        arr['name'][i] = None if i == 1 else 'rec %d' % i
+        arr['data'][i] = None if i == 2 else np.arange(i * 3, dtype='float32').reshape(i, 3)
+    return arr
+
+
+def assert_records_equal(a, b):
+    assert a.dtype.names == b.dtype.names
+    for name in ('id', 'amp', 'ok', 'name'):
+        assert list(a[name]) == list(b[name])
+    for x, y in zip(a['data'], b['data']):
+        if x is None:
+            assert y is None
+        else:
+            assert x.dtype == y.dtype
+            assert np.all(x == y)
+
+
+def test_encode_roundtrip():
+    arr = make_records(None)
+    header, body = read_service.encode_array(arr)
+    assert_records_equal(read_service.decode_array(header, body), arr)
+
+    empty = read_service.decode_array(*read_service.encode_array(arr[:0]))
+    assert len(empty) == 0 and empty.dtype.names == arr.dtype.names
+
+
+def test_client_server():
+    calls = []
+    def records(session, n):
+        calls.append(n)
+        return make_records(session, n)
+
+    state = [0]
+    ops = OrderedDict([('records', (records, ['pulse_response']))])
+    server = read_service.ReadServer(address=('127.0.0.1', 0), ops=ops, state_fn=lambda session, tables: state[0], state_interval=0).start()
+    try:
+        client = read_service.ReadClient(server.address)
+        assert_records_equal(client.call('records', n=5), make_records(None, 5))
+
+        # second request is served from cache
+        assert_records_equal(client.call('records', n=5), make_records(None, 5))
+        assert calls == [5]
+        assert server.stats['cache_hits'] == 1
+
+        # pipeline state changes invalidate cached results
+        state[0] = 1
+        client.call('records', n=5)
+        assert calls == [5, 5]
+
+        try:
+            client.call('no_such_op')
+            raise AssertionError("expected ReadServiceError")
+        except read_service.ReadServiceError:
+            pass
+        client.close()
+    finally:
+        server.stop()
+
+
+def test_fallback():
+    # with no service listening, call() runs the operation directly
+    server = read_service.ReadServer(address=('127.0.0.1', 0), ops={}, state_fn=lambda session, tables: None)
+    address = server.address
+    server.stop()
+
+    client = read_service.ReadClient(address, timeout=1)
+    try:
+        client.call('records', n=3)
+        raise AssertionError("expected ServiceUnavailable")
+    except read_service.ServiceUnavailable:
+        pass
+
+    read_service.ops['test_records'] = (make_records, [])
+    orig_address = config.read_service_address
+    config.read_service_address = '%s:%d' % address
+    try:
+        assert_records_equal(read_service.call('test_records', n=3), make_records(None, 3))
+    finally:
+        config.read_service_address = orig_address
+        read_service._unavailable_until = 0
+        del read_service.ops['test_records']
@@ -0,0 +1,29 @@
+import numpy as np
+from multipatch_analysis.util import nearest_unused_match
+
+
+def brute_force_match(targets, candidates):
+    used = np.zeros(len(candidates), dtype=bool)
+    matches = []
+    for t in targets:
+        order = np.argsort(np.abs(candidates - t), kind='mergesort')
+        unused = [j for j in order if not used[j]]
+        if len(unused) == 0:
+            matches.append(-1)
+            continue
+        used[unused[0]] = True
+        matches.append(unused[0])
+    return np.array(matches)
+
+
+def test_nearest_unused_match():
+    rng = np.random.RandomState(0)
+    for n_targets, n_candidates in [(0, 5), (5, 0), (20, 20), (50, 30), (30, 50), (200, 400)]:
+        for step in (None, 1.0):
+            targets = rng.uniform(0, 100, size=n_targets)
+            candidates = rng.uniform(0, 100, size=n_candidates)
+            if step is not None:
+                # many exact ties and duplicate candidates
+                targets = np.round(targets / 10) * 10 + 5 * (rng.uniform(size=n_targets) > 0.5)
+                candidates = np.round(candidates / 10) * 10
+            assert np.array_equal(nearest_unused_match(targets, candidates), brute_force_match(targets, candidates))
@@ -1,5 +1,6 @@
 from __future__ import print_function
 import os, sys, time, datetime, logging.handlers, re
+import numpy as np
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
@@ -274,3 +275,82 @@ def mkdir(path, test=False):
         if root != '':
             mkdir(root)
         os.mkdir(path)
+
+
+def replace_file(src, dst):
+    """Rename *src* to *dst*, atomically replacing *dst* if it exists.
+
+    Readers of *dst* see either the old or the new file, never a missing or partial one.
+    """
+    if hasattr(os, 'replace'):
+        os.replace(src, dst)
+    else:
+        try:
+            # python 2: rename replaces existing files atomically on posix
+            os.rename(src, dst)
+        except OSError:
+            # ..but not on windows
+            if not os.path.exists(dst):
+                raise
+            os.remove(dst)
+            os.rename(src, dst)
+
+
+def nearest_unused_match(targets, candidates):
+    """For each value in *targets* (in order), select the nearest value in *candidates* that
+    has not already been selected.
+
+    This is equivalent to looping over targets and choosing the unused candidate with the
+    smallest absolute difference, but requires only a single sort of the candidates.
+    Ties are broken in favor of the candidate with the lowest index.
+
+    Returns an integer array of the same length as *targets* giving the index of the
+    candidate matched to each target, or -1 where all candidates were already used.
+    """
+    targets = np.asarray(targets, dtype=float)
+    candidates = np.asarray(candidates, dtype=float)
+    order = np.argsort(candidates, kind='mergesort')
+    values = candidates[order]
+    n = len(values)
+
+    # "next unused" pointers over sorted positions, with path compression:
+    # right[i] is the first unused position >= i (n if none);
+    # left[i+1] is the last unused position <= i, plus one (0 if none).
+    right = list(range(n + 1))
+    left = list(range(n + 1))
+
+    def find(ptr, i):
+        root = i
+        while ptr[root] != root:
+            root = ptr[root]
+        while ptr[i] != root:
+            ptr[i], i = root, ptr[i]
+        return root
+
+    matches = np.empty(len(targets), dtype=int)
+    insert = np.searchsorted(values, targets, side='left')
+    for i, t in enumerate(targets):
+        r = find(right, insert[i])
+        l = find(left, insert[i]) - 1
+        if l >= 0:
+            # among unused candidates with equal values, use the first (lowest index)
+            l = find(right, np.searchsorted(values, values[l], side='left'))
+        if r == n and l < 0:
+            matches[i] = -1
+            continue
+        if r == n:
+            j = l
+        elif l < 0:
+            j = r
+        else:
+            dl = t - values[l]
+            dr = values[r] - t
+            if dl == dr:
+                j = l if order[l] < order[r] else r
+            else:
+                j = l if dl < dr else r
+        matches[i] = order[j]
+        # mark sorted position j as used
+        right[j] = j + 1
+        left[j + 1] = j
+    return matches
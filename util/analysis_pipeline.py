@@ -23,12 +23,17 @@ if __name__ == '__main__':
     parser.add_argument('--drop', action='store_true', default=False, help="Drop selected analysis results (do not run updates)", )
     parser.add_argument('--vacuum', action='store_true', default=False, help="Run VACUUM ANALYZE on the database to optimize its query planner", )
     parser.add_argument('--bake', action='store_true', default=False, help="Bake an sqlite file after the pipeline update completes", )
+    parser.add_argument('--incremental', action='store_true', default=False, help="When baking, only update experiments that changed since the sqlite file was last baked", )
+    parser.add_argument('--monitor-queries', action='store_true', default=False, help="Record timing and call sites of all database queries, and report the most expensive / repeated queries per module", dest='monitor_queries')
     
     
     args = parser.parse_args(sys.argv[1:])
 
     if args.local:
         pg.dbg()
+
+    if args.monitor_queries:
+        config.query_monitor = True
     
     if 'all' in args.modules:
         modules = list(all_modules.values())
@@ -55,7 +60,7 @@ if __name__ == '__main__':
         mod_names = ', '.join([module.name for module in modules])
         args.rebuild = raw_input("Rebuild modules: %s? " % mod_names) == 'y'
 
-    if args.bake and os.path.exists(config.synphys_db_sqlite):
+    if args.bake and os.path.exists(config.synphys_db_sqlite) and not args.incremental:
         msg = "sqlite database file %s already exists; ok to overwrite? " % config.synphys_db_sqlite
         ans = raw_input(msg)
         if ans == 'y':
@@ -104,6 +109,15 @@ if __name__ == '__main__':
         for module, result in report:
             print("{name:20s}  dropped: {n_dropped:6d}  updated: {n_updated:6d} ({n_retry:6d} retry)  errors: {n_errors:6d}".format(name=module.name, **result))
 
+        if args.monitor_queries:
+            print("\n================== Query Report ===========================")
+            for module, result in report:
+                stats = module.query_stats(job_ids=result['job_ids'])
+                if stats is None:
+                    continue
+                print("------ %s -------" % module.name)
+                print(db.query_monitor.format_summary(stats))
+
     if args.bake:
         print("\n================== Bake Sqlite ===========================")
-        db.bake_sqlite(config.synphys_db_sqlite)
+        db.bake_sqlite(config.synphys_db_sqlite, incremental=args.incremental)
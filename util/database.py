@@ -10,6 +10,16 @@ parser = argparse.ArgumentParser()
 parser.add_argument('--reset-db', action='store_true', default=False, help="Drop all tables in the database.", dest='reset_db')
 parser.add_argument('--vacuum', action='store_true', default=False, help="Ask the database to clean/optimize itself.")
 parser.add_argument('--bake', action='store_true', default=False, help="Bake current database into an sqlite file.")
+parser.add_argument('--incremental', action='store_true', default=False, help="Update a previously baked sqlite file with only the experiments that have changed.")
+parser.add_argument('--sqlite-file', type=str, default=None, help="sqlite file to bake into (default is config.synphys_db_sqlite).", dest='sqlite_file')
+parser.add_argument('--project', type=str, default=None, help="Comma-separated list of project names to include in the baked file.")
+parser.add_argument('--species', type=str, default=None, help="Comma-separated list of species to include in the baked file.")
+parser.add_argument('--acsf', type=str, default=None, help="Comma-separated list of ACSF solutions to include in the baked file.")
+parser.add_argument('--internal', type=str, default=None, help="Comma-separated list of internal solutions to include in the baked file.")
+parser.add_argument('--age', type=str, default=None, help="Range of specimen ages (in days) to include in the baked file, e.g. '40:60' or '40:'.")
+parser.add_argument('--uids', type=str, default=None, help="Comma-separated list of experiment timestamps to include in the baked file.")
+parser.add_argument('--skip-arrays', action='store_true', default=False, help="Leave all array data (recordings, averages) out of the baked file.", dest='skip_arrays')
+parser.add_argument('--export-columnar', type=str, default=None, help="Export analysis tables to columnar files in the given directory.", dest='export_columnar')
 parser.add_argument('--dbg', action='store_true', default=False, help="Start debugging console.")
 
 args = parser.parse_args(sys.argv[1:])
@@ -35,15 +45,31 @@ if args.vacuum:
 
 
 if args.bake:
-    if os.path.exists(config.synphys_db_sqlite):
-        msg = "sqlite database file %s already exists; ok to overwrite? " % config.synphys_db_sqlite
+    sqlite_file = args.sqlite_file or config.synphys_db_sqlite
+
+    filters = {}
+    for arg, name in [('project', 'project_name'), ('species', 'species'), ('acsf', 'acsf'), ('internal', 'internal')]:
+        val = getattr(args, arg)
+        if val is not None:
+            filters[name] = val.split(',')
+    if args.age is not None:
+        filters['age'] = [int(x) if x != '' else None for x in args.age.split(':')]
+    if args.uids is not None:
+        filters['experiment_ids'] = [float(uid) for uid in args.uids.split(',')]
+    
+    if os.path.exists(sqlite_file) and not args.incremental:
+        msg = "sqlite database file %s already exists; ok to overwrite? " % sqlite_file
         ans = raw_input(msg)
         if ans == 'y':
             print("  Ok, you asked for it..")
-            os.remove(config.synphys_db_sqlite)
+            os.remove(sqlite_file)
         else:
             print("  Phooey.")
             sys.exit(0)
         
-    db.bake_sqlite(config.synphys_db_sqlite)            
-            
\ No newline at end of file
+    db.bake_sqlite(sqlite_file, incremental=args.incremental, skip_arrays=args.skip_arrays, **filters)
+
+
+if args.export_columnar is not None:
+    from multipatch_analysis.database import columnar
+    columnar.export_columnar(args.export_columnar)
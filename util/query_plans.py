@@ -0,0 +1,271 @@
+"""Query plan regression checks for canonical workload queries.
+
+Runs a registry of the queries that dominate pipeline and analysis time against the
+configured database, captures their plans (EXPLAIN (ANALYZE, BUFFERS) on postgres,
+EXPLAIN QUERY PLAN on sqlite), timings and buffer counts, and compares them to a stored
+baseline. Changes in plan shape (for example an index scan turning into a sequential
+scan after a schema change) and large increases in cost, time or buffer usage are
+reported as regressions.
+
+Usage:
+
+    # record a baseline
+    python util/query_plans.py --baseline query_plans.json --update
+
+    # after changing schema / indexes, compare against the baseline
+    python util/query_plans.py --baseline query_plans.json
+
+The baseline also records the experiment / pair used to parameterize each query so that
+later runs measure exactly the same queries.
+"""
+from __future__ import print_function, division
+import argparse, sys, os, re, json, time
+from collections import OrderedDict
+
+import sqlalchemy
+import multipatch_analysis.database as db
+from multipatch_analysis.pulse_response_strength import response_query, baseline_query
+from multipatch_analysis.connection_strength import amps_query, baseline_amps_query
+from multipatch_analysis.connectivity import query_pairs
+
+
+canonical_queries = OrderedDict()
+
+def canonical_query(name):
+    """Decorator registering a function ``fn(session, sample)`` that returns a query to be checked.
+    """
+    def register(fn):
+        canonical_queries[name] = fn
+        return fn
+    return register
+
+
+@canonical_query('response_query')
+def _response_query(session, sample):
+    return response_query(session).filter(db.PulseResponse.experiment_id==sample['experiment_id'])
+
+
+@canonical_query('baseline_query')
+def _baseline_query(session, sample):
+    return baseline_query(session).filter(db.Baseline.experiment_id==sample['experiment_id'])
+
+
+@canonical_query('get_amps')
+def _get_amps(session, sample):
+    pair = session.query(db.Pair).filter(db.Pair.id==sample['pair_id']).one()
+    return amps_query(session, pair, clamp_mode='ic', get_data=True)
+
+
+@canonical_query('get_baseline_amps')
+def _get_baseline_amps(session, sample):
+    pair = session.query(db.Pair).filter(db.Pair.id==sample['pair_id']).one()
+    return baseline_amps_query(session, pair, clamp_mode='ic', get_data=True)
+
+
+@canonical_query('query_pairs')
+def _query_pairs(session, sample):
+    return query_pairs(project_name=sample['project_name'], session=session)
+
+
+@canonical_query('finished_jobs')
+def _finished_jobs(session, sample):
+    q = session.query(db.Pipeline.job_id, db.Pipeline.finish_time, db.Pipeline.success)
+    return q.filter(db.Pipeline.module_name=='pulse_response')
+
+
+def _bake_read(table):
+    def read_query(session, sample):
+        ids = [i for i, in session.query(table.id).filter(table.experiment_id==sample['experiment_id']).limit(1000)]
+        queries = db.database.TableReadThread.read_queries(table, ids=ids)
+        return queries[0] if len(queries) > 0 else None
+    return read_query
+
+for _table in [db.StimPulse, db.PulseResponse, db.Baseline, db.PulseResponseStrength]:
+    canonical_query('bake_read_' + _table.__table__.name)(_bake_read(_table))
+
+
+def choose_sample(session):
+    """Choose the experiment / pair used to parameterize canonical queries.
+
+    Prefers a synaptically connected pair that has connection strength results.
+    """
+    q = session.query(db.Pair.id, db.Pair.experiment_id, db.Experiment.project_name).join(db.Experiment, db.Pair.experiment_id==db.Experiment.id)
+    q = q.join(db.ConnectionStrength, db.ConnectionStrength.pair_id==db.Pair.id)
+    rec = q.filter(db.Pair.synapse==True).order_by(db.Pair.id).first() or q.order_by(db.Pair.id).first()
+    if rec is None:
+        raise Exception("Database has no pairs with connection strength results; cannot choose sample queries.")
+    return {'pair_id': rec[0], 'experiment_id': rec[1], 'project_name': rec[2]}
+
+
+def explain(session, query):
+    """Return a dict describing the plan and cost of *query*.
+
+    On postgres, the query is run with EXPLAIN (ANALYZE, BUFFERS) and the result includes
+    the estimated cost, execution time and buffer usage. On sqlite, only the plan shape and
+    measured execution time are available.
+    """
+    stmt = query.statement if hasattr(query, 'statement') else query
+    dialect = session.bind.dialect
+    compiled = stmt.compile(dialect=dialect)
+    if dialect.positional:
+        params = [compiled.params[k] for k in compiled.positiontup]
+    else:
+        params = compiled.params
+    sql = str(compiled)
+    cursor = session.connection().connection.cursor()
+
+    result = {'sql': ' '.join(sql.split())}
+    if dialect.name == 'postgresql':
+        cursor.execute('EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) ' + sql, params)
+        plan = cursor.fetchone()[0]
+        if isinstance(plan, (str, type(u''))):
+            plan = json.loads(plan)
+        plan = plan[0]
+        root = plan['Plan']
+        result.update({
+            'shape': plan_shape(root),
+            'scans': plan_scans(root),
+            'total_cost': root['Total Cost'],
+            'plan_rows': root['Plan Rows'],
+            'actual_rows': root.get('Actual Rows'),
+            'execution_time': plan.get('Execution Time', 0) / 1000.,
+            'planning_time': plan.get('Planning Time', 0) / 1000.,
+            'buffers': root.get('Shared Hit Blocks', 0) + root.get('Shared Read Blocks', 0),
+            'shared_read': root.get('Shared Read Blocks', 0),
+        })
+    else:
+        cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+        details = [row[-1] for row in cursor.fetchall()]
+        # sqlite includes literal values / internal ids in some plan lines
+        details = [re.sub(r'\b\d+\b', 'N', d) for d in details]
+        start = time.time()
+        cursor.execute(sql, params)
+        n_rows = len(cursor.fetchall())
+        result.update({
+            'shape': ' / '.join(details),
+            'scans': sorted(set([d for d in details if d.startswith('SCAN') or d.startswith('SEARCH')])),
+            'total_cost': None,
+            'plan_rows': None,
+            'actual_rows': n_rows,
+            'execution_time': time.time() - start,
+            'planning_time': None,
+            'buffers': None,
+            'shared_read': None,
+        })
+    cursor.close()
+    session.rollback()
+    return result
+
+
+def plan_shape(node):
+    """Return a compact string describing the tree of node types, relations, and indexes in a postgres plan.
+    """
+    desc = node['Node Type']
+    target = [node[k] for k in ('Relation Name', 'Index Name') if k in node]
+    if len(target) > 0:
+        desc += '[%s]' % ':'.join(target)
+    children = node.get('Plans', [])
+    if len(children) > 0:
+        desc += '(%s)' % ', '.join([plan_shape(ch) for ch in children])
+    return desc
+
+
+def plan_scans(node):
+    """Return a sorted list of "node type[relation:index]" for all scan nodes in a postgres plan.
+    """
+    scans = set()
+    if 'Relation Name' in node:
+        scans.add('%s[%s]' % (node['Node Type'], ':'.join([node[k] for k in ('Relation Name', 'Index Name') if k in node])))
+    for ch in node.get('Plans', []):
+        scans |= set(plan_scans(ch))
+    return sorted(scans)
+
+
+def capture(session, sample, names=None):
+    """Return {name: explain result} for all (or selected) canonical queries.
+    """
+    results = OrderedDict()
+    for name, fn in canonical_queries.items():
+        if names is not None and name not in names:
+            continue
+        query = fn(session, sample)
+        if query is None:
+            print("  %s: skipped (no sample rows)" % name)
+            continue
+        results[name] = explain(session, query)
+        print("  %s: %0.3f sec" % (name, results[name]['execution_time']))
+    return results
+
+
+def compare(baseline, current, cost_ratio=1.5, time_ratio=2.0, buffer_ratio=2.0, min_time=0.01):
+    """Compare captured plans against a baseline and return a list of (name, message) regressions.
+    """
+    regressions = []
+    for name, cur in current.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        if cur['shape'] != base['shape']:
+            msg = "plan shape changed"
+            new_scans = sorted(set(cur['scans']) - set(base['scans']))
+            old_scans = sorted(set(base['scans']) - set(cur['scans']))
+            if len(new_scans) > 0:
+                msg += "; new scans: %s" % ', '.join(new_scans)
+            if len(old_scans) > 0:
+                msg += "; removed scans: %s" % ', '.join(old_scans)
+            msg += "\n        was: %s\n        now: %s" % (base['shape'], cur['shape'])
+            regressions.append((name, msg))
+        if base['total_cost'] and cur['total_cost'] is not None and cur['total_cost'] > base['total_cost'] * cost_ratio:
+            regressions.append((name, "estimated cost increased %0.1fx (%0.0f -> %0.0f)" % (
+                cur['total_cost'] / base['total_cost'], base['total_cost'], cur['total_cost'])))
+        if cur['execution_time'] > max(base['execution_time'] * time_ratio, min_time):
+            regressions.append((name, "execution time increased %0.1fx (%0.3f -> %0.3f sec)" % (
+                cur['execution_time'] / max(base['execution_time'], 1e-6), base['execution_time'], cur['execution_time'])))
+        if base['buffers'] and cur['buffers'] is not None and cur['buffers'] > base['buffers'] * buffer_ratio:
+            regressions.append((name, "buffer usage increased %0.1fx (%d -> %d blocks)" % (
+                cur['buffers'] / base['buffers'], base['buffers'], cur['buffers'])))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Check query plans for canonical workload queries against a stored baseline")
+    parser.add_argument('--baseline', type=str, default='query_plans.json', help="JSON file containing baseline plans")
+    parser.add_argument('--update', action='store_true', default=False, help="Capture new plans and overwrite the baseline file")
+    parser.add_argument('--queries', type=lambda s: s.split(','), default=None, help="Comma-separated list of queries to check: %s" % ', '.join(canonical_queries.keys()))
+    parser.add_argument('--cost-ratio', type=float, default=1.5, dest='cost_ratio', help="Report estimated cost increases larger than this factor")
+    parser.add_argument('--time-ratio', type=float, default=2.0, dest='time_ratio', help="Report execution time increases larger than this factor")
+    parser.add_argument('--buffer-ratio', type=float, default=2.0, dest='buffer_ratio', help="Report buffer usage increases larger than this factor")
+    args = parser.parse_args(sys.argv[1:])
+
+    session = db.Session()
+    baseline = None
+    if os.path.exists(args.baseline) and not args.update:
+        baseline = json.load(open(args.baseline))
+        sample = baseline['sample']
+        if session.query(db.Pair).filter(db.Pair.id==sample['pair_id']).count() == 0:
+            print("Sample pair %d from baseline is not in this database; choosing a new sample." % sample['pair_id'])
+            sample = choose_sample(session)
+    else:
+        sample = choose_sample(session)
+
+    print("Capturing query plans (database %s, sample %s).." % (db.db_name, sample))
+    plans = capture(session, sample, names=args.queries)
+
+    if baseline is None:
+        with open(args.baseline, 'w') as fh:
+            json.dump({'db_name': db.db_name, 'sample': sample, 'plans': plans}, fh, indent=2)
+        print("Wrote baseline for %d queries to %s" % (len(plans), args.baseline))
+        sys.exit(0)
+
+    regressions = compare(baseline['plans'], plans, cost_ratio=args.cost_ratio, time_ratio=args.time_ratio, buffer_ratio=args.buffer_ratio)
+    missing = [name for name in plans if name not in baseline['plans']]
+    if len(missing) > 0:
+        print("No baseline for: %s" % ', '.join(missing))
+
+    print("\n================== Query Plan Report ===========================")
+    if len(regressions) == 0:
+        print("No regressions in %d queries." % len(plans))
+    else:
+        for name, msg in regressions:
+            print("%-28s %s" % (name, msg))
+        sys.exit(1)
@@ -0,0 +1,34 @@
+"""Run a local read service that serves common database reads to many clients
+through one shared connection pool and result cache.
+
+Clients use multipatch_analysis.database.read_service once config.read_service_address
+is set to the address served here (for example "127.0.0.1:25430").
+"""
+from __future__ import print_function, division
+import argparse, sys
+from multipatch_analysis.database import read_service
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Serve common read operations to local clients")
+    parser.add_argument('--host', type=str, default='127.0.0.1', help="Interface to listen on")
+    parser.add_argument('--port', type=int, default=25430, help="Port to listen on")
+    parser.add_argument('--pool-size', type=int, default=5, dest='pool_size', help="Maximum number of database connections")
+    parser.add_argument('--cache-mb', type=float, default=512, dest='cache_mb', help="Maximum size of the shared result cache (MB)")
+    parser.add_argument('--state-interval', type=float, default=10.0, dest='state_interval', help="Minimum interval (sec) between checks for updated pipeline results")
+    args = parser.parse_args(sys.argv[1:])
+
+    server = read_service.ReadServer(
+        address=(args.host, args.port),
+        pool_size=args.pool_size,
+        cache_bytes=int(args.cache_mb * 1024**2),
+        state_interval=args.state_interval,
+    )
+    print("Serving %s on %s:%d" % (', '.join(read_service.ops.keys()), server.address[0], server.address[1]))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.stop()
+        print("Served %(requests)d requests (%(cache_hits)d from cache, %(errors)d errors)" % server.stats)
@@ -0,0 +1,80 @@
+"""Compare read performance of a baked sqlite file against the postgres database.
+
+Runs the canonical workload queries from query_plans.py (pulse responses, amplitudes,
+pair lists, ..) against both databases and reports the time to execute each query and
+fetch / decode all of its rows. The sqlite file is opened with the read profile used by
+database.sqlite_engine (read-only, memory-mapped, large page cache).
+
+Usage:
+
+    python util/sqlite_benchmark.py synphys.sqlite [--create-indexes] [--repeat 5]
+
+The sqlite file must have been baked from the postgres database configured for this
+machine so that both contain the same records.
+"""
+from __future__ import print_function, division
+import argparse, sys, os, time
+from collections import OrderedDict
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+import multipatch_analysis.database as db
+from query_plans import canonical_queries, choose_sample
+
+
+def time_query(session, fn, sample, repeat):
+    """Return (best time, n_rows) for fetching all rows of a canonical query.
+    """
+    times = []
+    for i in range(repeat):
+        query = fn(session, sample)
+        if query is None:
+            return None, 0
+        start = time.time()
+        if hasattr(query, 'all'):
+            rows = query.all()
+        else:
+            rows = session.execute(query).fetchall()
+        times.append(time.time() - start)
+        session.rollback()
+    return min(times), len(rows)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compare query performance of a baked sqlite file against postgres")
+    parser.add_argument('sqlite_file', type=str, help="Baked sqlite file")
+    parser.add_argument('--repeat', type=int, default=3, help="Number of times to run each query (best time is reported)")
+    parser.add_argument('--queries', type=lambda s: s.split(','), default=None, help="Comma-separated list of queries to run: %s" % ', '.join(canonical_queries.keys()))
+    parser.add_argument('--create-indexes', action='store_true', default=False, dest='create_indexes', help="Add covering indexes to the sqlite file first (files baked by older versions lack these)")
+    args = parser.parse_args(sys.argv[1:])
+
+    if not os.path.exists(args.sqlite_file):
+        print("sqlite file %s does not exist" % args.sqlite_file)
+        sys.exit(1)
+    sqlite_addr = 'sqlite:///' + args.sqlite_file
+    if args.create_indexes:
+        db.database.create_sqlite_indexes(create_engine(sqlite_addr))
+
+    sessions = OrderedDict([
+        ('postgres', db.Session()),
+        ('sqlite', sessionmaker(bind=db.database.sqlite_engine(sqlite_addr))()),
+    ])
+    if not db.database.db_address_ro.startswith('postgres'):
+        print("Configured database is not postgres (%s); only the sqlite file will be measured." % db.database.db_address_ro)
+        del sessions['postgres']
+
+    # baked files may contain a subset of experiments; choose a sample that both databases contain
+    sample = choose_sample(sessions['sqlite'])
+    print("Sample: %s\n" % sample)
+
+    names = [name for name in canonical_queries if args.queries is None or name in args.queries]
+    print("%-36s" % "query" + "".join(["%14s" % name for name in sessions]) + "%10s" % "rows")
+    for name in names:
+        results = [time_query(session, canonical_queries[name], sample, args.repeat) for session in sessions.values()]
+        if results[0][0] is None:
+            print("%-36s skipped (no sample rows)" % name)
+            continue
+        line = "%-36s" % name + "".join(["%12.1fms" % (t * 1000) for t, n in results]) + "%10d" % results[-1][1]
+        if len(set([n for t, n in results])) > 1:
+            line += "   (row counts differ: %s)" % ', '.join(['%s=%d' % (k, n) for k, (t, n) in zip(sessions, results)])
+        print(line)
@@ -0,0 +1,33 @@
+"""Fill the configured database with synthetic experiments for load testing.
+
+Example: grow the database by 500 experiments, then time a pipeline stage and a bake:
+
+    python util/synthetic_db.py 500 --seed 1
+    python util/analysis_pipeline.py pair_summary
+    python util/database.py --bake --project synthetic
+
+See multipatch_analysis/database/synthetic.py.
+"""
+from __future__ import print_function, division
+import argparse, sys, time
+import multipatch_analysis.database as db
+from multipatch_analysis.database.synthetic import SyntheticDataGenerator
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Add synthetic experiments to the database")
+    parser.add_argument('n_experiments', type=int, help="Number of experiments to add")
+    parser.add_argument('--seed', type=int, default=0, help="Random seed")
+    parser.add_argument('--cells', type=int, default=8, help="Number of cells per experiment")
+    parser.add_argument('--sweeps', type=int, default=24, help="Number of sync recordings per experiment")
+    parser.add_argument('--pulses', type=int, default=12, help="Number of presynaptic pulses per sweep")
+    parser.add_argument('--connection-probability', type=float, default=0.15, dest='connection_probability', help="Probability that any pair is connected")
+    parser.add_argument('--project', type=str, default='synthetic', help="Project name for generated experiments")
+    args = parser.parse_args(sys.argv[1:])
+
+    session = db.Session(readonly=False)
+    gen = SyntheticDataGenerator(session, seed=args.seed, n_cells=args.cells, n_sweeps=args.sweeps, n_pulses=args.pulses,
+                                 connection_probability=args.connection_probability, project_name=args.project)
+    start = time.time()
+    gen.generate(args.n_experiments)
+    print("Added %d experiments in %0.1f sec" % (args.n_experiments, time.time() - start))